@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+#
+# Acceleration table generator and profile library, using NumPy.
+#
+# The dsPIC steps the motors with the delays (in 1us timer ticks) from a
+# 512 entry table, moving one entry per step (see acceleration.py). For a
+# constant acceleration of a steps/s^2 from a stop, step n happens at
+# t = sqrt(2n/a), so the delay before the next step is
+#
+#     c0 * (sqrt(n+1) - sqrt(n))    where c0 = sqrt(2/a)
+#
+# default_acceleration_table is this with c0 = 30716 ticks (about 2120
+# steps/s^2), rounded down - to within one tick, whatever made it rounded
+# a few entries differently. Here the tables are made from physical
+# numbers - acceleration and top speed in mm/s - for a step mode, so we can
+# compare profiles by how long they take to cover a number of cells.
+#
+# Copyright 2016 Rob Probin.
+# All original work.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+from __future__ import print_function
+
+import sys
+import numpy as np
+from acceleration import TABLE_TICK_TIME, default_acceleration_table, estimate_move_time
+
+TABLE_SIZE = 512
+CELL_SIZE_MM = 180.0
+# steps per cell for each step mode (distance_cell in mouse.py)
+STEPS_PER_CELL = {1: 347, 2: 2*347, 4: 4*347, 8: 8*347}
+
+# The table entries are read as signed 16 bit ints on the dsPIC.
+MAX_STEP_TICKS = 0x7FFF
+# Shortest step we allow, so both motor interrupts can keep up. This is a
+# safety limit, not a measured one - the default table goes down to 679.
+MIN_STEP_TICKS = 250
+
+
+def mm_per_step(step_mode):
+    return CELL_SIZE_MM / STEPS_PER_CELL[step_mode]
+
+
+# Make a table for acceleration (mm/s^2), optionally limited to max_speed
+# (mm/s), in the given step mode. The first entry is limited to what fits,
+# and the steps are never shorter than MIN_STEP_TICKS, which caps the top
+# speed in the fine step modes.
+def generate_acceleration_table(acceleration, max_speed=None, step_mode=2, size=TABLE_SIZE):
+    steps_acceleration = acceleration / mm_per_step(step_mode)
+    c0 = np.sqrt(2.0 / steps_acceleration) / TABLE_TICK_TIME
+    return _table_from_c0(c0, max_speed, step_mode, size)
+
+
+def _table_from_c0(c0, max_speed=None, step_mode=2, size=TABLE_SIZE):
+    n = np.arange(size, dtype=np.float64)
+    delays = c0 * (np.sqrt(n + 1) - np.sqrt(n))
+    if max_speed is not None:
+        min_delay = mm_per_step(step_mode) / max_speed / TABLE_TICK_TIME
+        delays = np.maximum(delays, min_delay)
+    delays = np.floor(delays)
+    delays = np.clip(delays, MIN_STEP_TICKS, MAX_STEP_TICKS)
+    return [int(d) for d in delays]
+
+
+# The acceleration (mm/s^2) and top speed (mm/s, at the last entry) of a
+# table, the other way round from generate_acceleration_table().
+def table_acceleration(table, step_mode=2):
+    c0 = float(table[1]) / (np.sqrt(2) - 1)
+    steps_acceleration = 2.0 / (c0 * TABLE_TICK_TIME) ** 2
+    return steps_acceleration * mm_per_step(step_mode)
+
+def table_top_speed(table, step_mode=2):
+    return mm_per_step(step_mode) / (table[-1] * TABLE_TICK_TIME)
+
+
+# What write_acceleration_table() and the dsPIC need. Returns a list of
+# problems, which is empty if the table is OK.
+def validate_acceleration_table(table):
+    problems = []
+    if len(table) != TABLE_SIZE:
+        problems.append("Table is %d long, not %d" % (len(table), TABLE_SIZE))
+    if not all(isinstance(v, int) for v in table):
+        problems.append("Table entries must be ints")
+        return problems
+    values = np.asarray(table)
+    if (values > MAX_STEP_TICKS).any() or (values <= 0).any():
+        problems.append("Entries must be 1 to %d" % MAX_STEP_TICKS)
+    if (values < MIN_STEP_TICKS).any():
+        problems.append("Entries below %d (step rate too high)" % MIN_STEP_TICKS)
+    if (np.diff(values) > 0).any():
+        problems.append("Entries must not go up (later entries are faster)")
+    return problems
+
+
+# name: (acceleration mm/s^2, max speed mm/s or None). Acceleration is for
+# step mode 2; the default profile is the original table. With no max
+# speed, the top speed is wherever the acceleration gets to by the end of
+# the table (see table_top_speed()) - in step mode 2 that's about 565 mm/s
+# for "fast" and 650 mm/s for "fastest", so their caps hold them below it.
+DEFAULT_ACCELERATION = table_acceleration(default_acceleration_table)
+PROFILES = {
+    "default": (DEFAULT_ACCELERATION, None),
+    "gentle": (400.0, None),
+    "brisk": (800.0, None),
+    "fast": (1200.0, 500.0),
+    "fastest": (1600.0, 600.0),
+}
+
+_profile_tables = {}
+
+# The table for a profile in a step mode. Raises ValueError for a profile
+# or step mode we don't have, or a table the dsPIC can't use.
+def get_profile_table(name, step_mode=2):
+    key = (name, step_mode)
+    if key not in _profile_tables:
+        if name not in PROFILES:
+            raise ValueError("No acceleration profile %r" % (name,))
+        if step_mode not in STEPS_PER_CELL:
+            raise ValueError("Acceleration profiles not done for step mode %r" % (step_mode,))
+        if name == "default" and step_mode == 2:
+            table = list(default_acceleration_table)
+        else:
+            acceleration, max_speed = PROFILES[name]
+            table = generate_acceleration_table(acceleration, max_speed, step_mode)
+        problems = validate_acceleration_table(table)
+        if problems:
+            raise ValueError("Acceleration profile %s is not valid: %s" % (name, ", ".join(problems)))
+        _profile_tables[key] = table
+    return _profile_tables[key]
+
+
+# Time in seconds to go 1 to max_cells cells in one move (stopped at both
+# ends), as a NumPy array indexed by cells-1
+def cell_times(table, speed, max_cells=16, step_mode=2):
+    steps = STEPS_PER_CELL[step_mode]
+    return np.array([estimate_move_time(cells * steps, speed, table) for cells in range(1, max_cells + 1)])
+
+
+if __name__ == "__main__":
+    def test():
+        # the generator gives back the original table
+        default = np.array(default_acceleration_table)
+        if abs(np.array(_table_from_c0(30716)) - default).max() > 1:
+            print("Generator doesn't match default_acceleration_table")
+            sys.exit(1)
+        if abs(np.array(generate_acceleration_table(DEFAULT_ACCELERATION)) - default).max() > 1:
+            print("Default profile doesn't match default_acceleration_table")
+            sys.exit(1)
+        if validate_acceleration_table(list(default_acceleration_table)):
+            print("default_acceleration_table not valid?")
+            sys.exit(1)
+        if not validate_acceleration_table([100] * 10) or not validate_acceleration_table(list(range(1000, 1512))):
+            print("Bad tables not found")
+            sys.exit(1)
+
+        # a max speed really limits the table
+        for name in ("fast", "fastest"):
+            acceleration, max_speed = PROFILES[name]
+            if generate_acceleration_table(acceleration, max_speed) == generate_acceleration_table(acceleration):
+                print("Max speed of", name, "makes no difference")
+                sys.exit(1)
+            if abs(table_top_speed(get_profile_table(name)) - max_speed) > 0.01 * max_speed:
+                print("Top speed of", name, "is not its max speed")
+                sys.exit(1)
+
+        # every profile in every step mode mouse.py knows about
+        for step_mode in STEPS_PER_CELL:
+            for name in PROFILES:
+                try:
+                    get_profile_table(name, step_mode)
+                except ValueError as e:
+                    print("Step mode", step_mode, e)
+                    sys.exit(1)
+        for name, step_mode in (("warp", 2), ("gentle", 3)):
+            try:
+                get_profile_table(name, step_mode)
+                print("No error for profile", name, "step mode", step_mode)
+                sys.exit(1)
+            except ValueError:
+                pass
+
+        speed = 500
+        cells = (1, 2, 4, 8, 15)
+        print("Profile   accel mm/s2  top mm/s  " + "  ".join("%2d cells" % c for c in cells))
+        for name in sorted(PROFILES, key=lambda n: PROFILES[n][0]):
+            table = get_profile_table(name)
+            times = cell_times(table, speed)
+            print("%-9s %11.0f %9.0f  " % (name, table_acceleration(table), table_top_speed(table)) +
+                  "  ".join("%7.3fs" % times[c-1] for c in cells))
+
+    test()
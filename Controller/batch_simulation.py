@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+#
+# Batch simulation of mouse.py over a directory of mazes.
+#
+# Each maze is run like the HEADLESS_SIMULATOR mode of mouse.py: a
+# MouseController does the whole run_program() search and speed run
+# against low_level_emulator, on a virtual clock, with the keys pressed
+# for it. The mazes are shared out over a ProcessPoolExecutor, one maze
+# at a time per worker process (the emulator and the clock are per
+# process), so a big corpus takes as many times less as there are cores.
+#
+# The mazes are 16x16 .maz text files, in the same format as the examples
+# in maze.py (see Maze.parse_maz_format()).
+#
+# Usage:
+#    python batch_simulation.py <maze directory> [workers]
+#
+# With no arguments it runs a self test on the built in example mazes.
+#
+# Copyright 2016 Rob Probin.
+# All original work.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+from __future__ import print_function
+
+import sys
+import os
+import time
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+from maze import Maze, MazeFailedToRead
+
+MAZE_SIZE = 16      # the automatic keys select the 16x16 maze
+# simulated seconds before we give up on a maze
+SIMULATED_TIME_LIMIT = 3600
+
+
+def load_maze_file(filename):
+    with open(filename, 'r') as f:
+        text = f.read().replace("\r", "").strip("\n")
+    size = (len(text.split("\n")) - 1) // 2
+    m = Maze(size)
+    m.parse_maz_format(text)
+    return m
+
+
+def find_maze_files(directory):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.endswith(".maz"))
+
+
+# Run one maze, in a worker process. Returns a dictionary of what happened.
+def simulate_maze(filename, time_limit=SIMULATED_TIME_LIMIT):
+    result = {
+        "maze": os.path.basename(filename),
+        "completed": False,
+        "crashed": False,
+        "timed_out": False,
+        "error": None,
+        "cells_explored": 0,
+        "moves": 0,
+        "turns": 0,
+        "serial_bytes": 0,
+        "simulated_time": 0.0,
+        "search_time": None,
+        "speed_run_time": None,
+        "cpu_time": 0.0,
+    }
+    try:
+        maze = load_maze_file(filename)
+    except (IOError, MazeFailedToRead):
+        result["error"] = "Can't read maze"
+        return result
+    if maze.size != MAZE_SIZE:
+        result["error"] = "Maze is %dx%d, not %dx%d" % (maze.size, maze.size, MAZE_SIZE, MAZE_SIZE)
+        return result
+
+    # mouse.py and the emulator pick their mode from the command line when
+    # they are first imported
+    sys.argv[1:] = ["HEADLESS_SIMULATOR"]
+    import sim_clock
+    import low_level_emulator
+    import mouse
+
+    # worker processes are reused, so start each maze from nothing
+    sim_clock.use_virtual_clock()
+    low_level_emulator.EMULATOR_MAZE = maze
+    low_level_emulator.EMULATOR_TIME_LIMIT = time_limit
+    start_cpu = time.process_time()
+    port = None
+    controller = None
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            port = mouse.set_up_port()
+            controller = mouse.make_controller(port)
+            result["completed"] = bool(controller.run_program())
+        except SystemExit:
+            # the emulator stops on a crash or the time limit
+            if port is None or not (port.crashed or port.timed_out):
+                result["error"] = "Exited"
+        except Exception as e:
+            result["error"] = "%s %s" % (type(e).__name__, e)
+
+    result["cpu_time"] = time.process_time() - start_cpu
+    result["simulated_time"] = sim_clock.time()
+    if port is not None:
+        result["crashed"] = port.crashed
+        result["timed_out"] = port.timed_out
+        result["cells_explored"] = len(port.cells_visited)
+        result["moves"] = port.moves
+        result["turns"] = port.turns
+        result["serial_bytes"] = port.bytes_written + port.bytes_read
+    if controller is not None:
+        result["search_time"] = controller.search_time
+        result["speed_run_time"] = controller.speed_run_time
+    return result
+
+
+# Run every maze file, with up to workers processes (None is one per
+# core). Returns the results in the same order as maze_files.
+def run_batch(maze_files, workers=None, time_limit=SIMULATED_TIME_LIMIT):
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(simulate_maze, maze_files, [time_limit] * len(maze_files)))
+
+
+def print_results(results):
+    def seconds(value):
+        return "-" if value is None else "%.1fs" % value
+
+    print("%-24s %-9s %6s %6s %6s %8s %9s %9s %9s %8s" %
+          ("Maze", "Result", "Cells", "Moves", "Turns", "Bytes", "Sim time", "Search", "Speed run", "CPU"))
+    for r in results:
+        if r["error"] is not None:
+            outcome = "ERROR"
+        elif r["crashed"]:
+            outcome = "CRASHED"
+        elif r["timed_out"]:
+            outcome = "TIMEOUT"
+        elif r["completed"]:
+            outcome = "ok"
+        else:
+            outcome = "no solve"
+        print("%-24s %-9s %6d %6d %6d %8d %8.1fs %9s %9s %7.2fs" %
+              (r["maze"][:24], outcome, r["cells_explored"], r["moves"], r["turns"],
+               r["serial_bytes"], r["simulated_time"], seconds(r["search_time"]),
+               seconds(r["speed_run_time"]), r["cpu_time"]))
+        if r["error"] is not None:
+            print("    ", r["error"])
+
+    completed = [r for r in results if r["completed"]]
+    print("%d mazes, %d completed, %d crashed, %d timed out, %d errors" %
+          (len(results), len(completed), sum(r["crashed"] for r in results),
+           sum(r["timed_out"] for r in results), sum(r["error"] is not None for r in results)))
+    if completed:
+        def mean(key):
+            return sum(r[key] for r in completed) / float(len(completed))
+        print("Completed mazes average: %.1f cells, %.1f moves, %.1f turns, %.0f bytes, %.1f s simulated" %
+              (mean("cells_explored"), mean("moves"), mean("turns"), mean("serial_bytes"), mean("simulated_time")))
+        timed = [r for r in completed if r["speed_run_time"] is not None]
+        if timed:
+            print("Average search %.1f s, speed run %.2f s" %
+                  (sum(r["search_time"] for r in timed) / len(timed),
+                   sum(r["speed_run_time"] for r in timed) / len(timed)))
+
+
+def main(directory, workers=None):
+    maze_files = find_maze_files(directory)
+    if not maze_files:
+        print("No .maz files in", directory)
+        sys.exit(1)
+    start = time.time()
+    results = run_batch(maze_files, workers)
+    print_results(results)
+    print("%d mazes in %.1f s" % (len(maze_files), time.time() - start))
+    if any(r["crashed"] or r["error"] is not None for r in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    def test():
+        import tempfile
+
+        # the built in example mazes, and one with the centre walled off
+        with tempfile.TemporaryDirectory() as directory:
+            for select in range(3):
+                m = Maze(MAZE_SIZE)
+                m.load_example_maze(select)
+                with open(os.path.join(directory, "example%d.maz" % select), 'w') as f:
+                    f.write(maze_text(m))
+            m = Maze(MAZE_SIZE)
+            m.load_example_maze(2)
+            for row, column in m.normal_end_cells():
+                for heading in range(4):
+                    m.set_front_wall(heading, row, column)
+            with open(os.path.join(directory, "closed.maz"), 'w') as f:
+                f.write(maze_text(m))
+            with open(os.path.join(directory, "small.maz"), 'w') as f:
+                f.write(maze_text(Maze(5)))
+
+            start = time.time()
+            results = run_batch(find_maze_files(directory))
+            print_results(results)
+            print("Wall clock %.1f s, %d CPUs" % (time.time() - start, os.cpu_count()))
+        by_name = dict((r["maze"], r) for r in results)
+        for select in range(3):
+            r = by_name["example%d.maz" % select]
+            if not r["completed"] or r["crashed"] or r["error"] is not None:
+                print("Example maze", select, "failed")
+                sys.exit(1)
+            if r["cells_explored"] < 10 or r["turns"] == 0 or r["serial_bytes"] == 0 or not r["speed_run_time"]:
+                print("Example maze", select, "metrics missing")
+                sys.exit(1)
+        if by_name["closed.maz"]["completed"] or by_name["closed.maz"]["crashed"]:
+            print("Closed maze was solved?")
+            sys.exit(1)
+        if by_name["small.maz"]["error"] is None:
+            print("5x5 maze not rejected")
+            sys.exit(1)
+
+    # a Maze as .maz text, for load_maze_file()
+    def maze_text(m):
+        lines = []
+        for row in range(m.size - 1, -1, -1):
+            lines.append("".join("+-" if m.get_front_wall(0, row, column) else "+ "
+                                 for column in range(m.size)) + "+")
+            lines.append("".join("| " if m.get_front_wall(3, row, column) else "  "
+                                 for column in range(m.size)) + "|")
+        lines.append("+-" * m.size + "+")
+        return "\n".join(lines)
+
+    if len(sys.argv) >= 2:
+        main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) >= 3 else None)
+    else:
+        test()
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+#
+# IR calibration statistics for the Vision2 Micromouse Robot, using NumPy.
+#
+# During calibration the mouse is put in a number of positions (next to the
+# left wall, in the middle, etc.) and the five IR levels are read in each.
+# Every reading is kept, rather than just the smallest and largest, and
+# the thresholds are worked out from trimmed means and trimmed minimums, so
+# one bad reading can't set a threshold.
+#
+# A position is finished once each sensor has min_samples and the 95%
+# confidence interval of its mean is tight enough, or max_samples have
+# been read - whichever comes first.
+#
+# Copyright 2016 Rob Probin.
+# All original work.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+from __future__ import print_function
+
+import sys
+import numpy as np
+
+SENSORS = ("front", "l90", "l45", "r90", "r45")
+
+# The positions the mouse is put in, in order, and what to tell the user
+POSITIONS = (
+    ("far_left", "Move to 0cm from left wall"),
+    ("left", "Move to 1.5cm from left wall"),
+    ("middle", "Move to middle between left and right walls"),
+    ("right", "Move to 1.5cm from right wall"),
+    ("far_right", "Move to 0cm from right wall"),
+    ("front_center", "Move to furthest away from front wall but most of robot in cell"),
+    ("front_long", "Move front of mouse to 1 cell away from front wall"),
+)
+
+# Few enough that the confidence interval decides when steady readings
+# are finished, but enough for it to mean something
+MIN_SAMPLES = 5
+MAX_SAMPLES = 50
+# a position is finished when the 95% confidence interval of the mean is
+# within this many counts, or this fraction of the mean, either side
+CONFIDENCE_COUNTS = 2
+CONFIDENCE_FRACTION = 0.02
+
+TRIM_FRACTION = 0.1         # trimmed mean drops this much off each end
+LOW_PERCENTILE = 5
+
+
+# trimmed mean, standard deviation, percentiles etc. of some readings
+def robust_stats(values, trim=TRIM_FRACTION):
+    values = np.sort(np.asarray(values, dtype=np.float64))
+    n = len(values)
+    if n == 0:
+        return None
+    cut = int(n * trim)
+    trimmed = values[cut:n-cut] if n - 2*cut > 0 else values
+    p5, p50, p95 = np.percentile(values, (LOW_PERCENTILE, 50, 100 - LOW_PERCENTILE))
+    std = values.std(ddof=1) if n > 1 else 0.0
+    trimmed_std = trimmed.std(ddof=1) if len(trimmed) > 1 else 0.0
+    return {
+        "count": n,
+        "trimmed_mean": trimmed.mean(),
+        "std": std,
+        # 95% half width of the trimmed mean, so glitches don't stop it
+        # from ever being tight enough
+        "confidence": 1.96 * trimmed_std / np.sqrt(len(trimmed)),
+        "min": values[0],
+        "trimmed_min": trimmed[0],
+        "p5": p5,
+        "median": p50,
+        "p95": p95,
+        "max": values[-1],
+    }
+
+
+class PositionSamples(object):
+
+    def __init__(self, max_samples=MAX_SAMPLES):
+        self.max_samples = max_samples
+        self.samples = np.zeros((len(SENSORS), max_samples), dtype=np.int32)
+        self.counts = np.zeros(len(SENSORS), dtype=np.int32)
+
+    # Readings after max_samples are ignored
+    def add(self, sensor, value):
+        index = SENSORS.index(sensor)
+        count = self.counts[index]
+        if count < self.max_samples:
+            self.samples[index, count] = value
+            self.counts[index] = count + 1
+
+    def values(self, sensor):
+        index = SENSORS.index(sensor)
+        return self.samples[index, :self.counts[index]]
+
+    def stats(self, sensor):
+        return robust_stats(self.values(sensor))
+
+    def is_done(self, min_samples=MIN_SAMPLES, counts=CONFIDENCE_COUNTS, fraction=CONFIDENCE_FRACTION):
+        if (self.counts >= self.max_samples).all():
+            return True
+        if (self.counts < min_samples).any():
+            return False
+        for index, sensor in enumerate(SENSORS):
+            if self.counts[index] >= self.max_samples:
+                continue
+            s = self.stats(sensor)
+            if s["confidence"] > max(counts, fraction * s["trimmed_mean"]):
+                return False
+        return True
+
+
+class CalibrationEngine(object):
+
+    def __init__(self, min_samples=MIN_SAMPLES, max_samples=MAX_SAMPLES,
+                 confidence_counts=CONFIDENCE_COUNTS, confidence_fraction=CONFIDENCE_FRACTION):
+        self.min_samples = min_samples
+        self.confidence_counts = confidence_counts
+        self.confidence_fraction = confidence_fraction
+        self.positions = {}
+        for name, _ in POSITIONS:
+            self.positions[name] = PositionSamples(max_samples)
+
+    def add(self, position, sensor, value):
+        self.positions[position].add(sensor, value)
+
+    def is_done(self, position):
+        return self.positions[position].is_done(self.min_samples, self.confidence_counts,
+                                                self.confidence_fraction)
+
+    def stats(self, position, sensor):
+        return self.positions[position].stats(sensor)
+
+    # Thresholds in the same form as IR_threshold_defaults in mouse.py.
+    # These follow the old min/max calculation, but with trimmed means in
+    # place of the extremes, and the lowest reading left after trimming in
+    # place of the minimum.
+    def thresholds(self):
+        def mean(position, sensor):
+            return self.stats(position, sensor)["trimmed_mean"]
+
+        def low(position, sensor):
+            return self.stats(position, sensor)["trimmed_min"]
+
+        IR = {}
+        # diagonal - between 1.5cm away and the middle, too close at 1/1.4
+        l45_middle = mean("middle", "l45")
+        r45_middle = mean("middle", "r45")
+        l45_diff = mean("left", "l45") - l45_middle
+        r45_diff = mean("right", "r45") - r45_middle
+        IR["left_45_threshold"] = int(l45_diff / 2.0 + l45_middle)
+        IR["right_45_threshold"] = int(r45_diff / 2.0 + r45_middle)
+        IR["left_45_too_close_threshold"] = int(l45_diff / 1.4 + l45_middle)
+        IR["right_45_too_close_threshold"] = int(r45_diff / 1.4 + r45_middle)
+
+        # wall detect - detect over other side
+        IR["left_side_threshold"] = int(low("far_right", "l90"))
+        IR["right_side_threshold"] = int(low("far_left", "r90"))
+
+        # front wall
+        IR["front_long_threshold"] = int(low("front_long", "front"))
+        IR["front_short_threshold"] = int(low("front_center", "front"))
+        return IR
+
+    # Human readable statistics and raw readings, for the calibration log
+    def write_raw_data(self, f):
+        for name, description in POSITIONS:
+            f.write("\n%s (%s)\n" % (name, description))
+            for sensor in SENSORS:
+                values = self.positions[name].values(sensor)
+                s = robust_stats(values)
+                if s is None:
+                    f.write("  %s: no readings\n" % sensor)
+                    continue
+                f.write("  %s: n=%d trimmed mean=%.1f std=%.1f p5=%.1f median=%.1f p95=%.1f min=%d max=%d\n" %
+                        (sensor, s["count"], s["trimmed_mean"], s["std"], s["p5"], s["median"],
+                         s["p95"], s["min"], s["max"]))
+                f.write("    %s\n" % " ".join(str(v) for v in values))
+
+
+if __name__ == "__main__":
+    def test():
+        # made up sensor readings for each position, with noise and the odd
+        # glitch, and check the thresholds end up between the positions
+        rng = np.random.RandomState(1)
+        levels = {
+            "far_left":     {"front": 20, "l90": 900, "l45": 800, "r90": 120, "r45": 100},
+            "left":         {"front": 20, "l90": 500, "l45": 600, "r90": 160, "r45": 200},
+            "middle":       {"front": 20, "l90": 250, "l45": 300, "r90": 250, "r45": 300},
+            "right":        {"front": 20, "l90": 160, "l45": 200, "r90": 500, "r45": 600},
+            "far_right":    {"front": 20, "l90": 120, "l45": 100, "r90": 900, "r45": 800},
+            "front_center": {"front": 60, "l90": 250, "l45": 300, "r90": 250, "r45": 300},
+            "front_long":   {"front": 18, "l90": 250, "l45": 300, "r90": 250, "r45": 300},
+        }
+        # the old calibration took a fixed 10 readings, and the minimum
+        OLD_SAMPLES = 10
+        engine = CalibrationEngine()
+        old_style = {}
+        total_readings = 0
+        for position, _ in POSITIONS:
+            reading = 0
+            while not engine.is_done(position):
+                for sensor in SENSORS:
+                    level = levels[position][sensor]
+                    value = int(rng.normal(level, level * 0.02))
+                    if reading == 3 and sensor == "l90":
+                        value = 0       # one glitch
+                    engine.add(position, sensor, value)
+                    old = old_style.setdefault(position, {}).setdefault(sensor, [])
+                    if len(old) < OLD_SAMPLES:
+                        old.append(value)
+                reading += 1
+            total_readings += reading
+            print("%-12s finished after %d readings" % (position, reading))
+
+        IR = engine.thresholds()
+        if not (levels["middle"]["l45"] < IR["left_45_threshold"] < IR["left_45_too_close_threshold"] < levels["left"]["l45"]):
+            print("45 thresholds not between middle and left")
+            sys.exit(1)
+        if not (0 < IR["left_side_threshold"] <= levels["far_right"]["l90"]):
+            print("Side threshold wrong")
+            sys.exit(1)
+        # the old way: the glitch sets the threshold
+        old_threshold = min(old_style["far_right"]["l90"])
+        print("left_side_threshold %d (min of first %d readings gives %d)" %
+              (IR["left_side_threshold"], OLD_SAMPLES, old_threshold))
+        print("Thresholds", IR)
+
+        # steady readings finish sooner than the old fixed count
+        engine = CalibrationEngine()
+        most_readings = 0
+        for position, _ in POSITIONS:
+            reading = 0
+            while not engine.is_done(position):
+                for sensor in SENSORS:
+                    level = levels[position][sensor]
+                    engine.add(position, sensor, int(rng.normal(level, level * 0.005)))
+                reading += 1
+            if reading >= OLD_SAMPLES:
+                print("Low noise %s took %d readings, no quicker than before" % (position, reading))
+                sys.exit(1)
+            most_readings = max(most_readings, reading)
+        print("Low noise positions finish after at most %d readings" % most_readings)
+
+        try:
+            from StringIO import StringIO
+        except ImportError:
+            from io import StringIO
+        f = StringIO()
+        engine.write_raw_data(f)
+        if "far_right" not in f.getvalue():
+            print("Raw data missing")
+            sys.exit(1)
+
+    test()
@@ -4,9 +4,10 @@
 # for mouse.py. This allows it to be run on a standard computer
 # without he I/O controller running.
 #
-# This operates in two modes: 
+# This operates in three modes: 
 #    (1) text mode.
 #    (2) graphical mode when called from graphic_emulator.
+#    (3) headless mode, with no keyboard or output, on a virtual clock.
 #
 # In the second case we disable text output from this file, and
 # route output to the graphic_emulator GUI shell. One advantage
@@ -32,15 +33,31 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 #
 from __future__ import print_function
-from collections import deque
 from maze import Maze
-import time
+import sim_clock
 from keyboard_thread import KeyThread
+from acceleration import default_acceleration_table, move_profile
+from bisect import bisect_left
+import heapq
 import sys
+import threading
 
 PAUSE_ON_MOVE = False
 AUTOMATIC_KEYS = False
 
+# a Maze to run in, rather than the built in example (see batch_simulation.py)
+EMULATOR_MAZE = None
+# stop with an error if the mouse is still going after this many
+# (simulated) seconds, e.g. it can't solve the maze. None is no limit.
+EMULATOR_TIME_LIMIT = None
+# how often the keys and LED display are looked at when there is a
+# keyboard or GUI (seconds). Headless, only the timers are looked at, when
+# they are due.
+BACKGROUND_INTERVAL = 0.01
+# Speed samples are taken every other timer 3 interrupt: 0x1000 * 64
+# prescale at FCY = 8MHz (see timer_interrupts.c)
+SPEED_SAMPLE_INTERVAL = 2 * 0x1000 * 64 / 8000000.0
+
 EMULATOR_BATTERY_CELL_VOLTAGE = 4.24 #4.25 #3.8 #3.7
 EMULATOR_BATTERY_ADC = 0x3FF & int(((4*EMULATOR_BATTERY_CELL_VOLTAGE) *1023 * 12000) / ((33000+12000) * 5 * 0.95))
 
@@ -49,6 +66,20 @@ if len(sys.argv) >= 2 and sys.argv[1] == "TEXT_SIMULATOR":
 else:
     TEXT_SIMULATOR = False
 
+if len(sys.argv) >= 2 and sys.argv[1] == "HEADLESS_SIMULATOR":
+    # no keyboard and no output, so the keys are pressed for us. mouse.py
+    # runs this on the virtual clock (see sim_clock.py).
+    HEADLESS_SIMULATOR = True
+    AUTOMATIC_KEYS = True
+else:
+    HEADLESS_SIMULATOR = False
+
+# Moves take as long as they would on the mouse (from the acceleration
+# table and the speed), and send EV_FINISHED_MOVE at the end. If False
+# they finish straight away. On the virtual clock this costs nothing, but
+# in the other modes it means really waiting - a search takes minutes.
+EMULATE_MOVE_TIMES = HEADLESS_SIMULATOR
+
 def lleprint(*args, **kargs):
     if TEXT_SIMULATOR:
         sep  = kargs.get('sep', ' ')            # Keyword arg defaults
@@ -67,7 +98,7 @@ class intermediate_writer:
         self.dest = dest
         self.led_text = ""
         self.led_print = False
-        self.led_end = time.time() + 1
+        self.led_end = sim_clock.time() + 1
 
     def flush(self):
         self.dest.flush()
@@ -78,12 +109,12 @@ class intermediate_writer:
                 self.led_text += text
             else:
                 self.led_text = text
-            self.led_end = time.time() + 0.05
+            self.led_end = sim_clock.time() + 0.05
         else:
             if len(self.led_text):
                 self.dest.write(self.led_text)
                 self.led_text = ""
-                self.led_end = time.time() + 1
+                self.led_end = sim_clock.time() + 1
             self.dest.write(text)
 
     def start_led_print(self):
@@ -97,10 +128,10 @@ class intermediate_writer:
         text = self.led_text
         self.led_text = ""
         self.write(text)
-        self.led_end = time.time() + 1
+        self.led_end = sim_clock.time() + 1
 
     def do_delayed_LEDs(self):
-        if self.led_end < time.time():
+        if self.led_end < sim_clock.time():
             self.flush_leds()
 
 class serial:
@@ -113,16 +144,24 @@ class serial:
             self.iw = intermediate_writer(sys.stdout)
             sys.stdout = self.iw
 
-            self.replies = deque()
+            self.replies = bytearray()
             self.locked = True
+            # mouse.py can read from another thread to the one writing
+            self.lock = threading.RLock()
             
             self.heading = 0
             self.row = 0
             self.column = 0
 
-            self.maze = Maze(16)
-            self.maze.load_example_maze()
-            self.target_time = time.time() + 2
+            if EMULATOR_MAZE is not None:
+                self.maze = EMULATOR_MAZE
+            else:
+                self.maze = Maze(16)
+                self.maze.load_example_maze()
+            self.start_time = sim_clock.time()
+            self.target_time = self.start_time + 2
+            self.next_background_time = self.start_time
+            self.wake_time = None
             self.timer_state = 0
             
             self.IR = False
@@ -130,6 +169,9 @@ class serial:
             if TEXT_SIMULATOR:
                 self.keys = KeyThread()
                 self.gui = self
+            elif HEADLESS_SIMULATOR:
+                self.keys = self
+                self.gui = self
             self.key_delayed = None
             
             self.timeout = timeout
@@ -138,10 +180,36 @@ class serial:
             
             self.shift_middle()
             
-            self.accel_table = [0]*512
+            # the dsPIC starts with the table built into the firmware
+            self.accel_table = list(default_acceleration_table)
+            self.move_profiles = {}     # (distance, speed): move_profile()
+            self.speed = 50             # until the mouse sets it
+            self.speed_samples = False
+            # until the mouse sets it (step mode 2 value)
+            self.cell_distance = 694
+
+            # replies due later (e.g. at the end of a move), as a heap of
+            # (time, order, data)
+            self.timed_replies = []
+            self.timed_reply_count = 0
+            self.move_end_time = self.start_time
+
+            # what happened, for batch_simulation.py
+            self.moves = 0
+            self.turns = 0
+            self.cells_visited = set([(0, 0)])
+            self.bytes_written = 0      # by mouse.py
+            self.bytes_read = 0
+            self.crashed = False
+            self.timed_out = False
+            self.move_time = 0.0        # total time spent moving
 
         def set_action(self, action):
             pass
+
+        # keys come from AUTOMATIC_KEYS when headless
+        def get_key(self):
+            return None
         
         def set_gui(self, gui):
             self.gui = gui
@@ -195,36 +263,61 @@ class serial:
             self.LEDs[num-1] = "."
             self.gui.set_action(("LED", num, False))
 
+        # Called on every read and write, but only does anything when
+        # _schedule_background() says something is due
         def do_background_processes(self):
+            now = sim_clock.time()
+            if now < self.next_background_time:
+                return
             self.do_timers()
             self.do_keys()
             self.iw.do_delayed_LEDs()
+            self._schedule_background(now)
+
+        # The next time there's background work: the timer, a held key's
+        # release, or with a keyboard or GUI to read (and LEDs to print)
+        # the next BACKGROUND_INTERVAL. sim_clock is told, so on the
+        # virtual clock a wait for the port goes straight there.
+        def _schedule_background(self, now):
+            next_time = self.target_time
+            if self.key_delayed is not None:
+                next_time = min(next_time, self.key_delayed[0])
+            if not HEADLESS_SIMULATOR:
+                next_time = min(next_time, now + BACKGROUND_INTERVAL)
+            self.next_background_time = next_time
+            if next_time != self.wake_time:
+                self.wake_time = next_time
+                sim_clock.wake_at(next_time)
             
         def do_timers(self):
-            if time.time() > self.target_time:
+            if EMULATOR_TIME_LIMIT is not None and sim_clock.time() - self.start_time > EMULATOR_TIME_LIMIT:
+                print("*** TIME LIMIT ***")
+                self.timed_out = True
+                sys.exit(1)
+            if sim_clock.time() >= self.target_time:
                 self.timer_state += 1
                 if self.timer_state == 1:
-                    self.target_time = time.time() + 0.1
+                    self.target_time = sim_clock.time() + 0.1
                 elif self.timer_state == 2:
                     if AUTOMATIC_KEYS: 
                         self._wrdata(b"\x38")    # A press
-                    self.target_time = time.time() + 0.25    # quick press
+                    self.target_time = sim_clock.time() + 0.25    # quick press
                 elif self.timer_state == 3:
                     if AUTOMATIC_KEYS: 
                         self._wrdata(b"\x30")    # A release
-                    self.target_time = time.time() + 1
+                    self.target_time = sim_clock.time() + 1
                 elif self.timer_state == 4:
                     if AUTOMATIC_KEYS: 
                         self._wrdata(b"\x39")    # B press
-                    self.target_time = time.time() + 2  # hold
+                    self.target_time = sim_clock.time() + 2  # hold
                 elif self.timer_state == 5:
                     if AUTOMATIC_KEYS: 
                         self._wrdata(b"\x31")    # B release
-                    self.target_time = time.time() + 1
+                    self.target_time = sim_clock.time() + 1
                 else:
                     self._wrdata(0x10+(EMULATOR_BATTERY_ADC>>8))
                     self._wrdata(EMULATOR_BATTERY_ADC & 0xFF)
-                    self.target_time = time.time() + 0.3
+                    self.target_time = sim_clock.time() + 0.3
                     # test for EV Speed sample
                     #self._wrdata(0x22)
                     #self._wrdata(0x02)
@@ -233,7 +326,7 @@ class serial:
         def do_keys(self):
             if self.key_delayed is not None:
                 (end_time, data) = self.key_delayed
-                if time.time() > end_time:
+                if sim_clock.time() >= end_time:
                     self._wrdata(data)
                     self.key_delayed = None
                 return
@@ -248,10 +341,10 @@ class serial:
                     self._wrdata(b"\x31")    # B release
                 elif key == 'A':
                     self._wrdata(b"\x38")    # A press
-                    self.key_delayed = (time.time()+2, b"\x30")
+                    self.key_delayed = (sim_clock.time()+2, b"\x30")
                 elif key == "B":
                     self._wrdata(b"\x39")    # B press
-                    self.key_delayed = (time.time()+2, b"\x31")
+                    self.key_delayed = (sim_clock.time()+2, b"\x31")
                 elif key == "<":
                     lleprint("*** Mouse a bit left")
                     self.shift_left()
@@ -282,149 +375,193 @@ class serial:
                     lleprint("***??? Didn't understand", key)
     
         def inWaiting(self):
-            self.do_background_processes()
-            return len(self.replies)
+            with self.lock:
+                self._release_timed_replies()
+                self.do_background_processes()
+                return len(self.replies)
         
+        # data is a byte value, or bytes
         def _wrdata(self, data):
             if type(data) is int:
                 if data > 255 or data < 0:
                     print("Expected byte value - breakpoint in _wrdata()")
                     sys.exit(1)
-                data = bytes([data])
-            elif len(data) != 1:
-                print("Expected length 1 string - fix in _wrdata() by splitting")
-                sys.exit(1)
-            if type(data) != bytes:
-                raise("Return data not bytes!!")
-            self.replies.append(data)
+                self.replies.append(data)
+            else:
+                self.replies += data
         
         def _wrdata_int16(self, data):
-            self._wrdata(data>>8)
-            self._wrdata(data&255)
-            
-        def _paramcheck(self, cmdv, params, num_params):
-            if len(params) != num_params:
-                print("Command", hex(cmdv), "had", len(params), "parameters, not", num_params)
-                sys.exit(1)
-                
-        def _process_cmd(self, cmdv, params):
-
-            if cmdv == 0x20 or cmdv == 0x21:
-                self._paramcheck(cmdv, params, 1)
-                LEDmask = params[0]
-                #LEDmask = ord(params[0])
-                if cmdv == 0x21: LEDmask += 512
-                lleprint("***ALL LEDS:", hex(LEDmask))
-                for n in range(1,10):
-                    if LEDmask&1:
-                        self.set_LED(n)
-                    else:
-                        self.clear_LED(n)
-                    LEDmask >>= 1
-                
-            elif cmdv >= 0x10 and cmdv <= 0x19:
-                LEDnum = cmdv&0x0F
-                #lleprint("*** LED", LEDnum, "on")
-                self.set_LED(LEDnum)
-                self.show_LEDs()
-            elif cmdv >= 0x00 and cmdv <= 0x09:
-                LEDnum = cmdv&0x0F
-                #lleprint("*** LED", LEDnum, "off")
-                self.clear_LED(LEDnum)
-                self.show_LEDs()
-            elif cmdv == 0x80:
-                self._paramcheck(cmdv, params, 0)
-                self._wrdata(cmdv)
-                
-            elif cmdv == 0x98:
-                self._paramcheck(cmdv, params, 0)
-                
-                if self.IR == False:
-                    print("Scanning IR not on - QUITTING")
-                    sys.exit(1)
+            self.replies += bytes((data >> 8, data & 255))
+
+        # send data at time t (on the sim_clock)
+        def _wrdata_at(self, t, data):
+            heapq.heappush(self.timed_replies, (t, self.timed_reply_count, data))
+            self.timed_reply_count += 1
+            # so a wait for the port on the virtual clock ends then
+            sim_clock.wake_at(t)
+
+        def _release_timed_replies(self):
+            if self.timed_replies and self.timed_replies[0][0] <= sim_clock.time():
+                now = sim_clock.time()
+                while self.timed_replies and self.timed_replies[0][0] <= now:
+                    self.replies += heapq.heappop(self.timed_replies)[2]
+
+        # Send EV_FINISHED_MOVE when a move of distance steps (forward or a
+        # turn) would finish on the mouse, with speed samples on the way if
+        # they are turned on. The position changes straight away. Like
+        # timer_move() in main.c, a new move replaces one that hasn't
+        # finished, and only the new one sends EV_FINISHED_MOVE.
+        def _finish_move(self, distance):
+            if not EMULATE_MOVE_TIMES:
+                self._wrdata(0x20)
+                return
 
-                # bit 0 = front long
-                # bit 1 = front short
-                # bit 2 = left side
-                # bit 3 = right side
-                value = 0x40
-                if self.maze.get_front_wall(self.heading, self.row, self.column):
-                    value += 3
-                    lleprint("***       ___")
-                else:
-                    nrow = self.row
-                    ncolumn = self.column
-                    if self.heading == 0:
-                        nrow += 1
-                    elif self.heading == 1:
-                        ncolumn += 1
-                    elif self.heading == 2:
-                        nrow -= 1
-                    else:
-                        ncolumn -= 1
-
-                    next_cell = self.maze.get_front_wall(self.heading, nrow, ncolumn)
-                    if next_cell == None or next_cell:
-                        value += 1
-                if self.maze.get_left_wall(self.heading, self.row, self.column):
-                    value += 0x04
-                    lleprint("***       |", end="")
-                else:
-                    lleprint("***        ", end="")
-                if self.maze.get_right_wall(self.heading, self.row, self.column):
-                    value += 0x08
-                    lleprint("  |")
-                else:
-                    lleprint(" ")
-                
-                #lleprint("*** value", value & 0x0f)
+            key = (distance, self.speed)
+            if key not in self.move_profiles:
+                self.move_profiles[key] = move_profile(distance, self.speed, self.accel_table)
+            step_times, step_speeds = self.move_profiles[key]
+            duration = step_times[-1] if step_times else 0.0
+            start = sim_clock.time()
+            if self.move_end_time > start:
+                # drop the rest of the old move, its 0x20 and speed samples
+                self.move_time -= self.move_end_time - start
+                self.timed_replies = []
+            self.move_end_time = start + duration
+            self.move_time += duration
+
+            if self.speed_samples and step_times:
+                # the sample timer runs all the time, not from the move start
+                t = SPEED_SAMPLE_INTERVAL - (start - self.start_time) % SPEED_SAMPLE_INTERVAL
+                while t < duration:
+                    index = step_speeds[min(bisect_left(step_times, t), len(step_speeds)-1)]
+                    # both motors at the same speed. The event has the top
+                    # bit of each in the command, as main.c does it (> 256)
+                    self._wrdata_at(start + t, bytes((0x22 + (index > 256) + 2*(index > 256),
+                                                      index & 0xFF, index & 0xFF)))
+                    t += SPEED_SAMPLE_INTERVAL
+            self._wrdata_at(self.move_end_time, b"\x20")
                 
-                self._wrdata(value)
-            
-            elif cmdv == 0x9A: # front
-                self._paramcheck(cmdv, params, 0)
-                self._wrdata(b"\x61")
-                self._wrdata(self.front>>8)
-                self._wrdata(self.front&255)
-
-            elif cmdv == 0x9B: # l90
-                self._paramcheck(cmdv, params, 0)
-                self._wrdata(b"\x62")
-                self._wrdata(self.ls>>8)
-                self._wrdata(self.ls&255)
-            
-            elif cmdv == 0x9C: # l45
-                self._paramcheck(cmdv, params, 0)
-                self._wrdata(b"\x63")
-                self._wrdata(self.l45>>8)
-                self._wrdata(self.l45&255)
-            
-            elif cmdv == 0x9D: # r90
-                self._paramcheck(cmdv, params, 0)
-                self._wrdata(b"\x64")
-                self._wrdata(self.rs>>8)
-                self._wrdata(self.rs&255)
+        # IR front/side state bitmap, from the maze
+        def _front_side_state(self):
+            # bit 0 = front long
+            # bit 1 = front short
+            # bit 2 = left side
+            # bit 3 = right side
+            value = 0
+            if self.maze.get_front_wall(self.heading, self.row, self.column):
+                value += 3
+                lleprint("***       ___")
+            else:
+                nrow = self.row
+                ncolumn = self.column
+                if self.heading == 0:
+                    nrow += 1
+                elif self.heading == 1:
+                    ncolumn += 1
+                elif self.heading == 2:
+                    nrow -= 1
+                else:
+                    ncolumn -= 1
+
+                next_cell = self.maze.get_front_wall(self.heading, nrow, ncolumn)
+                if next_cell == None or next_cell:
+                    value += 1
+            if self.maze.get_left_wall(self.heading, self.row, self.column):
+                value += 0x04
+                lleprint("***       |", end="")
+            else:
+                lleprint("***        ", end="")
+            if self.maze.get_right_wall(self.heading, self.row, self.column):
+                value += 0x08
+                lleprint("  |")
+            else:
+                lleprint(" ")
             
-            elif cmdv == 0x9E: # r45
-                self._paramcheck(cmdv, params, 0)
-                self._wrdata(b"\x65")
-                self._wrdata(self.r45>>8)
-                self._wrdata(self.r45&255)
+            #lleprint("*** value", value & 0x0f)
+            return value
+
+        #
+        # Command handlers, called with the command byte and the parameter
+        # bytes (already checked against the length in command_handlers).
+        # Every command gets an EF (instruction acknowledge) afterwards.
+        #
+        def _cmd_all_LEDs(self, cmdv, params):
+            LEDmask = params[0]
+            if cmdv == 0x21: LEDmask += 512
+            lleprint("***ALL LEDS:", hex(LEDmask))
+            for n in range(1,10):
+                if LEDmask&1:
+                    self.set_LED(n)
+                else:
+                    self.clear_LED(n)
+                LEDmask >>= 1
+
+        def _cmd_LED_on(self, cmdv, params):
+            LEDnum = cmdv&0x0F
+            #lleprint("*** LED", LEDnum, "on")
+            self.set_LED(LEDnum)
+            self.show_LEDs()
+
+        def _cmd_LED_off(self, cmdv, params):
+            LEDnum = cmdv&0x0F
+            #lleprint("*** LED", LEDnum, "off")
+            self.clear_LED(LEDnum)
+            self.show_LEDs()
+
+        def _cmd_poll(self, cmdv, params):
+            self._wrdata(cmdv)
+
+        def _cmd_wall_info(self, cmdv, params):
+            if self.IR == False:
+                print("Scanning IR not on - QUITTING")
+                sys.exit(1)
+
+            self._wrdata(0x40 + self._front_side_state())
+
+        def _cmd_all_sensor_state(self, cmdv, params):
+            self._wrdata(0x60)
+            self._wrdata(self._front_side_state())
+            # there's no model of the 45 sensors, so use the side walls
+            state_45 = 0
+            if self.maze.get_left_wall(self.heading, self.row, self.column):
+                state_45 += 1
+            if self.maze.get_right_wall(self.heading, self.row, self.column):
+                state_45 += 2
+            self._wrdata(state_45)
+            for level in (self.front, self.ls, self.l45, self.rs, self.r45):
+                self._wrdata_int16(level)
+
+        # command: (reply event, attribute with the level)
+        IR_level_replies = {
+            0x9A: (0x61, "front"),
+            0x9B: (0x62, "ls"),     # l90
+            0x9C: (0x63, "l45"),
+            0x9D: (0x64, "rs"),     # r90
+            0x9E: (0x65, "r45"),
+        }
+
+        def _cmd_IR_level(self, cmdv, params):
+            event, attribute = self.IR_level_replies[cmdv]
+            self._wrdata(event)
+            self._wrdata_int16(getattr(self, attribute))
+
+        def _cmd_stop_motors(self, cmdv, params):
+            lleprint("***STOP MOTORS")
+
+        def _cmd_forward(self, cmdv, params):
+            distance_value = params[0] * 256 + params[1]
+            lleprint("***FORWARD!", distance_value)
             
-            elif cmdv == 0xC0:
-                self._paramcheck(cmdv, params, 0)
-                lleprint("***STOP MOTORS")
-
-            elif cmdv == 0xC1:
-                self._paramcheck(cmdv, params, 2)
-                distance_value = params[0] * 256 + params[1]
-                lleprint("***FORWARD!", distance_value)
-                
-                if PAUSE_ON_MOVE:
-                    time.sleep(0.5)
+            if PAUSE_ON_MOVE:
+                sim_clock.sleep(0.5)
 
+            # nearest whole number of cells, at least one
+            cells = max(1, (distance_value + self.cell_distance // 2) // self.cell_distance)
+            self.moves += 1
+            for _ in range(cells):
                 if self.maze.get_front_wall(self.heading, self.row, self.column):
                     print("*** CRASHED ***!")
+                    self.crashed = True
                     sys.exit(1)
                     
                 if self.heading == 0:
@@ -435,198 +572,193 @@ class serial:
                     self.row -= 1
                 else:
                     self.column -= 1
-                
-                lleprint("***Position (%d, %d) Heading %d" % (self.row, self.column, self.heading))
-                self._wrdata(b"\x20")
-
-            elif cmdv == 0xC2: # right
-                self._paramcheck(cmdv, params, 2)
-                distance_value = params[0] * 256 + params[1]
-                if distance_value > 180:
-                    lleprint("***U-TURN!", distance_value)
-                    self.heading = 3 & (self.heading + 2)
-                else:
-                    lleprint("***RIGHT!", distance_value)
-                    self.heading = 3 & (self.heading + 1)
- 
-                if PAUSE_ON_MOVE:
-                    time.sleep(0.5)
-               
-                lleprint("***Position (%d, %d) Heading %d" % (self.row, self.column, self.heading))
-                self._wrdata(b"\x20")
-
-            elif cmdv == 0xC3: # left
-                self._paramcheck(cmdv, params, 2)
-                distance_value = params[0] * 256 + params[1]
-                if distance_value > 180:
-                    lleprint("***U-TURN!", distance_value)
-                    self.heading = 3 & (self.heading + 2)
-                else:
-                    lleprint("***LEFT!", distance_value)
-                    self.heading = 3 & (self.heading - 1)
-
-                if PAUSE_ON_MOVE:
-                    time.sleep(0.5)
+                self.cells_visited.add((self.row, self.column))
+            
+            lleprint("***Position (%d, %d) Heading %d" % (self.row, self.column, self.heading))
+            self._finish_move(distance_value)
+
+        def _cmd_right(self, cmdv, params):
+            distance_value = params[0] * 256 + params[1]
+            self.moves += 1
+            self.turns += 1
+            # a 90 degree turn is about a third of a cell, 180 about two thirds
+            if distance_value > self.cell_distance // 2:
+                lleprint("***U-TURN!", distance_value)
+                self.heading = 3 & (self.heading + 2)
+            else:
+                lleprint("***RIGHT!", distance_value)
+                self.heading = 3 & (self.heading + 1)
+
+            if PAUSE_ON_MOVE:
+                sim_clock.sleep(0.5)
+           
+            lleprint("***Position (%d, %d) Heading %d" % (self.row, self.column, self.heading))
+            self._finish_move(distance_value)
+
+        def _cmd_left(self, cmdv, params):
+            distance_value = params[0] * 256 + params[1]
+            self.moves += 1
+            self.turns += 1
+            if distance_value > self.cell_distance // 2:
+                lleprint("***U-TURN!", distance_value)
+                self.heading = 3 & (self.heading + 2)
+            else:
+                lleprint("***LEFT!", distance_value)
+                self.heading = 3 & (self.heading - 1)
 
-                lleprint("***Position (%d, %d) Heading %d" % (self.row, self.column, self.heading))
+            if PAUSE_ON_MOVE:
+                sim_clock.sleep(0.5)
 
-                self._wrdata(b"\x20")
-                
-            elif cmdv == 0xC4:
-                self._paramcheck(cmdv, params, 2)
-                lleprint("***Set speed to", params[0] * 256 + params[1])
+            lleprint("***Position (%d, %d) Heading %d" % (self.row, self.column, self.heading))
+            self._finish_move(distance_value)
             
-            elif cmdv == 0xC5:
-                self._paramcheck(cmdv, params, 2)
-                self.steering_correction = params[0] * 256 + params[1]
-                lleprint("***Set Steering correction to", self.steering_correction)
-
-            elif cmdv == 0xC6:
-                self._paramcheck(cmdv, params, 0)
-                lleprint("***Extend Movement!")
-                
-            elif cmdv == 0xC7:
-                self._paramcheck(cmdv, params, 2)
-                self.cell_distance = params[0] * 256 + params[1]
-                lleprint("***Set Cell distance to", self.cell_distance)
-
-            elif cmdv == 0xC8:
-                self._paramcheck(cmdv, params, 2)
-                self.wall_correction = params[0] * 256 + params[1]
-                lleprint("***Set Wall edge correction to", self.wall_correction)
-
-            elif cmdv == 0xC9:
-                self._paramcheck(cmdv, params, 2)
-                self.distance_to_test = params[0] * 256 + params[1]
-                lleprint("***Set distance test to", self.distance_to_test)
-                lleprint("*** >>>>Not complete yet! <<<<")
-
-            elif cmdv == 0xCF:
-                self._paramcheck(cmdv, params, 1)
-                subcmd = params[0]
-                self._wrdata(cmdv)
-                self._wrdata(params[0])
-                if subcmd == 0xC5:
-                    self._wrdata_int16(self.steering_correction)
-                elif subcmd == 0xC7:
-                    self._wrdata_int16(self.cell_distance)
-                elif subcmd == 0xC8:
-                    self._wrdata_int16(self.wall_correction)
-                elif subcmd == 0xC9:
-                    self._wrdata_int16(self.distance_to_test)
-                
-            elif cmdv == 0xD0:
-                self._paramcheck(cmdv, params, 0)
-                lleprint("*** TURN OFF IR***")
-                self.IR = False
-
-            elif cmdv == 0xD1:
-                self._paramcheck(cmdv, params, 0)
-                lleprint("*** TURN ON IR***")
-                self.IR = True
-
-            elif cmdv == 0xD8:
-                self._paramcheck(cmdv, params, 2)
-                self.front_long = params[0] * 256 + params[1]
-                lleprint("***Set front long to", self.front_long)
-
-            elif cmdv == 0xD9:
-                self._paramcheck(cmdv, params, 2)
-                self.front_short = params[0] * 256 + params[1]
-                lleprint("***Set front short to", self.front_short)
-
-            elif cmdv == 0xDA:
-                self._paramcheck(cmdv, params, 2)
-                self.left_side = params[0] * 256 + params[1]
-                lleprint("***Set left side to", self.left_side)
-
-            elif cmdv == 0xDB:
-                self._paramcheck(cmdv, params, 2)
-                self.right_side = params[0] * 256 + params[1]
-                lleprint("***Set right side to", self.right_side)
-
-            elif cmdv == 0xDC:
-                self._paramcheck(cmdv, params, 2)
-                self.left_45 = params[0] * 256 + params[1]
-                lleprint("***Set left 45 to", self.left_45)
-
-            elif cmdv == 0xDD:
-                self._paramcheck(cmdv, params, 2)
-                self.right_45 = params[0] * 256 + params[1]
-                lleprint("***Set right 45 to", self.right_45)
-
-            elif cmdv == 0xDE:
-                self._paramcheck(cmdv, params, 2)
-                self.r45_close = params[0] * 256 + params[1]
-                lleprint("***Set r45 close to", self.r45_close)
-
-            elif cmdv == 0xDF:
-                self._paramcheck(cmdv, params, 2)
-                self.l45_close = params[0] * 256 + params[1]
-                lleprint("***Set l45 close to", self.l45_close)
+        def _cmd_set_speed(self, cmdv, params):
+            self.speed = params[0] * 256 + params[1]
+            lleprint("***Set speed to", self.speed)
+
+        def _cmd_extend_movement(self, cmdv, params):
+            lleprint("***Extend Movement!")
+
+        # command: (attribute, description) for the commands that just
+        # set a 16 bit value. The 0xCF reply reads some of them back.
+        value_commands = {
+            0xC5: ("steering_correction", "Set Steering correction to"),
+            0xC7: ("cell_distance", "Set Cell distance to"),
+            0xC8: ("wall_correction", "Set Wall edge correction to"),
+            0xC9: ("distance_to_test", "Set distance test to"),
+            0xD8: ("front_long", "Set front long to"),
+            0xD9: ("front_short", "Set front short to"),
+            0xDA: ("left_side", "Set left side to"),
+            0xDB: ("right_side", "Set right side to"),
+            0xDC: ("left_45", "Set left 45 to"),
+            0xDD: ("right_45", "Set right 45 to"),
+            0xDE: ("r45_close", "Set r45 close to"),
+            0xDF: ("l45_close", "Set l45 close to"),
+        }
+
+        def _cmd_set_value(self, cmdv, params):
+            attribute, description = self.value_commands[cmdv]
+            value = params[0] * 256 + params[1]
+            setattr(self, attribute, value)
+            lleprint("***" + description, value)
+
+        def _cmd_set_distance_to_test(self, cmdv, params):
+            self._cmd_set_value(cmdv, params)
+            lleprint("*** >>>>Not complete yet! <<<<")
+
+        def _cmd_read_value(self, cmdv, params):
+            subcmd = params[0]
+            self._wrdata(cmdv)
+            self._wrdata(subcmd)
+            if subcmd in (0xC5, 0xC7, 0xC8, 0xC9):
+                self._wrdata_int16(getattr(self, self.value_commands[subcmd][0]))
+
+        def _cmd_IR_off(self, cmdv, params):
+            lleprint("*** TURN OFF IR***")
+            self.IR = False
 
-                
-            elif cmdv == 0xf9:
-                # write to acceleration table
-                self._paramcheck(cmdv, params, 3)
-                addr = params[0]
-                data = params[1]*256+params[2]
-                self.accel_table[addr] = data
-                self._wrdata(b"\xCE")
-                self._wrdata_int16(self.accel_table[addr])
-
-            elif cmdv == 0xfA:
-                # write to acceleration table
-                self._paramcheck(cmdv, params, 3)
-                addr = params[0]+256
-                data = params[1]*256+params[2]
-                self.accel_table[addr] = data
-                self._wrdata(b"\xCE")
-                self._wrdata_int16(self.accel_table[addr])
-                
-            elif cmdv == 0xfe:
-                self._paramcheck(cmdv, params, 3)
-                if params != b"\xfc\xf8\xfe":
-                    print("Unexpected unlock")
-                    print("EXITING")
-                    sys.exit(1)
-                if self.locked:
-                    self._wrdata(b"\xC0")
-                else:
-                    self._wrdata(b"\xC1")
-                    
-            else:
-                print("Unknown command", hex(cmdv))
+        def _cmd_IR_on(self, cmdv, params):
+            lleprint("*** TURN ON IR***")
+            self.IR = True
+
+        def _cmd_write_acceleration(self, cmdv, params):
+            # 0xF9 is the first 256 entries, 0xFA the second
+            addr = params[0]
+            if cmdv == 0xFA:
+                addr += 256
+            self.accel_table[addr] = params[1]*256+params[2]
+            self.move_profiles.clear()
+            self._wrdata(0xCE)
+            self._wrdata_int16(self.accel_table[addr])
+            
+        def _cmd_unlock(self, cmdv, params):
+            if params != b"\xfc\xf8\xfe":
+                print("Unexpected unlock")
                 print("EXITING")
                 sys.exit(1)
-            self._wrdata(b"\xEF")
-            
-            self.do_background_processes()
-            
+            if self.locked:
+                self._wrdata(0xC0)
+            else:
+                self._wrdata(0xC1)
+
+        def _cmd_switch_options(self, cmdv, params):
+            # only the speed samples are emulated, not the ticks per motor
+            # (F0/F1) or trim (F2/F3) reports
+            if cmdv == 0xF4:
+                self.speed_samples = False
+            elif cmdv == 0xF5:
+                self.speed_samples = True
+
+        # command byte: (handler, number of parameter bytes or None to
+        # not check)
+        command_handlers = {
+            0x20: (_cmd_all_LEDs, 1),
+            0x21: (_cmd_all_LEDs, 1),
+            0x80: (_cmd_poll, 0),
+            0x90: (_cmd_all_sensor_state, 0),
+            0x98: (_cmd_wall_info, 0),
+            0xC0: (_cmd_stop_motors, 0),
+            0xC1: (_cmd_forward, 2),
+            0xC2: (_cmd_right, 2),
+            0xC3: (_cmd_left, 2),
+            0xC4: (_cmd_set_speed, 2),
+            0xC6: (_cmd_extend_movement, 0),
+            0xC9: (_cmd_set_distance_to_test, 2),
+            0xCF: (_cmd_read_value, 1),
+            0xD0: (_cmd_IR_off, 0),
+            0xD1: (_cmd_IR_on, 0),
+            0xF9: (_cmd_write_acceleration, 3),
+            0xFA: (_cmd_write_acceleration, 3),
+            0xFE: (_cmd_unlock, 3),
+        }
+        for _cmd in range(0xF0, 0xF6):
+            command_handlers[_cmd] = (_cmd_switch_options, 0)
+        for _cmd in range(0x00, 0x0A):
+            command_handlers[_cmd] = (_cmd_LED_off, None)
+        for _cmd in range(0x10, 0x1A):
+            command_handlers[_cmd] = (_cmd_LED_on, None)
+        for _cmd in IR_level_replies:
+            command_handlers[_cmd] = (_cmd_IR_level, 0)
+        for _cmd in value_commands:
+            command_handlers.setdefault(_cmd, (_cmd_set_value, 2))
+        del _cmd
+
         def write(self, data):
+            with self.lock:
+                self._write(data)
+
+        def _write(self, data):
             if type(data) != bytes and type(data) != bytearray:
-                raise("Outgoing data not bytes or bytearray!! in write() in low_level_emulator")
+                print("Outgoing data not bytes or bytearray!! in write() in low_level_emulator")
+                sys.exit(1)
 
+            self.bytes_written += len(data)
+            self._release_timed_replies()
             cmdv = data[0]
-            # originally fix for Python 2
-            if type(cmdv) is str:
-                cmdv = ord(cmdv)
-                print("Unexpected string in write")
-                sys.exit(2)
-            self._process_cmd(cmdv, data[1:])
+            if cmdv not in self.command_handlers:
+                print("Unknown command", hex(cmdv))
+                print("EXITING")
+                sys.exit(1)
+            handler, num_params = self.command_handlers[cmdv]
+            params = data[1:]
+            if num_params is not None and len(params) != num_params:
+                print("Command", hex(cmdv), "had", len(params), "parameters, not", num_params)
+                sys.exit(1)
+            handler(self, cmdv, params)
+            self.replies.append(0xEF)
+
+            self.do_background_processes()
         
         def read(self, bytes_to_read):
+            with self.lock:
+                return self._read(bytes_to_read)
+
+        # Like the real port with a zero timeout - returns what's there, up
+        # to bytes_to_read
+        def _read(self, bytes_to_read):
+            self._release_timed_replies()
             self.do_background_processes()
-            if bytes_to_read != 1:
-                print("bytes to read != 1")
-                sys.exit(1)
-            if not self.replies:
-                return b""
-            else:
-                return_data = self.replies.popleft()
-                if type(return_data) != bytes and type(return_data) != bytearray:
-                    print("Unexpected data in read() in low_level_emulator")
-                    sys.exit(1)
-                return return_data
-            
-            
\ No newline at end of file
+            data = bytes(self.replies[:bytes_to_read])
+            del self.replies[:bytes_to_read]
+            self.bytes_read += len(data)
+            return data
@@ -21,6 +21,9 @@
 from __future__ import print_function
 
 import sys
+import heapq
+from array import array
+from collections import OrderedDict
 assert sys.version_info >= (3,0)
 
 class MazeFailedToRead(Exception):
@@ -37,12 +40,41 @@ ANSI_HOME_CURSOR = "\x1b[H"
 class Maze(object):
     
     # value of cell data if we can't get to it
-    UNREACHED = 9999     
+    UNREACHED = 9999
+    # value of weighted cell data if we can't get to it
+    UNREACHED_TIME = float("inf")
+
+    # The maze is stored as flat arrays, one entry per cell, indexed by
+    # row * size + column (see cell_index()). This keeps a 32x32 maze down
+    # to a few kilobytes and avoids the double list lookup per access.
+    #
+    # wall_data has one byte per cell with a bit per heading:
+    #    bit 0 = north, bit 1 = east, bit 2 = south, bit 3 = west
+    # Each internal wall is stored in both of the cells it is between.
+    NORTH_WALL = 1
+    EAST_WALL = 2
+    SOUTH_WALL = 4
+    WEST_WALL = 8
+
+    # number of distance maps flood_fill_all() keeps, least recently used
+    # are thrown away first
+    DISTANCE_CACHE_SIZE = 8
 
     def __init__(self, size_of_maze, standard_target = False, init_start_wall = True):
         # need to tell engine where to head for before flood works!
         self.targets = []
         self.size = size_of_maze
+        # index offset to the next cell for each heading
+        self.heading_offsets = (size_of_maze, 1, -size_of_maze, -1)
+
+        # Distance maps are cached by target set and wall revision, where the
+        # revision goes up every time a wall changes. So going back to a
+        # set of targets we flooded before, with no new walls, is a lookup.
+        self.wall_revision = 0
+        self._last_wall_revision = 0
+        self.distance_cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
         
         if standard_target:
             self.target_normal_end_cells()
@@ -52,15 +84,20 @@ class Maze(object):
         if init_start_wall:
             self.set_right_wall(0, 0, 0)
 
-    def target_normal_end_cells(self):
-        self.clear_targets()
+    def cell_index(self, row, column):
+        return row * self.size + column
+
+    def normal_end_cells(self):
         if self.size == 5:
-            self.set_target_cell(4, 4)
+            return [(4, 4)]
         elif self.size == 16:
-            self.set_target_cell(7, 7)
-            self.set_target_cell(7, 8)
-            self.set_target_cell(8, 7)
-            self.set_target_cell(8, 8)
+            return [(7, 7), (7, 8), (8, 7), (8, 8)]
+        return []
+
+    def target_normal_end_cells(self):
+        self.clear_targets()
+        for row, column in self.normal_end_cells():
+            self.set_target_cell(row, column)
     
     def target_start_cell(self):
         self.clear_targets()
@@ -69,94 +106,52 @@ class Maze(object):
     def _apply_targets(self):
         for target in self.targets:
             row, column = target
-            self.maze_cell_data[row][column] = 0
+            self.cell_data[row * self.size + column] = 0
 
-    def clear_north_south_maze_wall_data(self):
+    def clear_wall_data(self):
         size = self.size
-        self.NS_wall_data = []
+        self.wall_data = bytearray(size * size)
+        self._new_wall_revision()
         
-        # row 0
-        line = []
-        # for each column
-        for _ in range(0, size):
-            line.append(1)
-        self.NS_wall_data.append(line)
-
-        # row 1 to max
-        # for each row
-        for _ in range(1, size):
-            line = []
-            # and each column
-            for _ in range(0,size):
-                line.append(0)
-            
-            self.NS_wall_data.append(line)
-
-        # last line, size+1
-        line = []
-        # column
-        for _ in range(0, size):
-                line.append(1)
-        self.NS_wall_data.append(line)
-
-    def clear_east_west_maze_wall_data(self):
-        size = self.size
-        self.EW_wall_data = []
-        
-        # row 1 to max
-        for _ in range(0, size):
-            line = []
-            for column in range(0,size+1):
-                if column == 0 or column == size:
-                    line.append(1)
-                else:
-                    line.append(0)
-            
-            self.EW_wall_data.append(line)
+        # outside walls
+        for column in range(size):
+            self.wall_data[column] |= self.SOUTH_WALL
+            self.wall_data[(size-1) * size + column] |= self.NORTH_WALL
+        for row in range(size):
+            self.wall_data[row * size] |= self.WEST_WALL
+            self.wall_data[row * size + size-1] |= self.EAST_WALL
 
+        # Same layout as wall_data, but a bit is set once we know if that
+        # wall is there or not. Unknown walls are treated as open by the
+        # normal flood fills. The outside walls are always known.
+        self.known_data = bytearray(self.wall_data)
 
     def clear_maze_cell_data(self):
-        size = self.size
-        self.maze_cell_data = []
-        
-        # for each row
-        for _ in range(0, size):
-            #line = []
-            line = [self.UNREACHED]*size
-            
-            # for each column
-            #for _ in range(0,size):
-            #    line.append(self.UNREACHED)            # big enough for 32x32 maze would be 1024 cells!
-            
-            self.maze_cell_data.append(line)
+        # big enough for 32x32 maze would be 1024 cells!
+        self.cell_data = array('H', [self.UNREACHED]) * (self.size * self.size)
         self._apply_targets()
 
-
     def clear_marks(self):
-        self.marks = []
-        size = self.size
-        for _ in range(size):
-            line = [False]*size
-            self.marks.append(line)
+        self.mark_data = bytearray(self.size * self.size)
         
     def set_mark(self, row, column):
-        self.marks[row][column] = True
+        self.mark_data[row * self.size + column] = 1
         
-    def clear_maze_data(self):
-        self.clear_north_south_maze_wall_data()
-        self.clear_east_west_maze_wall_data()
-
-        self.explored = []
-        size = self.size
-        for _ in range(size):
-            line = [False]*size
-            self.explored.append(line)
+    def is_marked(self, row, column):
+        return self.mark_data[row * self.size + column] != 0
 
+    def clear_maze_data(self):
+        self.clear_wall_data()
+        self.clear_maze_cell_data()
+        self.explored_data = bytearray(self.size * self.size)
         self.clear_marks()
         
     def set_explored(self, row, column):
-        self.explored[row][column] = True
+        self.explored_data[row * self.size + column] = 1
     
+    def is_explored(self, row, column):
+        return self.explored_data[row * self.size + column] != 0
+
     def print_maze(self):
         #print("Start cell is bottom left")
         if PRINT_MAP_USES_HOME_CURSOR:
@@ -168,7 +163,7 @@ class Maze(object):
             # line above
             line_str = []
             for column in range(0, self.size):
-                if self.NS_wall_data[line+1][column]:
+                if self.get_front_wall(0, line, column):
                     line_str.append("+----")
                 else:
                     line_str.append("+    ")
@@ -178,24 +173,25 @@ class Maze(object):
             # wall line
             line_str = []
             for column in range(0, self.size):
-                if self.EW_wall_data[line][column]:
+                if self.get_front_wall(3, line, column):
                     line_str.append("|")
                 else:
                     line_str.append(" ")
 
-                if self.marks[line][column]:
-                    if self.explored[line][column]:
-                        line_str.append("@%3s" % self.maze_cell_data[line][column])
+                index = self.cell_index(line, column)
+                if self.mark_data[index]:
+                    if self.explored_data[index]:
+                        line_str.append("@%3s" % self.cell_data[index])
                     else:
-                        line_str.append("x%3s" % self.maze_cell_data[line][column])
+                        line_str.append("x%3s" % self.cell_data[index])
                         
-                elif self.explored[line][column]:
-                    line_str.append(".%3s" % self.maze_cell_data[line][column])
+                elif self.explored_data[index]:
+                    line_str.append(".%3s" % self.cell_data[index])
                     
                 else:
-                    line_str.append("%4s" % self.maze_cell_data[line][column])
+                    line_str.append("%4s" % self.cell_data[index])
                 
-            if self.EW_wall_data[line][self.size]:
+            if self.get_front_wall(1, line, self.size-1):
                 line_str.append("|")
             else:
                 line_str.append("+")
@@ -204,7 +200,7 @@ class Maze(object):
         # line above
         line_str = []
         for column in range(0, self.size):
-            if self.NS_wall_data[0][column]:
+            if self.get_front_wall(2, 0, column):
                 line_str.append("+----")
             else:
                 line_str.append("+    ")
@@ -217,7 +213,7 @@ class Maze(object):
             # line above
             line_str = []
             for column in range(0, self.size):
-                if self.NS_wall_data[line+1][column]:
+                if self.get_front_wall(0, line, column):
                     line_str.append("+-")
                 else:
                     line_str.append("+ ")
@@ -227,12 +223,12 @@ class Maze(object):
             # wall line
             line_str = []
             for column in range(0, self.size):
-                if self.EW_wall_data[line][column]:
+                if self.get_front_wall(3, line, column):
                     line_str.append("| ")
                 else:
                     line_str.append("  ")
                 
-            if self.EW_wall_data[line][self.size]:
+            if self.get_front_wall(1, line, self.size-1):
                 line_str.append("|")
             else:
                 line_str.append("+")
@@ -241,7 +237,7 @@ class Maze(object):
         # line above
         line_str = []
         for column in range(0, self.size):
-            if self.NS_wall_data[0][column]:
+            if self.get_front_wall(2, 0, column):
                 line_str.append("+-")
             else:
                 line_str.append("+ ")
@@ -249,29 +245,32 @@ class Maze(object):
         print("".join(line_str))
         
     def print_stats(self):
-        print("Cell data lines =", len(self.maze_cell_data))
-        print("EW Wall lines =", len(self.EW_wall_data))
-        print("NS wall lines =", len(self.NS_wall_data))
-        print("Cell data rows =", len(self.maze_cell_data[0]))
-        print("EW Wall rows =", len(self.EW_wall_data[0]))
-        print("NS wall rows =", len(self.NS_wall_data[0]))
+        print("Cells =", len(self.cell_data))
+        print("Cell data bytes =", len(self.cell_data) * self.cell_data.itemsize)
+        print("Wall data bytes =", len(self.wall_data))
+        print("Explored data bytes =", len(self.explored_data))
+        print("Mark data bytes =", len(self.mark_data))
+        print("Distance cache hits =", self.cache_hits, "misses =", self.cache_misses)
     
     def flood_adjust_one_square(self, row, column):
+        index = row * self.size + column
+        cell_data = self.cell_data
+        walls = self.wall_data[index]
         cell = self.UNREACHED
         
-        if not self.NS_wall_data[row+1][column]:
-            cell = min(cell, self.maze_cell_data[row+1][column])
-        if not self.NS_wall_data[row][column]:
-            cell = min(cell, self.maze_cell_data[row-1][column])
+        if not walls & self.NORTH_WALL:
+            cell = min(cell, cell_data[index + self.size])
+        if not walls & self.SOUTH_WALL:
+            cell = min(cell, cell_data[index - self.size])
 
-        if not self.EW_wall_data[row][column+1]:
-            cell = min(cell, self.maze_cell_data[row][column+1])
-        if not self.EW_wall_data[row][column]:
-            cell = min(cell, self.maze_cell_data[row][column-1])
+        if not walls & self.EAST_WALL:
+            cell = min(cell, cell_data[index + 1])
+        if not walls & self.WEST_WALL:
+            cell = min(cell, cell_data[index - 1])
 
         cell += 1   # if we have to get to it from another cell, then it will be one higher
-        if cell < self.maze_cell_data[row][column]:
-            self.maze_cell_data[row][column] = cell
+        if cell < cell_data[index]:
+            cell_data[index] = cell
             return True
 
         return False
@@ -293,26 +292,311 @@ class Maze(object):
         return iterations
 
     def flood_fill_all(self):
-        self.clear_maze_cell_data()
-        cell_list = self.targets    # start from target
+        # copy, because flood_fill_incremental() changes cell_data in place
+        self.cell_data = array('H', self._cached_flood(self.targets))
+
+    # Distance map for the targets with the current walls, from the cache if
+    # we have it. The returned array belongs to the cache, don't change it.
+    def _cached_flood(self, targets):
+        key = (tuple(sorted(set(targets))), self.wall_revision)
+        cache = self.distance_cache
+        if key in cache:
+            self.cache_hits += 1
+            cache.move_to_end(key)
+            return cache[key]
+
+        self.cache_misses += 1
+        cell_data = self._flood(self.wall_data, targets)
+        self._cache_store(key, cell_data)
+        return cell_data
+
+    # Revisions are never reused, even after restore_state(), so a cached
+    # map can't be mistaken for one with different walls.
+    def _new_wall_revision(self):
+        self._last_wall_revision += 1
+        self.wall_revision = self._last_wall_revision
+
+    # Use cell data worked out elsewhere (e.g. by the speculative planner)
+    # for the current walls and targets, instead of a flood fill.
+    def use_cell_data(self, cell_data):
+        self.cell_data = array('H', cell_data)
+        key = (tuple(sorted(set(self.targets))), self.wall_revision)
+        self._cache_store(key, array('H', cell_data))
+
+    # Take a copy of the walls and distances, so we can try things out
+    # and put them back afterwards with restore_state().
+    def save_state(self):
+        return (bytearray(self.wall_data), bytearray(self.known_data),
+                array('H', self.cell_data), self.wall_revision,
+                OrderedDict(self.distance_cache))
+
+    def restore_state(self, state):
+        wall_data, known_data, cell_data, wall_revision, distance_cache = state
+        self.wall_data = bytearray(wall_data)
+        self.known_data = bytearray(known_data)
+        self.cell_data = array('H', cell_data)
+        self.wall_revision = wall_revision
+        self.distance_cache = OrderedDict(distance_cache)
+
+    def _cache_store(self, key, cell_data):
+        cache = self.distance_cache
+        cache[key] = cell_data
+        cache.move_to_end(key)
+        while len(cache) > self.DISTANCE_CACHE_SIZE:
+            cache.popitem(last=False)
+
+    # Flood fill from the targets using the given walls, returning new cell data
+    def _flood(self, wall_data, targets):
+        size = self.size
+        cell_data = array('H', [self.UNREACHED]) * (size * size)
+        # start from target. Every cell in a wave has the same value, so 
+        # this is _process_higher_surrounding_cells() inlined for speed.
+        cell_list = [self.cell_index(row, column) for row, column in targets]
+        for index in cell_list:
+            cell_data[index] = 0
+        current = 0
         while len(cell_list):
+            current += 1
             new_list = []
-            for cell in cell_list:
-                row, column = cell
-                new_list.extend(self._process_higher_surrounding_cells(row, column))
-            cell_list = []
-            for cell in new_list:
-                row, column = cell
-                cell_list.extend(self._process_higher_surrounding_cells(row, column))
-        
-#    def floor_fill_update_from_here(self, row, column):
-#        pass
-#
-#    def start_incremental_flood_fill_from_here(self, row, column):
-#        pass
-#
-#    def step_incremental_flood_fill_from_here(self):
-#        return True
+            append = new_list.append
+            for index in cell_list:
+                walls = wall_data[index]
+                if not walls & 1:
+                    next_index = index + size
+                    if cell_data[next_index] > current:
+                        cell_data[next_index] = current
+                        append(next_index)
+                if not walls & 2:
+                    next_index = index + 1
+                    if cell_data[next_index] > current:
+                        cell_data[next_index] = current
+                        append(next_index)
+                if not walls & 8:
+                    next_index = index - 1
+                    if cell_data[next_index] > current:
+                        cell_data[next_index] = current
+                        append(next_index)
+                if not walls & 4:
+                    next_index = index - size
+                    if cell_data[next_index] > current:
+                        cell_data[next_index] = current
+                        append(next_index)
+            cell_list = new_list
+
+        return cell_data
+
+    # Flood fill with all the walls we haven't seen yet closed. This doesn't
+    # change cell_data, the new cell data is returned.
+    def flood_fill_pessimistic(self, targets=None):
+        if targets is None:
+            targets = self.targets
+        closed_walls = bytearray(self.wall_data)
+        for index, known in enumerate(self.known_data):
+            closed_walls[index] |= ~known & 0x0F
+        return self._flood(closed_walls, targets)
+
+    # The normal flood fill assumes unknown walls are open, so it gives the
+    # shortest that the route could possibly be. Closing all the unknown
+    # walls gives the shortest route using only walls we know about. If they
+    # are the same length then the known route is the shortest.
+    def is_shortest_path_proven(self, row, column, targets=None):
+        if targets is None:
+            targets = self.targets
+        index = self.cell_index(row, column)
+        optimistic = self._cached_flood(targets)[index]
+        pessimistic = self.flood_fill_pessimistic(targets)[index]
+        return pessimistic != self.UNREACHED and optimistic == pessimistic
+
+    # Make every wall we don't know about a wall, so that routes only use
+    # known open cells (e.g. for a speed run once the shortest route is 
+    # proven). A flood fill is needed afterwards.
+    def close_unknown_walls(self):
+        for index, known in enumerate(self.known_data):
+            self.wall_data[index] |= ~known & 0x0F
+        self.known_data = bytearray([0x0F]) * (self.size * self.size)
+        self._new_wall_revision()
+
+    # Incremental version of flood_fill_all(). Call this after adding walls
+    # (with set_front_wall() etc.) instead of doing a full flood fill.
+    #
+    # walls is a list of (heading, row, column) for the walls just added. The
+    # cell data must be up to date from a previous flood fill with the same
+    # targets - adding walls can only make cells further away, so we only
+    # need to look at the cells that depended on the walls that were added.
+    #
+    # Returns the number of cells that had to be re-flooded.
+    def flood_fill_incremental(self, walls):
+        cell_data = self.cell_data
+        size = self.size
+        unreached = self.UNREACHED
+        target_indexes = set(self.cell_index(row, column) for row, column in self.targets)
+
+        # (1) Find cells that have lost their route to the target. A cell is
+        # still ok if it has an open neighbour that is one lower.
+        check_list = []
+        for heading, row, column in walls:
+            if row < 0 or row >= size or column < 0 or column >= size:
+                continue
+            index = row * size + column
+            check_list.append(index)
+            heading &= 3
+            if heading == 0:
+                if row+1 < size: check_list.append(index + size)
+            elif heading == 1:
+                if column+1 < size: check_list.append(index + 1)
+            elif heading == 2:
+                if row > 0: check_list.append(index - size)
+            else:
+                if column > 0: check_list.append(index - 1)
+
+        affected = []
+        while check_list:
+            index = check_list.pop()
+            current = cell_data[index]
+            if current == unreached or index in target_indexes:
+                continue
+            neighbours = self._open_neighbours(index)
+            supported = False
+            for neighbour in neighbours:
+                if cell_data[neighbour] == current-1:
+                    supported = True
+                    break
+            if supported:
+                continue
+
+            # lost route, so anything that was relying on this cell needs
+            # to be checked as well.
+            cell_data[index] = unreached
+            affected.append(index)
+            for neighbour in neighbours:
+                if cell_data[neighbour] == current+1:
+                    check_list.append(neighbour)
+
+        # (2) Re-flood the affected cells from the edge of the unaffected area,
+        # lowest values first so each cell only gets set once.
+        heap = []
+        for index in affected:
+            lowest = unreached
+            for neighbour in self._open_neighbours(index):
+                lowest = min(lowest, cell_data[neighbour])
+            if lowest != unreached:
+                cell_data[index] = lowest+1
+                heapq.heappush(heap, (lowest+1, index))
+
+        while heap:
+            value, index = heapq.heappop(heap)
+            if cell_data[index] != value:
+                continue        # already lowered by another route
+            for neighbour in self._process_higher_surrounding_cells(index):
+                heapq.heappush(heap, (value+1, neighbour))
+
+        # this is now the full flood for these walls, so keep it
+        key = (tuple(sorted(set(self.targets))), self.wall_revision)
+        self._cache_store(key, array('H', cell_data))
+
+        return len(affected)
+
+    def _open_neighbours(self, index):
+        walls = self.wall_data[index]
+        neighbours = []
+        if not walls & self.NORTH_WALL:
+            neighbours.append(index + self.size)
+        if not walls & self.EAST_WALL:
+            neighbours.append(index + 1)
+        if not walls & self.WEST_WALL:
+            neighbours.append(index - 1)
+        if not walls & self.SOUTH_WALL:
+            neighbours.append(index - self.size)
+        return neighbours
+
+    # Time weighted flood fill. Rather than counting cells, this finds the
+    # time to get to the target from every (cell, heading) - so a long
+    # straight is cheaper than a zig-zag with the same number of cells.
+    #
+    # straight_costs[n] is the time for a single forward move of n cells
+    # (so this needs to be size+1 long), turn90_cost and turn180_cost are the
+    # times for the on-the-spot turns.
+    #
+    # This is Dijkstra over the (cell, heading) states, run backwards from
+    # the targets. Results go in weighted_cell_data, indexed by
+    # cell_index*4 + heading.
+    def flood_fill_weighted(self, straight_costs, turn90_cost, turn180_cost):
+        size = self.size
+        wall_data = self.wall_data
+        offsets = self.heading_offsets
+        unreached = self.UNREACHED_TIME
+        costs = array('d', [unreached]) * (size * size * 4)
+        self.weighted_cell_data = costs
+        self.weighted_costs = (straight_costs, turn90_cost, turn180_cost)
+
+        heap = []
+        for row, column in self.targets:
+            index = self.cell_index(row, column)
+            for heading in range(4):
+                costs[index*4 + heading] = 0.0
+                heap.append( (0.0, index, heading) )
+        heapq.heapify(heap)
+
+        while heap:
+            cost, index, heading = heapq.heappop(heap)
+            if cost > costs[index*4 + heading]:
+                continue        # already found a quicker way
+
+            # we could have turned on the spot to get to this heading
+            for other_heading, turn_cost in ((heading+1) & 3, turn90_cost), ((heading-1) & 3, turn90_cost), ((heading+2) & 3, turn180_cost):
+                new_cost = cost + turn_cost
+                if new_cost < costs[index*4 + other_heading]:
+                    costs[index*4 + other_heading] = new_cost
+                    heapq.heappush(heap, (new_cost, index, other_heading))
+
+            # ... or come straight here from any cell behind us in one move
+            back_wall = 1 << ((heading + 2) & 3)
+            back_offset = offsets[(heading + 2) & 3]
+            from_index = index
+            cells = 0
+            while not wall_data[from_index] & back_wall:
+                from_index += back_offset
+                cells += 1
+                new_cost = cost + straight_costs[cells]
+                if new_cost < costs[from_index*4 + heading]:
+                    costs[from_index*4 + heading] = new_cost
+                    heapq.heappush(heap, (new_cost, from_index, heading))
+
+    def get_weighted_cell_value(self, heading, row, column):
+        if row < 0 or row >= self.size or column < 0 or column >= self.size:
+            return self.UNREACHED_TIME
+        return self.weighted_cell_data[(row * self.size + column)*4 + (heading & 3)]
+
+    # Same as get_lowest_directions_against_heading() but using the
+    # flood_fill_weighted() times. Returns the relative headings (0=forward,
+    # 1=right, 2=back, 3=left) quickest first, or an empty list at the target.
+    def get_fastest_directions_against_heading(self, heading, row, column):
+        if self.get_weighted_cell_value(heading, row, column) == 0:
+            return []
+
+        straight_costs, turn90_cost, turn180_cost = self.weighted_costs
+
+        options = []
+        # forward - best of all the straight moves we could do from here
+        index = row * self.size + column
+        front_wall = 1 << (heading & 3)
+        offset = self.heading_offsets[heading & 3]
+        forward = self.UNREACHED_TIME
+        cells = 0
+        while not self.wall_data[index] & front_wall:
+            index += offset
+            cells += 1
+            forward = min(forward, straight_costs[cells] + self.weighted_cell_data[index*4 + (heading & 3)])
+        if forward < self.UNREACHED_TIME:
+            options.append( (forward, 0) )
+
+        for relative_heading, turn_cost in (1, turn90_cost), (3, turn90_cost), (2, turn180_cost):
+            cost = turn_cost + self.get_weighted_cell_value(heading + relative_heading, row, column)
+            if cost < self.UNREACHED_TIME:
+                options.append( (cost, relative_heading) )
+
+        options.sort()
+        return [relative_heading for _, relative_heading in options]
 
     # set_target_cell can be called multipled times (e.g. in 4 square for 16x16)
     def set_target_cell(self, row, column):
@@ -326,16 +610,65 @@ class Maze(object):
         if row < 0 or row >= self.size or column < 0 or column >= self.size:
             return
         
-        if state: state = 1
+        heading &= 3
+        index = row * self.size + column
+        bit = 1 << heading
+        other_side = self._other_side_of_wall(heading, row, column)
+        old_walls = self.wall_data[index]
+
+        if state:
+            self.wall_data[index] |= bit
+            if other_side:
+                self.wall_data[other_side[0]] |= other_side[1]
+        else:
+            self.wall_data[index] &= ~bit
+            if other_side:
+                self.wall_data[other_side[0]] &= ~other_side[1]
+
+        if self.wall_data[index] != old_walls:
+            self._new_wall_revision()
+
+        # setting a wall (either way) means we know about it
+        self.known_data[index] |= bit
+        if other_side:
+            self.known_data[other_side[0]] |= other_side[1]
+
+    # the same wall seen from the cell on the other side, as (index, bit),
+    # or None if it's an outside wall
+    def _other_side_of_wall(self, heading, row, column):
         heading &= 3
         if heading == 0:
-            self.NS_wall_data[row+1][column] = state
+            row += 1
         elif heading == 1:
-            self.EW_wall_data[row][column+1] = state
+            column += 1
         elif heading == 2:
-            self.NS_wall_data[row][column] = state
+            row -= 1
         else:
-            self.EW_wall_data[row][column] = state
+            column -= 1
+        if row < 0 or row >= self.size or column < 0 or column >= self.size:
+            return None
+        return (row * self.size + column, 1 << ((heading + 2) & 3))
+
+    # record that we know the state of a wall, without changing it
+    def set_front_wall_known(self, heading, row, column):
+        if row < 0 or row >= self.size or column < 0 or column >= self.size:
+            return
+        heading &= 3
+        self.known_data[row * self.size + column] |= 1 << heading
+        other_side = self._other_side_of_wall(heading, row, column)
+        if other_side:
+            self.known_data[other_side[0]] |= other_side[1]
+
+    def set_left_wall_known(self, heading, row, column):
+        self.set_front_wall_known(heading-1, row, column)
+
+    def set_right_wall_known(self, heading, row, column):
+        self.set_front_wall_known(heading+1, row, column)
+
+    def is_front_wall_known(self, heading, row, column):
+        if row < 0 or row >= self.size or column < 0 or column >= self.size:
+            return True
+        return (self.known_data[row * self.size + column] >> (heading & 3)) & 1 != 0
     
     def set_left_wall(self, heading, row, column, state=True):
         self.set_front_wall(heading-1, row, column, state)
@@ -347,15 +680,7 @@ class Maze(object):
         if row < 0 or row >= self.size or column < 0 or column >= self.size:
             return
         
-        heading &= 3
-        if heading == 0:
-            return self.NS_wall_data[row+1][column]
-        elif heading == 1:
-            return self.EW_wall_data[row][column+1]
-        elif heading == 2:
-            return self.NS_wall_data[row][column]
-        else:
-            return self.EW_wall_data[row][column]
+        return (self.wall_data[row * self.size + column] >> (heading & 3)) & 1
     
     def get_left_wall(self, heading, row, column):
         return self.get_front_wall(heading-1, row, column)
@@ -366,7 +691,7 @@ class Maze(object):
     def get_cell_value(self, row, column):    
         if row < 0 or row >= self.size or column < 0 or column >= self.size:
             return self.UNREACHED
-        return self.maze_cell_data[row][column]
+        return self.cell_data[row * self.size + column]
 
     def get_next_cell_value(self, heading, row, column):
         heading &= 3
@@ -383,7 +708,7 @@ class Maze(object):
         if row < 0 or row >= self.size or column < 0 or column >= self.size:
             return self.UNREACHED
 
-        return self.maze_cell_data[row][column]
+        return self.cell_data[row * self.size + column]
         
     def get_lowest_directions_against_heading(self, heading, row, column):
         heading_list = []
@@ -411,42 +736,45 @@ class Maze(object):
 
         return heading_list
     
-    def _process_higher_surrounding_cells(self, row, column):
+    def _process_higher_surrounding_cells(self, index):
         # This function is called lots of times, so all the function calls have
         # been replaced with direct array accesses. This is fine because we 
         # do not need the flexibility of headings here. So the code is still
         # not confused by this.
+        cell_data = self.cell_data
+        size = self.size
+        walls = self.wall_data[index]
         cell_list = []
-        current = 1 + self.maze_cell_data[row][column]
+        current = 1 + cell_data[index]
 
         #if not self.get_front_wall(0, row, column):
-        if not self.NS_wall_data[row+1][column]:
-            front = self.maze_cell_data[row+1][column]
-            if front > current:
-                cell_list.append( (row+1, column) )
-                self.maze_cell_data[row+1][column] = current
+        if not walls & 1:
+            next_index = index + size
+            if cell_data[next_index] > current:
+                cell_list.append(next_index)
+                cell_data[next_index] = current
                 
         #if not self.get_right_wall(0, row, column):
-        if not self.EW_wall_data[row][column+1]:
-            right = self.maze_cell_data[row][column+1]
-            if right > current:
-                cell_list.append( (row, column+1) )
-                self.maze_cell_data[row][column+1] = current
+        if not walls & 2:
+            next_index = index + 1
+            if cell_data[next_index] > current:
+                cell_list.append(next_index)
+                cell_data[next_index] = current
 
         #if not self.get_left_wall(0, row, column):
-        if not self.EW_wall_data[row][column]:
-            left = self.maze_cell_data[row][column-1]
-            if left > current:
-                cell_list.append( (row, column-1) )
-                self.maze_cell_data[row][column-1] = current
+        if not walls & 8:
+            next_index = index - 1
+            if cell_data[next_index] > current:
+                cell_list.append(next_index)
+                cell_data[next_index] = current
 
         # back last
         #if not self.get_front_wall(2, row, column):
-        if not self.NS_wall_data[row][column]:
-            back = self.maze_cell_data[row-1][column]
-            if back > current:
-                cell_list.append( (row-1, column) )
-                self.maze_cell_data[row-1][column] = current
+        if not walls & 4:
+            next_index = index - size
+            if cell_data[next_index] > current:
+                cell_list.append(next_index)
+                cell_data[next_index] = current
 
         return cell_list
 
@@ -507,10 +835,11 @@ class Maze(object):
         
         row = len(maz)-2
         for line in maz:
+            # floor division, so the bottom line is row -1 (not 0)
             if row % 2:
-                self.parse_maz_NS(line, int(row/2))
+                self.parse_maz_NS(line, row // 2)
             else:
-                self.parse_maz_EW(line, int(row/2))
+                self.parse_maz_EW(line, row // 2)
             row -= 1
 
     def load_example_maze(self, select=2):
@@ -672,10 +1001,12 @@ if __name__ == "__main__":
         m.load_example_maze()
         time_taken = []
         for _ in range(10):
+            m.distance_cache.clear()
             start_time = timeit.default_timer()
             iterations = m.flood_fill_all()
             time_taken.append(timeit.default_timer() - start_time)
         print("Fast Fill Time = ", min(time_taken)*1000, "ms")
+        m.print_stats()
         #print("XTime = ", 100 * min(timeit.repeat(m.flood_fill_all, repeat=10, number=10)), "ms")
         m.print_maz_format()
         m.print_maze()
@@ -694,10 +1025,156 @@ if __name__ == "__main__":
         
         for row in range(16):
             for column in range(16):
-                if n.maze_cell_data[row][column] != m.maze_cell_data[row][column]:
+                if n.get_cell_value(row, column) != m.get_cell_value(row, column):
                     print("Mismatch in cell data", row, column)
                     sys.exit(1)
 
+        # incremental flood fill against full flood fill, adding walls a few
+        # at a time like the mouse does when it scans a cell
+        import random
+        random.seed(1)
+        for size in (16, 32):
+            m = Maze(size)
+            half = size // 2
+            m.set_target_cell(half-1, half-1)
+            m.set_target_cell(half-1, half)
+            m.set_target_cell(half, half-1)
+            m.set_target_cell(half, half)
+            m.flood_fill_all()
+            full_time = 0
+            incremental_time = 0
+            affected = 0
+            for _ in range(size * size // 2):
+                walls = []
+                for _ in range(random.randint(1, 3)):
+                    wall = (random.randint(0, 3), random.randrange(size), random.randrange(size))
+                    if not m.get_front_wall(*wall):
+                        m.set_front_wall(*wall)
+                        walls.append(wall)
+                start_time = timeit.default_timer()
+                affected += m.flood_fill_incremental(walls)
+                incremental_time += timeit.default_timer() - start_time
+                incremental = m.cell_data[:]
+
+                # not flood_fill_all(), that would just find the
+                # incremental result in the cache
+                start_time = timeit.default_timer()
+                full = m._flood(m.wall_data, m.targets)
+                full_time += timeit.default_timer() - start_time
+                if incremental != full:
+                    print("Mismatch in incremental flood fill", size)
+                    sys.exit(1)
+            print("%dx%d Full Fill Time = %f ms, Incremental Fill Time = %f ms, cells re-flooded = %d" %
+                  (size, size, full_time*1000, incremental_time*1000, affected))
+
+        # time weighted flood fill against cell counting flood fill, using
+        # made up move times where straights are much cheaper per cell
+        straight_costs = [0] + [0.5 + 0.25*cells for cells in range(1, 17)]
+        turn90_cost = 0.4
+        turn180_cost = 0.6
+        def run_time(m, weighted):
+            # walk from the start merging straights, like a speed run would
+            heading, row, column = 0, 0, 0
+            total = 0
+            cells = 0
+            for _ in range(256):
+                if weighted:
+                    headings = m.get_fastest_directions_against_heading(heading, row, column)
+                else:
+                    headings = m.get_lowest_directions_against_heading(heading, row, column)
+                if not headings or headings[0] != 0:
+                    if cells:
+                        total += straight_costs[cells]
+                        cells = 0
+                if not headings:
+                    return total
+                if headings[0] == 0:
+                    cells += 1
+                    row, column = [(row+1, column), (row, column+1), (row-1, column), (row, column-1)][heading]
+                else:
+                    total += turn180_cost if headings[0] == 2 else turn90_cost
+                    heading = (heading + headings[0]) & 3
+            print("Didn't reach target")
+            sys.exit(1)
+
+        # distance map cache - switching between centre and start targets
+        m = Maze(16, standard_target = True)
+        m.load_example_maze(0)
+        hits = m.cache_hits
+        for _ in range(3):
+            m.target_normal_end_cells()
+            m.flood_fill_all()
+            if list(m.cell_data) != list(m._flood(m.wall_data, m.targets)):
+                print("Cached centre flood is wrong")
+                sys.exit(1)
+            m.target_start_cell()
+            m.flood_fill_all()
+            if list(m.cell_data) != list(m._flood(m.wall_data, m.targets)):
+                print("Cached start flood is wrong")
+                sys.exit(1)
+        if m.cache_hits - hits != 4:
+            print("Expected 4 cache hits, got", m.cache_hits - hits)
+            sys.exit(1)
+        # a new wall must not give an old map
+        m.set_front_wall(0, 0, 0)
+        m.flood_fill_all()
+        if list(m.cell_data) != list(m._flood(m.wall_data, m.targets)):
+            print("Cache not invalidated by new wall")
+            sys.exit(1)
+        start_time = timeit.default_timer()
+        for _ in range(100):
+            m.target_normal_end_cells()
+            m.flood_fill_all()
+            m.target_start_cell()
+            m.flood_fill_all()
+        cached_time = timeit.default_timer() - start_time
+        start_time = timeit.default_timer()
+        for _ in range(100):
+            m._flood(m.wall_data, m.normal_end_cells())
+            m._flood(m.wall_data, [(0, 0)])
+        uncached_time = timeit.default_timer() - start_time
+        m.print_stats()
+        print("200 target switches: cached %.1f ms, uncached %.1f ms" % (cached_time*1000, uncached_time*1000))
+
+        # shortest path proof - nothing known, part known and all known
+        truth = Maze(16, standard_target = True)
+        truth.load_example_maze(1)
+        m = Maze(16, standard_target = True)
+        if m.is_shortest_path_proven(0, 0):
+            print("Shortest path proven with nothing known")
+            sys.exit(1)
+        m.flood_fill_all()
+        heading, row, column = 0, 0, 0
+        while m.get_cell_value(row, column):
+            # drive the shortest route, seeing the walls of each cell
+            for wall_heading in range(4):
+                m.set_front_wall(wall_heading, row, column, truth.get_front_wall(wall_heading, row, column))
+            m.flood_fill_all()
+            heading = (heading + m.get_lowest_directions_against_heading(heading, row, column)[0]) & 3
+            row, column = [(row+1, column), (row, column+1), (row-1, column), (row, column-1)][heading]
+        pessimistic = m.flood_fill_pessimistic()
+        for index in range(256):
+            if pessimistic[index] < m.cell_data[index]:
+                print("Pessimistic flood shorter than optimistic")
+                sys.exit(1)
+        print("Shortest path proven after one run?", m.is_shortest_path_proven(0, 0))
+        if not truth.is_shortest_path_proven(0, 0):
+            print("Shortest path not proven with all walls known")
+            sys.exit(1)
+
+        for select in range(3):
+            m = Maze(16, standard_target = True)
+            m.load_example_maze(select)
+            m.flood_fill_all()
+            m.flood_fill_weighted(straight_costs, turn90_cost, turn180_cost)
+            shortest_time = run_time(m, False)
+            fastest_time = run_time(m, True)
+            print("Example maze %d: shortest path %.2f s, fastest path %.2f s (%d cells)" % 
+                  (select, shortest_time, fastest_time, m.get_cell_value(0, 0)))
+            if fastest_time > shortest_time or abs(fastest_time - m.get_weighted_cell_value(0, 0, 0)) > 0.0001:
+                print("Weighted flood fill didn't find fastest path")
+                sys.exit(1)
+
 
     test()
     
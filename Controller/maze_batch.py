@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+#
+# Batch flood fill for lots of mazes at once, using NumPy.
+#
+# This is for off-line strategy tuning (not for the robot) where we need
+# distance maps for thousands of wall layouts. The walls are the same per-cell
+# masks as Maze.wall_data, stacked into an (N, size, size) array, and every
+# maze is flooded together a wave at a time, with each maze row packed
+# into the bits of one int.
+#
+# Copyright 2016 Rob Probin.
+# All original work.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+from __future__ import print_function
+
+import sys
+import numpy as np
+from maze import Maze
+
+
+# Stack the walls of a list of Maze objects (all the same size) into an
+# (N, size, size) array of wall masks, indexed [maze, row, column].
+def stack_maze_walls(mazes):
+    size = mazes[0].size
+    walls = np.empty((len(mazes), size, size), dtype=np.uint8)
+    for n, m in enumerate(mazes):
+        if m.size != size:
+            raise ValueError("All mazes in a batch must be the same size")
+        walls[n] = np.frombuffer(bytes(m.wall_data), dtype=np.uint8).reshape(size, size)
+    return walls
+
+
+# Each row of a maze is kept as one unsigned int, with bit n for column n,
+# so a wave step for every maze is a few shifts and ANDs on an (N, size)
+# array. Returns the smallest little endian int type with a bit per column.
+def _row_type(size):
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if size <= np.dtype(dtype).itemsize * 8:
+            return np.dtype(dtype).newbyteorder('<')
+    raise ValueError("Mazes bigger than 64x64 can't be batch flood filled")
+
+# (..., size) array of bools or masks (non-zero is set) to (...) array of rows
+def _pack_rows(cells, dtype):
+    packed = np.packbits(cells, axis=-1, bitorder='little')
+    padding = dtype.itemsize - packed.shape[-1]
+    if padding:
+        packed = np.concatenate([packed, np.zeros(packed.shape[:-1] + (padding,), np.uint8)], axis=-1)
+    return np.ascontiguousarray(packed).view(dtype)[..., 0]
+
+# (...) array of rows to (..., size) array of 0 or 1
+def _unpack_rows(rows, size):
+    return np.unpackbits(rows[..., None].view(np.uint8), axis=-1, bitorder='little')[..., :size]
+
+
+# Flood fill every maze in walls (an (N, size, size) array of wall masks).
+#
+# targets is either a list of (row, column) used for every maze, or an
+# (N, size, size) boolean array of target cells per maze. Returns an
+# (N, size, size) uint16 array of distances, the same as flood_fill_all()
+# would leave in Maze.cell_data for each maze (Maze.UNREACHED if no route).
+def batch_flood_fill(walls, targets):
+    walls = np.asarray(walls, dtype=np.uint8)
+    if walls.ndim != 3 or walls.shape[1] != walls.shape[2]:
+        raise ValueError("Expected walls to be N x size x size")
+    size = walls.shape[1]
+    dtype = _row_type(size)
+    if isinstance(targets, np.ndarray):
+        target_cells = targets
+    else:
+        target_cells = np.zeros(walls.shape, dtype=bool)
+        for row, column in targets:
+            target_cells[:, row, column] = True
+
+    # Like Maze._flood(), the wave goes out of a cell through its open
+    # walls: north from (row, column) to (row+1, column), east to
+    # (row, column+1). The columns a shift would take off the side of the
+    # maze are masked off.
+    full = (1 << size) - 1
+    north = ~_pack_rows(walls[:, :-1] & Maze.NORTH_WALL, dtype) & dtype.type(full)
+    south = ~_pack_rows(walls[:, 1:] & Maze.SOUTH_WALL, dtype) & dtype.type(full)
+    east = ~_pack_rows(walls & Maze.EAST_WALL, dtype) & dtype.type(full >> 1)
+    west = ~_pack_rows(walls & Maze.WEST_WALL, dtype) & dtype.type(full & ~1)
+    frontier = _pack_rows(target_cells, dtype)
+    unvisited = ~frontier & dtype.type(full)
+
+    # The distances are kept as bit planes - a cell reached on wave n is
+    # set in plane b if bit b of n is set - so each wave only touches the
+    # rows, and they are unpacked once at the end.
+    levels = np.zeros(((size * size).bit_length(),) + frontier.shape, dtype)
+    result_levels = levels.copy()
+    result_unvisited = unvisited.copy()
+
+    # Mazes are taken out of the working set as soon as their wave stops.
+    active = np.arange(walls.shape[0])
+    wave = 0
+    while len(active):
+        wave += 1
+        new = frontier & east
+        new <<= 1
+        new |= (frontier & west) >> 1
+        new[:, 1:] |= frontier[:, :-1] & north
+        new[:, :-1] |= frontier[:, 1:] & south
+        new &= unvisited
+        unvisited ^= new
+        for bit in range(wave.bit_length()):
+            if wave >> bit & 1:
+                levels[bit] |= new
+        frontier = new
+
+        running = frontier.any(axis=1)
+        if not running.all():
+            finished = ~running
+            result_levels[:, active[finished]] = levels[:, finished]
+            result_unvisited[active[finished]] = unvisited[finished]
+            active = active[running]
+            frontier, unvisited, north, south, east, west = [
+                a[running] for a in (frontier, unvisited, north, south, east, west)]
+            levels = levels[:, running]
+
+    distances = np.zeros(walls.shape, dtype=np.uint16)
+    for bit in range(len(result_levels)):
+        distances |= _unpack_rows(result_levels[bit], size).astype(np.uint16) << bit
+    distances[_unpack_rows(result_unvisited, size).view(bool)] = Maze.UNREACHED
+    return distances
+
+
+if __name__ == "__main__":
+    def test():
+        import random
+        import timeit
+
+        # random mazes plus the built in examples, checked against
+        # both of the Maze flood fills
+        random.seed(1)
+        mazes = []
+        for select in range(3):
+            m = Maze(16, standard_target = True)
+            m.load_example_maze(select)
+            mazes.append(m)
+        for _ in range(197):
+            m = Maze(16, standard_target = True)
+            for _ in range(random.randint(20, 250)):
+                m.set_front_wall(random.randint(0, 3), random.randrange(16), random.randrange(16))
+            mazes.append(m)
+
+        walls = stack_maze_walls(mazes)
+        distances = batch_flood_fill(walls, mazes[0].targets)
+        for n, m in enumerate(mazes):
+            m.flood_fill_all()
+            if list(distances[n].flatten()) != list(m.cell_data):
+                print("Mismatch against flood_fill_all() in maze", n)
+                sys.exit(1)
+            m.flood_fill_all_multipass()
+            if list(distances[n].flatten()) != list(m.cell_data):
+                print("Mismatch against flood_fill_all_multipass() in maze", n)
+                sys.exit(1)
+        print("Batch flood fill matches for", len(mazes), "mazes")
+
+        # per-maze targets
+        target_mask = np.zeros(walls.shape, dtype=bool)
+        target_mask[:, 0, 0] = True
+        distances = batch_flood_fill(walls, target_mask)
+        for n, m in enumerate(mazes):
+            m.target_start_cell()
+            m.flood_fill_all()
+            if list(distances[n].flatten()) != list(m.cell_data):
+                print("Mismatch with target mask in maze", n)
+                sys.exit(1)
+        print("Batch flood fill with target mask matches")
+
+        # rows that don't fill their int
+        for size in (5, 20):
+            small = []
+            for _ in range(20):
+                m = Maze(size, standard_target = True)
+                for _ in range(random.randint(5, size * size)):
+                    m.set_front_wall(random.randint(0, 3), random.randrange(size), random.randrange(size))
+                small.append(m)
+            distances = batch_flood_fill(stack_maze_walls(small), small[0].targets)
+            for n, m in enumerate(small):
+                m.flood_fill_all()
+                if list(distances[n].flatten()) != list(m.cell_data):
+                    print("Mismatch in %dx%d maze %d" % (size, size, n))
+                    sys.exit(1)
+        print("Batch flood fill matches for 5x5 and 20x20 mazes")
+
+        # bad input is an exception, not an exit
+        for bad in (lambda: stack_maze_walls([Maze(16), Maze(5)]),
+                    lambda: batch_flood_fill(np.zeros((2, 16, 8), np.uint8), [(0, 0)]),
+                    lambda: batch_flood_fill(np.zeros((2, 65, 65), np.uint8), [(0, 0)])):
+            try:
+                bad()
+                print("Bad input not found")
+                sys.exit(1)
+            except ValueError:
+                pass
+
+        big_walls = np.concatenate([walls] * 10)
+        batch_time = min(timeit.repeat(lambda: batch_flood_fill(big_walls, mazes[0].targets), number=1, repeat=3))
+
+        def one_at_a_time():
+            for _ in range(10):
+                for m in mazes:
+                    m.distance_cache.clear()
+                    m.flood_fill_all()
+        single_time = min(timeit.repeat(one_at_a_time, number=1, repeat=3))
+        print("%d mazes: batch %.1f ms, one at a time %.1f ms" % (len(big_walls), batch_time*1000, single_time*1000))
+
+    test()
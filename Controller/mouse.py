@@ -80,10 +80,18 @@ if len(sys.argv) >= 2:
         SIMULATOR = True
         TEXT_SIMULATOR = True
         GUI_SIMULATOR = False
+        HEADLESS_SIMULATOR = False
     elif sys.argv[1] == "GUI_SIMULATOR":
         SIMULATOR = True
         TEXT_SIMULATOR = False
         GUI_SIMULATOR = True
+        HEADLESS_SIMULATOR = False
+    elif sys.argv[1] == "HEADLESS_SIMULATOR":
+        # one search and speed run, with automatic keys, on a virtual clock
+        SIMULATOR = True
+        TEXT_SIMULATOR = False
+        GUI_SIMULATOR = False
+        HEADLESS_SIMULATOR = True
     else:
         print("Unknown command line argument")
         sys.exit(-201)
@@ -91,6 +99,11 @@ else:
     SIMULATOR = False
     TEXT_SIMULATOR = False
     GUI_SIMULATOR = False
+    HEADLESS_SIMULATOR = False
+
+import sim_clock
+if HEADLESS_SIMULATOR:
+    sim_clock.use_virtual_clock()
 
 if SIMULATOR:
     from low_level_emulator import serial   #@UnusedImport
@@ -103,6 +116,20 @@ import time
 from collections import deque
 import os
 from maze import Maze
+from speculative_planner import SpeculativePlanner
+from speed_run import compile_speed_run, compile_diagonal_speed_run, SpeedRunRouteFailed
+from serial_reader import SerialReader, take_frame
+from acceleration import default_acceleration_table, estimate_move_time
+try:
+    from sensor_capture import SensorCapture
+    from calibration import CalibrationEngine, POSITIONS as calibration_positions
+    from acceleration_profiles import get_profile_table, validate_acceleration_table
+except ImportError:
+    # no NumPy, so no sensor capture, calibration or acceleration profiles
+    SensorCapture = None
+    CalibrationEngine = None
+    get_profile_table = None
+    validate_acceleration_table = None
 import datetime
 
 ################################################################
@@ -113,6 +140,13 @@ import datetime
 verbose = False
 print_map_in_progress = True
 snoop_serial_data = False        # good but slow
+use_serial_reader_thread = True  # read the serial port in another thread
+if HEADLESS_SIMULATOR:
+    # the reader thread waits in real time
+    use_serial_reader_thread = False
+# return from main() after one run, rather than going back to the keys
+exit_after_run = HEADLESS_SIMULATOR
+EVENT_WAIT_TIME = 0.02           # seconds to sleep waiting for an event
 
 step_mode = 2           # valid values are 1, 2, 4, 8
 
@@ -137,6 +171,46 @@ elif step_mode == 2:
 else:
     print("Haven't done other step modes yet")
 
+# speed run on the quickest path (using move time estimates from the 
+# acceleration table) rather than the path with the fewest cells
+speed_run_weighted = True
+
+# work out the flood fill for each possible wall scan while moving forward
+speculative_planning = True
+
+# do the speed run from a compiled move list, rather than a cell at a time
+speed_run_compiled = True
+# cut across zig-zags with 45 degree turns in the speed run (the emulator
+# only knows the four headings, so leave off for the text simulator)
+speed_run_diagonals = False
+
+# during search, go down straights of explored cells in one move
+search_multi_cell_moves = True
+# keep extending a forward move into unexplored cells, using the test 
+# distance events to see the walls on the way (needs IO processor support)
+search_extend_moves = False
+
+# read all the IR levels with one all sensor state request (0x90) rather
+# than one request per sensor (needs IO processor support)
+use_sensor_snapshot = True
+
+# keep every IR level, speed sample and tick report (not just the last)
+# in ring buffers for steering tuning, if NumPy is installed
+capture_sensors = True
+
+# IR calibration reads at least this many samples in each position, and
+# stops when the 95% confidence interval of each sensor's mean is within
+# the counts or fraction of the mean (or at the maximum samples)
+calibration_min_samples = 5
+calibration_max_samples = 50
+calibration_confidence_counts = 2
+calibration_confidence_fraction = 0.02
+
+# acceleration table to write at start up, from the profiles in
+# acceleration_profiles.py (e.g. "brisk"), or None to leave the dsPIC's
+# table alone. Needs NumPy.
+acceleration_profile = None
+
 HOLD_KEY_TIME = 1.5     # seconds
 
 BATT_VOLTAGE_PER_CELL_WARNING = 3.8
@@ -151,25 +225,6 @@ log_battery_voltage = False
 now_string = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
 battery_filename = "battery_%s.txt" % now_string
 
-################################################################
-# 
-# Module-level Variables
-#
-
-#port = None
-move_finished = False
-battery_voltage = 17
-minimum_battery_voltage = battery_voltage
-
-maze_selected = 5   # should be 5 or 16
-
-keys_in_queue = deque()
-
-battery_voltage_mode = 0 # 0 = ok, 1 = low voltage, 2 = shutdown
-battery_voltage_count = BATT_VOLTAGE_COUNT
-
-battery_voltage_array = []
-
 ################################################################
 # 
 # Exceptions
@@ -197,23 +252,9 @@ def recover_from_major_error():
 
 # define timer function
 # Need to test time.time against datetime.utcnow() or date.now() on RPi
-read_accurate_time = time.time
-
-# This function manages the saving of battery data
-def save_battery_data(flush_all_data, battery_voltage):
-    global log_battery_voltage
-    global battery_voltage_array
-
-    if log_battery_voltage:
-        
-        if battery_voltage is not None:
-            battery_voltage_array.append( (time.time(), battery_voltage) )
-
-        if flush_all_data or len(battery_voltage_array) >= 200:
-            with open(battery_filename, "a") as f:
-                for item in battery_voltage_array:
-                    f.write("%f, %s\n" % (item[0], item[1]))
-            battery_voltage_array = []
+# This is time.time(), unless we are on the virtual clock.
+def read_accurate_time():
+    return sim_clock.time()
 
 
 ################################################################
@@ -222,58 +263,13 @@ def save_battery_data(flush_all_data, battery_voltage):
 # 
 
 
-sent_bytes_in_flight = 0
-messages_in_flight_queue = deque()
-flight_queue_full = False
-
-def send_message(port, message):
-    global sent_bytes_in_flight
-    global message_in_flight_queue
-    
-    ml = len(message)
-
-    # run as many as we can until we are empty
-    while port.inWaiting():
-        event_processor(port)
-    
-    if sent_bytes_in_flight + ml > 4:
-        print(">", ml, sent_bytes_in_flight)
-        
-    end_time = time.time() + 0.1
-    while (ml + sent_bytes_in_flight) > 4:
-        global flight_queue_full
-        flight_queue_full = True
-        event_processor(port)
-        flight_queue_full = False
-        if time.time() > end_time:
-            print("Waited for response - we should do something")
-            end_time = time.time() + 1
-
-    sent_bytes_in_flight += ml
-    messages_in_flight_queue.append(ml)
-    port.write(message)
-    # @todo: should we check number of bytes written?
-
-
-def acknowledge_send(port, cmd):
-    global sent_bytes_in_flight
-    global message_in_flight_queue
-
-    try:
-        count = messages_in_flight_queue.popleft()
-    except IndexError:
-        print("Got acknowledge send without anything in message_in_flight_queue - Ignoring")
-        count = 0
-        #recover_from_major_error()
-
-    sent_bytes_in_flight -= count
-
-def reset_message_queue():
-    global sent_bytes_in_flight
-    global message_in_flight_queue
-
-    sent_bytes_in_flight = 0
-    messages_in_flight_queue = deque()
+# The dsPIC has a 4 byte receive window. Messages wait in outgoing_queue
+# and are sent as soon as there is room, which is usually when an
+# acknowledge (0xEF) comes back - so send_message() doesn't have to wait
+# for a round trip per message. messages_in_flight_queue holds
+# (length, time sent) for each message the dsPIC hasn't acknowledged.
+SEND_WINDOW_BYTES = 4
+MAX_QUEUED_BYTES = 64       # send_message() waits if more than this is queued
 
 ################################################################
 # 
@@ -283,15 +279,6 @@ def reset_message_queue():
 def message_into_hex(s):
     return ":".join("{:02x}".format(c) for c in s)
 
-def send_unlock_command(port):
-    if verbose: print("Send Unlock")
-    send_message(port, b'\xFE\xFC\xF8\xFE')
-
-
-def send_poll_command(port):
-    if verbose: print("Send Poll")
-    send_message(port, b'\x80')
-
 #def wait_for_poll_repl(port):
 #    s = port.read(1)
 #    if s == '\x80':
@@ -302,226 +289,29 @@ def send_poll_command(port):
 #        print("For Poll Reply: Got", message_into_hex(s))
 
 
-def send_switch_led_command(port, led, on):
-    if on:
-        command = 0x10 + led
-        #if verbose: print("Switch LED", led, "on")
-    else:
-        #if verbose: print("Switch LED", led, "off")
-        command = 0x00 + led
-
-    send_message(port, bytes([command]))
-
-
-def send_led_pattern_command(port, led_states):
-    # 0x20 = CMD_TYPE_ALL_LEDS - extra byte (leds 1-8, led 9-bit 0 of cmd byte)
-    leds_1to8 = led_states & 0xFF
-    cmd_and_led_9 = 0x20 + ((led_states >> 8) & 1)
-    send_message(port, bytes([cmd_and_led_9, leds_1to8]))
-
-def turn_off_all_LEDs(port):
-    send_led_pattern_command(port, 0);
-
-    
-def turn_off_motors(port):
-    if verbose: print("Turn off motors")
-    send_message(port, b"\xC0")
-
-def move_forward(port, distance):
-    global move_finished
-    move_finished = False
-    
-    if verbose: print("Forward")
-    s = bytes([0xC1, distance >> 8, distance & 0xff])
-    send_message(port, s)
-
-def move_right(port, distance):
-    global move_finished
-    move_finished = False
-    
-    if verbose: print("right")
-    s = bytes([0xC2, distance >> 8, distance & 0xff])
-    send_message(port, s)
-
-def move_left(port, distance):
-    global move_finished
-    move_finished = False
-    
-    if verbose: print("left")
-    s = bytes([0xC3, distance >> 8, distance & 0xff])
-    send_message(port, s)
-
-def turn_on_ir(port):
-    if verbose: print("IR on")
-    send_message(port, b"\xD1")
-    
-def turn_off_ir(port):
-    if verbose: print("IR off")
-    send_message(port, b"\xD0")
-
-
-def set_speed(port, speed):
-    if verbose: print("set speed", speed)
-    s = bytes([0xC4, speed >> 8, speed & 0xff])
-    send_message(port, s)
-
-def send_get_wall_info(port):
-    if verbose: print("Get wall IR")
-    send_message(port, b"\x98")
-
-def send_get_45_sensor_info(port):
-    if verbose: print("Get 45 IR")
-    send_message(port, b"\x99")
-
-def get_front_level(port):
-    send_message(port, b"\x9A")
-
-def get_l90_level(port):
-    send_message(port, b"\x9B")
-
-def get_l45_level(port):
-    send_message(port, b"\x9C")
-
-def get_r90_level(port):
-    send_message(port, b"\x9D")
-
-def get_r45_level(port):
-    send_message(port, b"\x9E")
-
-
-def set_steering_correction(port, distance):
-    if verbose: print("set steering correction distance", distance)
-    s = bytes([0xC5, distance >> 8, distance & 0xff])
-    send_message(port, s)
-
-def extend_movement(port):
-    if verbose: print("extent movement")
-    send_message(port, "b\xC6")
-
-def set_cell_distance(port, distance):
-    if verbose: print("set_cell_distance", distance)
-    s = bytes([0xC7, distance >> 8, distance & 0xff])
-    send_message(port, s)
-
-def set_wall_edge_correction(port, distance):
-    if verbose: print("set_wall_edge_correction", distance)
-    s = bytes([0xC8, distance >> 8, distance & 0xff])
-    send_message(port, s)
-
-def set_distance_to_test(port, distance):
-    if verbose: print("set_distance_to_test", distance)
-    s = bytes([0xC9, distance >> 8, distance & 0xff])
-    send_message(port, s)
-
-
+################################################################
+# 
+# Write cache
 #
-# IR commands
+# LED, IR on/off and speed commands are sent a lot with the same value
+# (e.g. the menus set the LEDs every time round the loop). These commands
+# just record what we want, and flush_pending_writes() sends the changes,
+# so nothing is sent if the dsPIC already has that state, and several LED
+# changes are sent as one pattern command. The flush happens before any
+# other message is sent (so the order is kept) and each time round
+# event_processor(), i.e. once per tick.
 #
-def set_front_long_threshold(port, threshold):
-    if verbose: print("set_front_long_threshold", threshold)
-    s = bytes([0xD8, threshold >> 8, threshold & 0xff])
-    send_message(port, s)
-
-def set_front_short_threshold(port, threshold):
-    if verbose: print("set_front_short_threshold", threshold)
-    s = bytes([0xD9, threshold >> 8, threshold & 0xff])
-    send_message(port, s)
-
-def set_left_side_threshold(port, threshold):
-    if verbose: print("set_left_side_threshold", threshold)
-    s = bytes([0xDA, threshold >> 8, threshold & 0xff])
-    send_message(port, s)
-
-def set_right_side_threshold(port, threshold):
-    if verbose: print("set_right_side_threshold", threshold)
-    s = bytes([0xDB, threshold >> 8, threshold & 0xff])
-    send_message(port, s)
-
-def set_left_45_threshold(port, threshold):
-    if verbose: print("set_left_45_threshold", threshold)
-    s = bytes([0xDC, threshold >> 8, threshold & 0xff])
-    send_message(port, s)
-
-def set_right_45_threshold(port, threshold):
-    if verbose: print("set_right_45_threshold", threshold)
-    s = bytes([0xDD, threshold >> 8, threshold & 0xff])
-    send_message(port, s)
-
-def set_left_45_too_close_threshold(port, threshold):
-    if verbose: print("set_left_45_too_close_threshold", threshold)
-    s = bytes([0xDE, threshold >> 8, threshold & 0xff])
-    send_message(port, s)
-
-def set_right_45_too_close_threshold(port, threshold):
-    if verbose: print("set_right_45_too_close_threshold", threshold)
-    s = bytes([0xDF, threshold >> 8, threshold & 0xff])
-    send_message(port, s)
-
-def get_steering_correction(port):
-    if verbose: print("get steering correction distance")
-    clear_CF_result(0xC5)
-    s = b"\xCF\xC5"
-    send_message(port, s)
-    return get_CF_result(port, 0xC5)
-
-def get_cell_distance(port):
-    if verbose: print("get_cell_distance")
-    clear_CF_result(0xC7)
-    s = b"\xCF\xC7"
-    send_message(port, s)
-    return get_CF_result(port, 0xC7)
-
-def get_wall_edge_correction(port):
-    if verbose: print("get_wall_edge_correction")
-    clear_CF_result(0xC8)
-    s = b"\xCF\xC8"
-    send_message(port, s)
-    return get_CF_result(port, 0xC8)
-
-def get_distance_to_test(port):
-    if verbose: print("get_distance_to_test")
-    clear_CF_result(0xC9)
-    s = b"\xCF\xC9"
-    send_message(port, s)
-    return get_CF_result(port, 0xC9)
+# LEDs are numbered 1-9, bit n-1 in the masks below. The dsPIC drives
+# LEDs 7-9 from the IR sensors itself, so writes to those are never
+# dropped as repeats.
+coalesce_writes = True
+ALL_LEDS = 0x1FF
+DSPIC_DRIVEN_LEDS = 0x1C0
 
 
 steering_correction_value = 10
 distance_to_test_value = 300
 
-def check_distances_are_set_correctly(port):
-    if get_steering_correction(port) != steering_correction_value:
-        print("get_steering_correction() didn't return expected value")
-        return False
-    if get_cell_distance(port) != distance_cell:
-        print("get_cell_distance() didn't return expected value")
-        return False
-    if get_wall_edge_correction(port) != wall_edge_correction_factor:
-        print("get_wall_edge_correction() didn't return expected value")
-        return False
-    if get_distance_to_test(port) != distance_to_test_value:
-        print("get_distance_to_test() didn't return expected value")
-        return False
-    
-    return True
-
-def set_default_distances(port):
-    
-    success = False
-    for _ in range(10):
-    #set_speed(port, speed)
-        set_steering_correction(port, steering_correction_value)           # might need to fixed for higher speeds
-        set_cell_distance(port, distance_cell)      # 
-        set_wall_edge_correction(port, wall_edge_correction_factor)
-        set_distance_to_test(port, distance_to_test_value)
-
-        if check_distances_are_set_correctly(port):
-            success = True
-            break
-    
-    if not success:
-        print("Failed to set values 10 times :-(")
-
 
 ################################################################
 # 
@@ -531,815 +321,111 @@ def set_default_distances(port):
 #
 
 list_of_events = []
-timer_next_end_time = read_accurate_time()+1
-battery_count = 10
 
 def add_event(function, repeating=False):
     pass
 
 
-execution_state_LED6 = True
-
-def run_timers(port):
-    global timer_next_end_time
-    time_now = read_accurate_time()
-    if time_now > timer_next_end_time:
-        
-        # notice: time slip possible here, no 'catchup' attempted.
-        timer_next_end_time = read_accurate_time()
-        
-        global battery_voltage_mode
-        if battery_voltage_mode == 0:
-            # no problem
-            timer_next_end_time += 1
-        else:
-            # fast flash if problem
-            timer_next_end_time += 0.125
-
-        # only do this if we are not running full already...
-        if not flight_queue_full and not TEXT_SIMULATOR:
-            # we hard code a function here, for the moment
-            global execution_state_LED6
-            send_switch_led_command(port, 6, execution_state_LED6)
-            execution_state_LED6 = not execution_state_LED6
-
-        global battery_count
-        global minimum_battery_voltage
-        battery_count -= 1
-        if battery_count <= 0:
-                print("Batt V", battery_voltage, "cell:", battery_voltage/4.0, "min:", minimum_battery_voltage)
-                battery_count = 10
-
-################################################################
-# 
-# Recieved Event Functions
-# 
-def EV_UNKNOWN_RESET(port, cmd):
-    print("Unknown Reset")
-    raise SoftReset
-def EV_POWER_ON_RESET(port, cmd):
-    print("Power On Reset")
-    if snoop_serial_data:
-        port.print_all()
-    recover_from_major_error()
-def EV_BROWN_OUT_RESET(port, cmd):
-    print("Brown Out Reset")
-    recover_from_major_error()
-def EV_WATCHDOG_RESET(port, cmd):
-    print("Watchdog Reset")
-    recover_from_major_error()
-def EV_SOFTWARE_RESET(port, cmd):
-    print("Software Reset")
-    recover_from_major_error()
-def EV_EXTERNAL_RESET(port, cmd):
-    print("External Reset")
-    raise SoftReset
-
-def EV_EXCEPTION_RESET(port, cmd):
-    print("Exception Reset")
-    recover_from_major_error()
-
-
 # approximately 5v. 1024 steps (1024=max). Multiplier for potential divider.
 
 Vfeed = 5.0
 Aref_voltage = 5.0 * 0.95
 battery_voltage_conversion = Aref_voltage * (33000+12000) / 12000 / 1023
 
+# Handlers read the rest of their frame with event.read(1), like reading
+# the serial port, but get it from here.
+class EventFrameReader:
+    def __init__(self, frame):
+        self.frame = frame
+        self.position = 1
 
-def EV_BATTERY_VOLTAGE(port, cmd):
-    ADC_reading = port.read(1)
-    ADClen = len(ADC_reading)
-    if ADClen != 1:
-        if ADClen == 0:
-            print("Didn't get second byte of battery voltage")
-            recover_from_major_error()
-        else:
-            print("More than one byte in voltage")
-            recover_from_major_error()
-
-    ADC_reading = ord(ADC_reading) + 256 * (cmd & 0x03)
-
-    # potential divider is 33K and 12K. This does into an ADC where the reference is approx. 5v.
-    global battery_voltage_conversion
-    global battery_voltage
-    battery_voltage = ADC_reading * battery_voltage_conversion
-    #print("Batt V", voltage, "cell:", voltage/4)
-    
-    
-    # figure out the warnings and 
-    global BATTERY_VOLTAGE_SHUTDOWN
-    global BATTERY_VOLTAGE_WARNING
-    global battery_voltage_mode
-    global battery_voltage_count
-    global BATT_VOLTAGE_COUNT
-    global minimum_battery_voltage
-    
-    save_battery_data(False, battery_voltage)
-    if battery_voltage < minimum_battery_voltage:
-        minimum_battery_voltage = battery_voltage
-        
-    potential_mode = 0
-    if battery_voltage <= BATTERY_VOLTAGE_WARNING:
-        potential_mode = 1
-        if battery_voltage <= BATTERY_VOLTAGE_SHUTDOWN:
-            potential_mode = 2
-
-        # we only go one way... don't allow increases to 
-        # reset the warnings or shutdown!
-        if  potential_mode > battery_voltage_mode:
-            battery_voltage_count -= 1
-            if battery_voltage_count <= 0:
-                # become a higher mode
-                # two passes are required to reach shutdown!
-                battery_voltage_mode += 1
-                battery_voltage_count = BATT_VOLTAGE_COUNT
-                # shutdown the Raspberry Pi
-                if battery_voltage_mode == 1:
-                    print("Battery Low.      Batt V", battery_voltage, "cell:", battery_voltage/4.0)
-                elif battery_voltage_mode == 2:
-                    raise ShutdownRequest
-        else:
-            battery_voltage_count = BATT_VOLTAGE_COUNT
-
-
-
-ir_front_level = 0
-ir_front_level_new = False
-
-def EV_IR_FRONT_LEVEL(port, cmd):
-    global ir_front_level
-    global ir_front_level_new
-    ir_front_level = ord(port.read(1))*256
-    ir_front_level += ord(port.read(1))
-    if verbose: print("IR Front level", ir_front_level)
-    ir_front_level_new = True
-
-ir_l90_level = 0
-ir_l90_level_new = False
-    
-def EV_L90_LEVEL(port, cmd):
-    global ir_l90_level
-    global ir_l90_level_new
-    ir_l90_level = ord(port.read(1))*256
-    ir_l90_level += ord(port.read(1))
-    if verbose: print("IR L90 level", ir_l90_level)
-    ir_l90_level_new = True
-
-ir_l45_level = 0
-ir_l45_level_new = False
-    
-def EV_L45_LEVEL(port, cmd):
-    global ir_l45_level
-    global ir_l45_level_new
-    ir_l45_level = ord(port.read(1))*256
-    ir_l45_level += ord(port.read(1))
-    if verbose: print("IR L45 level", ir_l45_level)
-    ir_l45_level_new = True
-    
-ir_r90_level = 0
-ir_r90_level_new = False
-
-def EV_R90_LEVEL(port, cmd):
-    global ir_r90_level
-    global ir_r90_level_new
-    ir_r90_level = ord(port.read(1))*256
-    ir_r90_level += ord(port.read(1))
-    if verbose: print("IR R90 level", ir_r90_level)
-    ir_r90_level_new = True
-    
-ir_r45_level = 0
-ir_r45_level_new = False
-
-def EV_R45_LEVEL(port, cmd):
-    global ir_r45_level
-    global ir_r45_level_new
-    ir_r45_level = ord(port.read(1))*256
-    ir_r45_level += ord(port.read(1))
-    if verbose: print("IR R45 level", ir_r45_level)
-    ir_r45_level_new = True
-
-def EV_TICKS_PER_MOTOR(port, cmd):
-    left_ticks = ord(port.read(1))*256 + ord(port.read(1))
-    right_ticks = ord(port.read(1))*256 + ord(port.read(1))
-    print("Left Motor Ticks =", left_ticks, " Right Motor Ticks =", right_ticks)
-
-def EV_FINISHED_MOVE(port, cmd):
-    global move_finished
-    move_finished = True
-    print("Got move finished")
-
-locked = True
-
-def EV_UNLOCK_FROM_LOCK(port, cmd):
-    print("Got unlock from lock")
-    global locked
-    locked = False
-
-def EV_UNLOCK_FROM_UNLOCK(port, cmd):
-    print("Got unlock from unlock")
-    global locked
-    locked = False
-
-def EV_LOCK_BY_TIMER(port, cmd):
-    print("Got lock by timer - NOT HANDLED")
-    recover_from_major_error()
-    global locked
-    locked = True
-    # @todo: We should issue unlock here, immediately!
-
-def EV_LOCK_BY_COMMAND(port, cmd):
-    print("Got lock by command - NOT HANDLED")
-    recover_from_major_error()
-    global locked
-    locked = True
-    # @todo: We should issue unlock here, immediately!
-
-
-def EV_POLL_REPLY(port, cmd):
-    print("Got poll reply")
-
-def EV_FAIL_INVALID_COMMAND(port, cmd):
-    print("Got invalid command")
-    recover_from_major_error()
-
-#def EV_GOT_INSTRUCTION(port, cmd):
-#    acknowledge_send()
-
-key_A_start_time = None
-key_B_start_time = None
-
-def EV_BUTTON_A_RELEASE(port, cmd):
-    global key_A_start_time
-    if key_A_start_time == None:
-        # no press, ignore release
-        return
-    #print("KEY A TIME =", read_accurate_time() - key_A_start_time)
-    # hold key or normal key?
-    if (read_accurate_time() - key_A_start_time) > HOLD_KEY_TIME:
-        keys_in_queue.append('A')
-        if verbose: print("held A")
-    else:
-        keys_in_queue.append('a')
-        if verbose: print("press A")
-        
-    key_A_start_time = None
-
-def EV_BUTTON_B_RELEASE(port, cmd):
-    global key_B_start_time
-    if key_B_start_time == None:
-        # no press, ignore release
-        return
-    #print("KEY B TIME =", read_accurate_time() - key_B_start_time)
-    # hold key or normal key?
-    if (read_accurate_time() - key_B_start_time) > HOLD_KEY_TIME:
-        keys_in_queue.append('B')
-        if verbose: print("held B")
-    else:
-        keys_in_queue.append('b')
-        if verbose: print("press B")
-
-    key_B_start_time = None
-
-def EV_BUTTON_A_PRESS(port, cmd):
-    global key_A_start_time
-    key_A_start_time = read_accurate_time()
-    
-def EV_BUTTON_B_PRESS(port, cmd):
-    global key_B_start_time
-    key_B_start_time = read_accurate_time()
-
-got_wall_info = False
-left_wall_sense = False
-right_wall_sense = False
-front_short_wall_sense = False
-front_long_wall_sense = False
-
-#EV_IR_FRONT_SIDE_STATE  0x40        // bit 0 = front long
-#                                    // bit 1 = front short
-#                                    // bit 2 = left side
-#                                    // bit 3 = right side
-def EV_IR_FRONT_SIDE_STATE(port, cmd):
-    global got_wall_info
-    global left_wall_sense
-    global right_wall_sense
-    global front_short_wall_sense
-    global front_long_wall_sense
-    left_wall_sense = cmd&4
-    right_wall_sense = cmd&8
-    front_short_wall_sense = cmd&2
-    front_long_wall_sense = cmd&1
-    got_wall_info = True
-
-
-got_45_info = False
-left_45_sense = False
-right_45_sense = False
-left_45_too_close_sense = False
-right_45_too_close_sense = False
-
-# define EV_IR_45_STATE          0x50        // bit 0 = left 45
-#                                           // bit 1 = right 45
-#                                           // bit 2 = left 45 too close
-#                                           // bit 3 = right 45 too close
-def EV_IR_45_STATE(port, cmd):
-    global got_45_info
-    global left_45_sense
-    global right_45_sense
-    global left_45_too_close_sense
-    global right_45_too_close_sense
-    left_45_sense = cmd & 1
-    right_45_sense = cmd & 2
-    left_45_too_close_sense = cmd & 4
-    right_45_too_close_sense = cmd & 8
-    got_45_info = True
-
-
-"""
-def EV_IR_FRONT_SIDE_STATE_0(port, cmd):
-    # we use short sensor for wall measurement
-    # left, front, right, front_long
-    return False, False, False, False  # cmd&4, cmd&2, cmd&8, cmd&1
-
-def EV_IR_FRONT_SIDE_STATE_1(port, cmd):
-    # we use short sensor for wall measurement
-    # left, front, right, front_long
-    return False, False, False, True  # cmd&4, cmd&2, cmd&8, cmd&1
-
-def EV_IR_FRONT_SIDE_STATE_2(port, cmd):
-    # we use short sensor for wall measurement
-    # left, front, right, front_long
-    return False, True, False, False  # cmd&4, cmd&2, cmd&8, cmd&1
-
-def EV_IR_FRONT_SIDE_STATE_3(port, cmd):
-    # we use short sensor for wall measurement
-    # left, front, right, front_long
-    return False, True, False, True  # cmd&4, cmd&2, cmd&8, cmd&1
-
-def EV_IR_FRONT_SIDE_STATE_4(port, cmd):
-    # we use short sensor for wall measurement
-    # left, front, right, front_long
-    return True, False, False, False  # cmd&4, cmd&2, cmd&8, cmd&1
-
-def EV_IR_FRONT_SIDE_STATE_5(port, cmd):
-    # we use short sensor for wall measurement
-    # left, front, right, front_long
-    return True, False, False, True  # cmd&4, cmd&2, cmd&8, cmd&1
-
-def EV_IR_FRONT_SIDE_STATE_6(port, cmd):
-    # we use short sensor for wall measurement
-    # left, front, right, front_long
-    return True, True, False, False  # cmd&4, cmd&2, cmd&8, cmd&1
-
-def EV_IR_FRONT_SIDE_STATE_7(port, cmd):
-    # we use short sensor for wall measurement
-    # left, front, right, front_long
-    return True, True, False, True  # cmd&4, cmd&2, cmd&8, cmd&1
-
-def EV_IR_FRONT_SIDE_STATE_8(port, cmd):
-    # we use short sensor for wall measurement
-    # left, front, right, front_long
-    return False, False, True, False  # cmd&4, cmd&2, cmd&8, cmd&1
-
-def EV_IR_FRONT_SIDE_STATE_9(port, cmd):
-    # we use short sensor for wall measurement
-    # left, front, right, front_long
-    return False, False, True, True  # cmd&4, cmd&2, cmd&8, cmd&1
-
-def EV_IR_FRONT_SIDE_STATE_A(port, cmd):
-    # we use short sensor for wall measurement
-    # left, front, right, front_long
-    return False, True, True, False  # cmd&4, cmd&2, cmd&8, cmd&1
-
-def EV_IR_FRONT_SIDE_STATE_B(port, cmd):
-    # we use short sensor for wall measurement
-    # left, front, right, front_long
-    return False, True, True, True  # cmd&4, cmd&2, cmd&8, cmd&1
-
-def EV_IR_FRONT_SIDE_STATE_C(port, cmd):
-    # we use short sensor for wall measurement
-    # left, front, right, front_long
-    return True, False, True, False  # cmd&4, cmd&2, cmd&8, cmd&1
-
-def EV_IR_FRONT_SIDE_STATE_D(port, cmd):
-    # we use short sensor for wall measurement
-    # left, front, right, front_long
-    return True, False, True, True  # cmd&4, cmd&2, cmd&8, cmd&1
-
-def EV_IR_FRONT_SIDE_STATE_E(port, cmd):
-    # we use short sensor for wall measurement
-    # left, front, right, front_long
-    return True, True, True, False  # cmd&4, cmd&2, cmd&8, cmd&1
-
-def EV_IR_FRONT_SIDE_STATE_F(port, cmd):
-    # we use short sensor for wall measurement
-    # left, front, right, front_long
-    return True, True, True, True  # cmd&4, cmd&2, cmd&8, cmd&1
-"""
-
-test_distance_flag = True
-
-def EV_TEST_DISTANCE(port, cmd):
-    #print("Test Distance")
-    ir_state = ord(port.read(1))
-    if ir_state > 0x40 and ir_state < 0x4f:
-        test_distance_flag = True
-        EV_IR_FRONT_SIDE_STATE(port, ir_state)
-    else:
-        print("Test distance without EV_IR_FRONT_SIDE_STATE")
-        raise MajorError
-        
-def EV_SPEED_SAMPLE_00(port, cmd):
-    left = ord(port.read(1))
-    right = ord(port.read(1))
-    print("Speed", left, right)
-
-def EV_SPEED_SAMPLE_01(port, cmd):
-    left = ord(port.read(1))+256
-    right = ord(port.read(1))
-    print("Speed", left, right)
-
-def EV_SPEED_SAMPLE_10(port, cmd):
-    left = ord(port.read(1))
-    right = ord(port.read(1))+256
-    print("Speed", left, right)
-
-def EV_SPEED_SAMPLE_11(port, cmd):
-    left = ord(port.read(1))+256
-    right = ord(port.read(1))+256
-    print("Speed", left, right)
-
-def EV_STEERING_TRIM_REPORT(port, cmd):
-    print("Trim", cmd&0x0F)
-
-config_parameter_read_values = {
-                                0xC5:None,
-                                0xC7:None,
-                                0xC8:None,
-                                0xC9:None,
-                                }
-def EV_CONFIG_PARAMETER_VALUE(port, cmd):
-    subcmd = ord(port.read(1))
-    if subcmd not in config_parameter_read_values:
-        print("INVALID CONFIG PARAMETER VALUE")
-    else:
-        config_parameter_read_values[subcmd] = ord(port.read(1))*256 + ord(port.read(1))
-
-
-acceleration_value = None
-
-def EV_VALUE_FOR_ACCEL(port, cmd):
-    global acceleration_value
-    acceleration_value = ord(port.read(1))*256 + ord(port.read(1))
-
-    
-def get_CF_result(port, subcmd_type):
-    while config_parameter_read_values[subcmd_type] is None:
-        # @todo: Add timeout here (and other wait locations)
-        event_processor(port)
-    
-    return config_parameter_read_values[subcmd_type]
-
-
-def clear_CF_result(subcmd_type):
-    config_parameter_read_values[subcmd_type] = None
-    
-################################################################
-# 
-# Event Processor 
-# 
-
-command_handlers = {
-    0x00: EV_UNKNOWN_RESET,
-    0x01: EV_POWER_ON_RESET,
-    0x02: EV_BROWN_OUT_RESET,
-    0x03: EV_WATCHDOG_RESET,
-    0x04: EV_SOFTWARE_RESET,
-    0x05: EV_EXTERNAL_RESET,
-    0x06: EV_EXCEPTION_RESET,
-
-    0x10: EV_BATTERY_VOLTAGE,   # bit 0 and bit 1 plus extra byte
-    0x11: EV_BATTERY_VOLTAGE,
-    0x12: EV_BATTERY_VOLTAGE,
-    0x13: EV_BATTERY_VOLTAGE,
-    
-    0x20: EV_FINISHED_MOVE,
-    
-    0x21: EV_TEST_DISTANCE,    # single command (but always followed immediately by EV_IR_FRONT_SIDE_STATE)
-
-    0x22: EV_SPEED_SAMPLE_00,
-    0x23: EV_SPEED_SAMPLE_01,
-    0x24: EV_SPEED_SAMPLE_10,
-    0x25: EV_SPEED_SAMPLE_11,
-    0x26: EV_TICKS_PER_MOTOR,
-    
-    0x30: EV_BUTTON_A_RELEASE,
-    0x31: EV_BUTTON_B_RELEASE,
-    0x38: EV_BUTTON_A_PRESS,
-    0x39: EV_BUTTON_B_PRESS,
-
-
-    0x40: EV_IR_FRONT_SIDE_STATE,
-    0x41: EV_IR_FRONT_SIDE_STATE,
-    0x42: EV_IR_FRONT_SIDE_STATE,
-    0x43: EV_IR_FRONT_SIDE_STATE,
-    0x44: EV_IR_FRONT_SIDE_STATE,
-    0x45: EV_IR_FRONT_SIDE_STATE,
-    0x46: EV_IR_FRONT_SIDE_STATE,
-    0x47: EV_IR_FRONT_SIDE_STATE,
-    0x48: EV_IR_FRONT_SIDE_STATE,
-    0x49: EV_IR_FRONT_SIDE_STATE,
-    0x4A: EV_IR_FRONT_SIDE_STATE,
-    0x4B: EV_IR_FRONT_SIDE_STATE,
-    0x4C: EV_IR_FRONT_SIDE_STATE,
-    0x4D: EV_IR_FRONT_SIDE_STATE,
-    0x4E: EV_IR_FRONT_SIDE_STATE,
-    0x4F: EV_IR_FRONT_SIDE_STATE,
-
-    # not really used (except for steering, which is low level code)
-    0x50: EV_IR_45_STATE,
-    0x51: EV_IR_45_STATE,
-    0x52: EV_IR_45_STATE,
-    0x53: EV_IR_45_STATE,
-    0x54: EV_IR_45_STATE,
-    0x55: EV_IR_45_STATE,
-    0x56: EV_IR_45_STATE,
-    0x57: EV_IR_45_STATE,
-    0x58: EV_IR_45_STATE,
-    0x59: EV_IR_45_STATE,
-    0x5A: EV_IR_45_STATE,
-    0x5B: EV_IR_45_STATE,
-    0x5C: EV_IR_45_STATE,
-    0x5D: EV_IR_45_STATE,
-    0x5E: EV_IR_45_STATE,
-    0x5F: EV_IR_45_STATE,
-
-    0x61: EV_IR_FRONT_LEVEL,
-    0x62: EV_L90_LEVEL,
-    0x63: EV_L45_LEVEL,
-    0x64: EV_R90_LEVEL,
-    0x65: EV_R45_LEVEL,
-
-    0x70: EV_STEERING_TRIM_REPORT,
-    0x71: EV_STEERING_TRIM_REPORT,
-    0x72: EV_STEERING_TRIM_REPORT,
-    0x73: EV_STEERING_TRIM_REPORT,
-    0x74: EV_STEERING_TRIM_REPORT,
-    0x75: EV_STEERING_TRIM_REPORT,
-    0x76: EV_STEERING_TRIM_REPORT,
-    0x77: EV_STEERING_TRIM_REPORT,
-    0x78: EV_STEERING_TRIM_REPORT,
-    0x79: EV_STEERING_TRIM_REPORT,
-    0x7A: EV_STEERING_TRIM_REPORT,
-    0x7B: EV_STEERING_TRIM_REPORT,
-    0x7C: EV_STEERING_TRIM_REPORT,
-    0x7D: EV_STEERING_TRIM_REPORT,
-    0x7E: EV_STEERING_TRIM_REPORT,
-    0x7F: EV_STEERING_TRIM_REPORT,
-    
-    # unlocking
-    0xC0: EV_UNLOCK_FROM_LOCK,
-    0xC1: EV_UNLOCK_FROM_UNLOCK,
-    0xC2: EV_LOCK_BY_TIMER,
-    0xC3: EV_LOCK_BY_COMMAND,
-
-    0xCE: EV_VALUE_FOR_ACCEL,
-    0xCF: EV_CONFIG_PARAMETER_VALUE,
-    
-    0x80: EV_POLL_REPLY,
-
-    0xE2: EV_FAIL_INVALID_COMMAND,
-    0xEF: acknowledge_send,  # no intermediate function required, like EV_GOT_INSTRUCTION
-}
-
-
-def event_processor(port):
-    cmd = port.read(1)
-    if len(cmd) != 0:
-        # test port.read(1) is ok
-        if len(cmd) != 1:
-            print("event_processor read not len 1 ERROR")
-            sys.exit(1)
-        #print(cmd, type(cmd))
-        cmd = ord(cmd)
-        if cmd in command_handlers:
-            command_handlers[cmd](port, cmd)
-        else:
-            print("Unknown event", hex(cmd), "ignoring")
-            #recover_from_major_error()
-
-    run_timers(port)
+    def read(self, num_chars):
+        data = self.frame[self.position:self.position+num_chars]
+        self.position += num_chars
+        return data
 
 ################################################################
 # 
 # Control Functions
 #       
 
-# one used originally in mouse
-default_acceleration_table = [
-0x77FC,0x31B3,0x2622,0x2026,0x1C53,0x199B,0x178C,0x15EB,0x1496,0x1378,
-0x1284,0x11B1,0x10F8,0x1054,0x0FC1,0x0F3D,0x0EC5,0x0E57,0x0DF3,0x0D96,
-0x0D40,0x0CF0,0x0CA5,0x0C60,0x0C1E,0x0BE1,0x0BA7,0x0B70,0x0B3C,0x0B0B,
-0x0ADD,0x0AB0,0x0A86,0x0A5D,0x0A36,0x0A11,0x09EE,0x09CC,0x09AB,0x098B,
-0x096D,0x0950,0x0933,0x0918,0x08FE,0x08E4,0x08CC,0x08B4,0x089D,0x0886,
-0x0871,0x085C,0x0847,0x0833,0x0820,0x080D,0x07FB,0x07E9,0x07D7,0x07C7,
-0x07B6,0x07A6,0x0796,0x0787,0x0778,0x0769,0x075B,0x074D,0x073F,0x0732,
-0x0725,0x0718,0x070B,0x06FF,0x06F3,0x06E7,0x06DB,0x06D0,0x06C5,0x06BA,
-0x06AF,0x06A5,0x069A,0x0690,0x0686,0x067C,0x0673,0x0669,0x0660,0x0657,
-0x064E,0x0645,0x063C,0x0634,0x062B,0x0623,0x061B,0x0613,0x060B,0x0603,
-0x05FB,0x05F4,0x05EC,0x05E5,0x05DE,0x05D7,0x05D0,0x05C9,0x05C2,0x05BB,
-0x05B5,0x05AE,0x05A7,0x05A1,0x059B,0x0595,0x058E,0x0588,0x0582,0x057C,
-0x0577,0x0571,0x056B,0x0565,0x0560,0x055A,0x0555,0x0550,0x054A,0x0545,
-0x0540,0x053B,0x0536,0x0531,0x052C,0x0527,0x0522,0x051D,0x0519,0x0514,
-0x050F,0x050B,0x0506,0x0502,0x04FD,0x04F9,0x04F4,0x04F0,0x04EC,0x04E8,
-0x04E3,0x04DF,0x04DB,0x04D7,0x04D3,0x04CF,0x04CB,0x04C7,0x04C3,0x04C0,
-0x04BC,0x04B8,0x04B4,0x04B1,0x04AD,0x04A9,0x04A6,0x04A2,0x049F,0x049B,
-0x0498,0x0494,0x0491,0x048D,0x048A,0x0487,0x0484,0x0480,0x047D,0x047A,
-0x0477,0x0473,0x0470,0x046D,0x046A,0x0467,0x0464,0x0461,0x045E,0x045B,
-0x0458,0x0455,0x0452,0x0450,0x044D,0x044A,0x0447,0x0444,0x0442,0x043F,
-0x043C,0x0439,0x0437,0x0434,0x0431,0x042F,0x042C,0x042A,0x0427,0x0425,
-0x0422,0x0420,0x041D,0x041B,0x0418,0x0416,0x0413,0x0411,0x040E,0x040C,
-0x040A,0x0407,0x0405,0x0403,0x0401,0x03FE,0x03FC,0x03FA,0x03F8,0x03F5,
-0x03F3,0x03F1,0x03EF,0x03ED,0x03EA,0x03E8,0x03E6,0x03E4,0x03E2,0x03E0,
-0x03DE,0x03DC,0x03DA,0x03D8,0x03D6,0x03D4,0x03D2,0x03D0,0x03CE,0x03CC,
-0x03CA,0x03C8,0x03C6,0x03C4,0x03C2,0x03C0,0x03BE,0x03BD,0x03BB,0x03B9,
-0x03B7,0x03B5,0x03B3,0x03B2,0x03B0,0x03AE,0x03AC,0x03AB,0x03A9,0x03A7,
-0x03A5,0x03A4,0x03A2,0x03A0,0x039E,0x039D,0x039B,0x0399,0x0398,0x0396,
-0x0395,0x0393,0x0391,0x0390,0x038E,0x038C,0x038B,0x0389,0x0388,0x0386,
-0x0385,0x0383,0x0381,0x0380,0x037E,0x037D,0x037B,0x037A,0x0378,0x0377,
-0x0375,0x0374,0x0373,0x0371,0x0370,0x036E,0x036D,0x036B,0x036A,0x0368,
-0x0367,0x0366,0x0364,0x0363,0x0362,0x0360,0x035F,0x035D,0x035C,0x035B,
-0x0359,0x0358,0x0357,0x0355,0x0354,0x0353,0x0351,0x0350,0x034F,0x034E,
-0x034C,0x034B,0x034A,0x0348,0x0347,0x0346,0x0345,0x0343,0x0342,0x0341,
-0x0340,0x033F,0x033D,0x033C,0x033B,0x033A,0x0339,0x0337,0x0336,0x0335,
-0x0334,0x0333,0x0332,0x0330,0x032F,0x032E,0x032D,0x032C,0x032B,0x032A,
-0x0328,0x0327,0x0326,0x0325,0x0324,0x0323,0x0322,0x0321,0x0320,0x031E,
-0x031D,0x031C,0x031B,0x031A,0x0319,0x0318,0x0317,0x0316,0x0315,0x0314,
-0x0313,0x0312,0x0311,0x0310,0x030F,0x030E,0x030D,0x030C,0x030B,0x030A,
-0x0309,0x0308,0x0307,0x0306,0x0305,0x0304,0x0303,0x0302,0x0301,0x0300,
-0x02FF,0x02FE,0x02FD,0x02FC,0x02FB,0x02FA,0x02F9,0x02F8,0x02F7,0x02F6,
-0x02F6,0x02F5,0x02F4,0x02F3,0x02F2,0x02F1,0x02F0,0x02EF,0x02EE,0x02ED,
-0x02EC,0x02EC,0x02EB,0x02EA,0x02E9,0x02E8,0x02E7,0x02E6,0x02E5,0x02E5,
-0x02E4,0x02E3,0x02E2,0x02E1,0x02E0,0x02DF,0x02DF,0x02DE,0x02DD,0x02DC,
-0x02DB,0x02DA,0x02DA,0x02D9,0x02D8,0x02D7,0x02D6,0x02D6,0x02D5,0x02D4,
-0x02D3,0x02D2,0x02D1,0x02D1,0x02D0,0x02CF,0x02CE,0x02CE,0x02CD,0x02CC,
-0x02CB,0x02CA,0x02CA,0x02C9,0x02C8,0x02C7,0x02C7,0x02C6,0x02C5,0x02C4,
-0x02C4,0x02C3,0x02C2,0x02C1,0x02C1,0x02C0,0x02BF,0x02BE,0x02BE,0x02BD,
-0x02BC,0x02BB,0x02BB,0x02BA,0x02B9,0x02B9,0x02B8,0x02B7,0x02B6,0x02B6,
-0x02B5,0x02B4,0x02B4,0x02B3,0x02B2,0x02B1,0x02B1,0x02B0,0x02AF,0x02AF,
-0x02AE,0x02AD,0x02AD,0x02AC,0x02AB,0x02AB,0x02AA,0x02A9,0x02A9,0x02A8,
-0x02A7,0x02A7,
-]
-
-def write_acceleration_table(port, table_to_write):
-    if len(table_to_write) != 512:
-        print("Table is not 512 long!")
-        return
-    
-    errors = 0
-    addr = 0
-    while True:
-        if addr < 256:
-            s = b"\xF9"
-        else:
-            s = b"\xFA"
-
-        global acceleration_value
-        acceleration_value = None
-        data = table_to_write[addr]
-        s += bytes([addr & 0xff, data >> 8, data & 0xff])
-        send_message(port, s)
-        
-        while acceleration_value == None:
-            event_processor(port)
-            
-        if acceleration_value != data:
-            print("Error verifying acceleration value", addr, data, acceleration_value)
-            errors += 1
-            if (errors > 20):
-                print("More than 10 Errors")
-                exit(1)
-        else:
-            addr += 1
-            if addr == 512:
-                break
-
-def write_default_acceleration_table(port):
-    write_acceleration_table(port, default_acceleration_table)
-
-
-def wait_for_move_to_finish(port):
-    if verbose: print("Wait for move finished")
-    global move_finished
-    while not move_finished:
-        event_processor(port)
-    move_finished = False
 
-def wait_for_move_to_finish_reading_sensors(port):
-    if verbose: print("Wait for move finished (reading sensors)")
-    global move_finished
-    st = time.time()
-    state = 0
-    while not move_finished:
-        event_processor(port)
-        
-        time_diff = time.time() - st
-        if time_diff > 0.1:
-            if state == 0:
-                get_r45_level(port)
-            else:
-                get_l45_level(port)
-            st = time.time()
-            state = 1 - state
-
-        global ir_l45_level_new
-        global ir_r45_level_new
-        global ir_l45_level
-        global ir_r45_level
-        if ir_l45_level_new:
-            ir_l45_level_new = False
-            print("L45 =", ir_l45_level)
-        if ir_r45_level_new:
-            ir_r45_level_new = False
-            print("R45 =", ir_r45_level)
-
-    move_finished = False
-
-
-
-def wait_for_unlock_to_complete(port):
-    if verbose: print("Waiting for unlock to complete")
-    start_time = read_accurate_time()
-
-    # run one anway
-    event_processor(port)
-    while locked:
-        event_processor(port)
-        if read_accurate_time() > (start_time + 2):
-            return False
-
-    return True
-
-
-def wait_for_poll_reply(port):
-    # @todo: complete this funnction
-    pass
-
-def get_key(port):
-    while True:
-        # always poll events at least once
-        event_processor(port)
-        
-        # check the key queue
-        if keys_in_queue:
-            return keys_in_queue.popleft()
-
-
-    
-def get_wall_info(port):
-    global got_wall_info
-    got_wall_info = False
-    
-    send_get_wall_info(port)
-    while not got_wall_info:
-        event_processor(port)
-    
-    return left_wall_sense, front_short_wall_sense, right_wall_sense
-
-
-def get_45_info(port):
-    global got_45_info
-    got_45_info = False
-    
-    send_get_45_sensor_info(port)
-    while not got_45_info:
-        event_processor(port)
+# The dsPIC's acceleration table is in RAM, so it goes back to the one
+# built into the firmware (default_acceleration_table) when it resets. We
+# keep a list of the tables it might have, and only write the entries
+# that differ from any of them - normally that's just the last one we
+# wrote, which is also saved in ACCELERATION_TABLE_CACHE_FILE. When we
+# start up, or after an error, it might have reset without us seeing the
+# reset event, so the default table is possible as well. None means we
+# know nothing, and the whole table is written.
+ACCELERATION_TABLE_CACHE_FILE = 'acceleration_table.txt'
+ACCEL_WRITES_AHEAD = 8          # writes queued before waiting for echoes
 
+def save_acceleration_table_cache(table):
+    try:
+        with open(ACCELERATION_TABLE_CACHE_FILE, 'w') as f:
+            for value in table:
+                f.write("%d\n" % value)
+    except IOError:
+        pass
 
-def scan_for_walls(port, m, robot_direction, robot_row, robot_column):
-    left, front, right = get_wall_info(port)
-    if verbose: print("Directions LFR =", left, front, right)
-    wall_changed = False
+def update_walls(m, robot_direction, robot_row, robot_column, left, front, right, planner=None):
+    revision = m.wall_revision
+    new_walls = []
     if left and not m.get_left_wall(robot_direction, robot_row, robot_column):
         m.set_left_wall(robot_direction, robot_row, robot_column)
-        wall_changed = True
+        new_walls.append( (robot_direction-1, robot_row, robot_column) )
     if right and not m.get_right_wall(robot_direction, robot_row, robot_column):
         m.set_right_wall(robot_direction, robot_row, robot_column)
-        wall_changed = True
+        new_walls.append( (robot_direction+1, robot_row, robot_column) )
     if front and not m.get_front_wall(robot_direction, robot_row, robot_column):
         m.set_front_wall(robot_direction, robot_row, robot_column)
-        wall_changed = True
-
-    if wall_changed:
-        m.flood_fill_all()
-
-def wait_seconds(port, time):
-    if time < 0:
-        return
-    
-    end_time = read_accurate_time() + time
-    while read_accurate_time() < end_time:
-        event_processor(port)
+        new_walls.append( (robot_direction, robot_row, robot_column) )
+
+    # missing walls are worth knowing about too, for proving the shortest path
+    if not left:
+        m.set_left_wall_known(robot_direction, robot_row, robot_column)
+    if not right:
+        m.set_right_wall_known(robot_direction, robot_row, robot_column)
+    if not front:
+        m.set_front_wall_known(robot_direction, robot_row, robot_column)
+
+    if planner and planner.use_result(robot_direction, robot_row, robot_column, revision, new_walls):
+        # already worked out during the move
+        pass
+    elif new_walls:
+        # only re-flood the cells affected by the new walls
+        m.flood_fill_incremental(new_walls)
+
+    return new_walls
+
+def flood_fill_fastest(m, speed):
+    # time weighted flood fill, costing each move by how long it will take
+    straight_costs = [estimate_move_time(cells * distance_cell, speed) for cells in range(m.size + 1)]
+    turn90_cost = estimate_move_time(distance_turnl90, speed)
+    turn180_cost = estimate_move_time(distance_turn180, speed)
+    m.flood_fill_weighted(straight_costs, turn90_cost, turn180_cost)
+
+# How many cells we can go forward in one move. The cells we pass through
+# must be explored (so we already know their walls) with the route carrying
+# straight on. The last cell can be unexplored, we'll scan it when we stop.
+def cells_to_move_forward(m, direction, row, column):
+    cells = 0
+    while True:
+        if direction == 0:
+            row += 1
+        elif direction == 1:
+            column += 1
+        elif direction == 2:
+            row -= 1
+        else:
+            column -= 1
+        cells += 1
+        if not m.is_explored(row, column):
+            return cells
+        headings = m.get_lowest_directions_against_heading(direction, row, column)
+        if len(headings) == 0 or headings[0] != 0:
+            return cells
 
 def is_shortest_path_explored(m, row, column, direction):
     # do a virtual dry run
@@ -1350,7 +436,7 @@ def is_shortest_path_explored(m, row, column, direction):
     
     while True:
         m.set_mark(row, column)
-        if m.explored[row][column] == False:
+        if not m.is_explored(row, column):
             return (False, row, column)
         
         headings = m.get_lowest_directions_against_heading(direction, row, column)
@@ -1395,18 +481,6 @@ def cell_one_away(m, robot_row, robot_column, unex_row, unex_column):
     else:
         return False
 
-flashing_cal4_led = False
-def do_calibration_LEDs(port, value):
-    send_switch_led_command(port, 1, value & 1)
-    send_switch_led_command(port, 2, value & 2)
-    send_switch_led_command(port, 3, value & 4)
-    if TEXT_SIMULATOR:
-        send_switch_led_command(port, 4, True)
-    else:
-        global flashing_cal4_led
-        send_switch_led_command(port, 4, flashing_cal4_led)
-        flashing_cal4_led = not flashing_cal4_led
-
 IR_threshold_defaults = {
             "front_long_threshold":15,
             "front_short_threshold":50,
@@ -1418,170 +492,6 @@ IR_threshold_defaults = {
             "right_45_too_close_threshold":760,
 }
 
-def set_default_IR_thresholds(port, IR):
-    set_front_long_threshold(port, IR["front_long_threshold"])
-    set_front_short_threshold(port, IR["front_short_threshold"])
-    set_left_side_threshold(port, IR["left_side_threshold"])
-    set_right_side_threshold(port, IR["right_side_threshold"])
-    set_left_45_threshold(port, IR["left_45_threshold"])
-    set_right_45_threshold(port, IR["right_45_threshold"])
-    set_left_45_too_close_threshold(port, IR["left_45_too_close_threshold"])
-    set_right_45_too_close_threshold(port, IR["right_45_too_close_threshold"])
-
-
-def grab_values(target):
-    global ir_front_level_new
-    global ir_l90_level_new
-    global ir_r90_level_new
-    global ir_l45_level_new
-    global ir_r45_level_new
-    
-    global ir_front_level
-    global ir_l90_level
-    global ir_r90_level
-    global ir_l45_level
-    global ir_r45_level
-    
-    if ir_front_level_new:
-        ir_front_level_new = False
-        if 'frmax' not in target or ir_front_level > target['frmax']:
-            target['frmax'] = ir_front_level
-        if 'frmin' not in target or ir_front_level < target['frmin']:
-            target['frmin'] = ir_front_level
-        if 'frcount' not in target:
-            target['frcount'] = 1
-        else:
-            target['frcount'] += 1
-        
-    if ir_l90_level_new:
-        ir_l90_level_new = False
-        if 'l90max' not in target or ir_l90_level > target['l90max']:
-            target['l90max'] = ir_l90_level
-        if 'l90min' not in target or ir_l90_level < target['l90min']:
-            target['l90min'] = ir_l90_level
-        if 'l90count' not in target:
-            target['l90count'] = 1
-        else:
-            target['l90count'] += 1
-
-    if ir_r90_level_new:
-        ir_r90_level_new = False
-        if 'r90max' not in target or ir_r90_level > target['r90max']:
-            target['r90max'] = ir_r90_level
-        if 'r90min' not in target or ir_r90_level < target['r90min']:
-            target['r90min'] = ir_r90_level
-        if 'r90count' not in target:
-            target['r90count'] = 1
-        else:
-            target['r90count'] += 1
-        
-    if ir_l45_level_new:
-        ir_l45_level_new = False
-        if 'l45max' not in target or ir_l45_level > target['l45max']:
-            target['l45max'] = ir_l45_level
-        if 'l45min' not in target or ir_l45_level < target['l45min']:
-            target['l45min'] = ir_l45_level
-        if 'l45count' not in target:
-            target['l45count'] = 1
-        else:
-            target['l45count'] += 1
-
-    if ir_r45_level_new:
-        ir_r45_level_new = False
-        if 'r45max' not in target or ir_r45_level > target['r45max']:
-            target['r45max'] = ir_r45_level
-        if 'r45min' not in target or ir_r45_level < target['r45min']:
-            target['r45min'] = ir_r45_level
-        if 'r45count' not in target:
-            target['r45count'] = 1
-        else:
-            target['r45count'] += 1
-
-
-left_count = {}
-right_count = {}
-far_left_count = {}
-far_right_count = {}
-middle_count = {}
-front_center = {}
-front_long_count = {}
-cal_IR = {}
-
-def calibration_for_position(port, read_data, position_store):
-    if read_data:
-        c = position_store
-        grab_values(c)
-        if c['r90count'] >= 10 and c['r45count'] >= 10 and c['l90count'] >= 10 and c['l45count'] >= 10 and c['frcount'] >= 10:
-            return True
-    return False
-
-def calculate_and_configure(port, read_data, _):
-    global left_count
-    global right_count
-    global far_left_count
-    global far_right_count
-    global middle_count
-    global front_center
-    global front_long_count
-    #print(left_count)
-    #print(right_count)
-    #print(middle_count)
-    #print(front_center)
-    #print(front_long_count)
-    try:
-        with open('cal_raw_data_%s.txt' % datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S'), 'w') as f:
-            f.write("\nfar left\n")
-            f.write(str(far_left_count))
-            f.write("left\n")
-            f.write(str(left_count))
-            f.write("\nmiddle\n")
-            f.write(str(middle_count))
-            f.write("\nright\n")
-            f.write(str(right_count))
-            f.write("\nfar right\n")
-            f.write(str(far_right_count))
-
-            f.write("\n\nfront\n")
-            f.write(str(front_center))
-            f.write("\nfront long\n")
-            f.write(str(front_long_count))
-    except IOError:
-        pass
-    
-    #
-    # We will need to test these on a real mouse
-    #
-    # diagonal
-    # for too close we select 2/3 and for a bit close 1/3
-    # between 1cm away and middle
-    l45_diff = left_count['l45max'] - middle_count['l45min']
-    r45_diff = right_count['r45max'] - middle_count['r45min']
-    cal_IR["left_45_threshold"] = int(l45_diff/ 2.0 ) + middle_count['l45min']
-    cal_IR["right_45_threshold"] = int(r45_diff / 2.0) + middle_count['r45min']
-    cal_IR["left_45_too_close_threshold"] = int(l45_diff/ 1.4 ) + middle_count['l45min']
-    cal_IR["right_45_too_close_threshold"] = int(r45_diff / 1.4) + middle_count['r45min']
-
-    # wall detect - detect over other side
-    cal_IR["left_side_threshold"] = far_right_count['l90min']
-    cal_IR["right_side_threshold"] = far_left_count['r90min']
-    
-    # front wall
-    cal_IR["front_long_threshold"] = front_long_count['frmin']
-    cal_IR["front_short_threshold"] = front_center['frmin']
-
-    set_default_IR_thresholds(port, cal_IR)
-    return True
-
-def calibration_test(port, read_data, _):
-    # if True, then exit, otherwise just wait by returning False...
-    return read_data
-
-
-def calibration_save_and_quit(port, read_data, _):
-    print("Save calibration")
-    write_config_file('calibration.txt', cal_IR)
-    return None
-
 
 def read_config_file(filename, key_value_map):
     try:
@@ -1610,444 +520,2064 @@ def write_config_file(filename, key_value_map):
     except IOError:
         pass
 
+################################################################
+# 
+# Mouse Controller
+#
+# Everything we know about the mouse (what it has said, what we have sent,
+# what we are waiting for) is in here, so more than one can run at once
+# (e.g. simulated mice in threads) and starting again after an error is
+# just making a new one. The settings above are shared.
+#
+class MouseController(object):
 
-def load_IR_calibration(port):
-    read_config_file('calibration.txt', IR_threshold_defaults)
-    set_default_IR_thresholds(port, IR_threshold_defaults)
-
-
-def do_calibration(port):
-    print("Start Calibration")
-
-    global ir_front_level_new
-    global ir_l90_level_new
-    global ir_r90_level_new
-    global ir_l45_level_new
-    global ir_r45_level_new
-    ir_front_level_new = False
-    ir_l90_level_new = False
-    ir_r90_level_new = False
-    ir_l45_level_new = False
-    ir_r45_level_new = False
-
-    global left_count
-    global right_count
-    global far_left_count
-    global far_right_count
-    global middle_count
-    global front_center
-    global front_long_count
-    left_count = {}
-    right_count = {}
-    middle_count = {}
-    front_center = {}
-    front_long_count = {}
-    far_left_count = {}
-    far_right_count = {}
-
-    cal_dispatcher = [
-        (calibration_for_position, "Move to 0cm from left wall", far_left_count),
-        (calibration_for_position, "Move to 1.5cm from left wall", left_count),
-        (calibration_for_position, "Move to middle between left and right walls", middle_count),
-        (calibration_for_position, "Move to 1.5cm from right wall", right_count),
-        (calibration_for_position, "Move to 0cm from right wall", far_right_count),
-        (calibration_for_position, "Move to furthest away from front wall but most of robot in cell", front_center),
-        (calibration_for_position,  "Move front of mouse to 1 cell away from front wall", front_long_count),
-        (calculate_and_configure, "Calculating calibration", None),
-        (calibration_test, "Test sensor LEDs now", None),
-        (calibration_save_and_quit, "Saving sensor calibration", None),
-    ]
-
-
-    start = read_accurate_time()
-    turn_on_ir(port)
-    
-    update_state = 1
-    cal_state = 0
-    print(cal_dispatcher[cal_state][1])
-    read_data = False
-    flash = True
-    while True:
-        if (read_accurate_time() - start) > 0.05:
-            if update_state == 1:
-                get_front_level(port)
-            elif update_state == 2:
-                get_l90_level(port)
-                get_r90_level(port)
-            elif update_state == 3:
-                get_l45_level(port)
-                get_r45_level(port)
+    def __init__(self, port, serial_reader=None):
+        self.port = port
+        # if use_serial_reader_thread is on, see set_up_port()
+        self.serial_reader = serial_reader
+        # bytes read from the serial port, but not handled yet
+        self.receive_buffer = bytearray()
+        self.serial_read_calls = 0
+        self.event_handlers = dict((cmd, handler.__get__(self))
+                                   for cmd, handler in self.command_handlers.items())
+
+        self.move_finished = False
+        self.battery_voltage = 17
+        self.minimum_battery_voltage = self.battery_voltage
+        self.battery_voltage_mode = 0 # 0 = ok, 1 = low voltage, 2 = shutdown
+        self.battery_voltage_count = BATT_VOLTAGE_COUNT
+        self.battery_voltage_array = []
+
+        self.maze_selected = 5   # should be 5 or 16
+        self.keys_in_queue = deque()
+        self.key_A_start_time = None
+        self.key_B_start_time = None
+
+        # flow control, see queue_message()
+        self.sent_bytes_in_flight = 0
+        self.messages_in_flight_queue = deque()
+        self.flight_queue_full = False
+        self.outgoing_queue = deque()    # (message, time queued)
+        self.queued_bytes = 0
+
+        # flow control statistics, see print_flow_stats()
+        self.flow_stats_start_time = read_accurate_time()
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.max_queue_depth = 0
+        self.queue_wait_time = 0.0       # total time messages waited for room in the window
+        self.send_stall_time = 0.0       # total time send_message() waited for the queue
+        self.ack_count = 0
+        self.ack_time_total = 0.0
+        self.ack_time_max = 0.0
+
+        # write cache, see flush_pending_writes()
+        self.led_states_wanted = 0
+        self.led_states_sent = 0
+        self.led_states_known = 0        # LEDs where we know what the dsPIC has
+        self.led_states_dirty = 0        # LEDs written since the last flush
+        self.ir_state_wanted = None
+        self.ir_state_sent = None
+        self.speed_wanted = None
+        self.speed_sent = None
+        self.write_bytes_requested = 0   # what would have been sent without the cache
+        self.write_bytes_sent = 0
+
+        self.timer_next_end_time = read_accurate_time()+1
+        sim_clock.wake_at(self.timer_next_end_time)
+        self.battery_count = 10
+        self.execution_state_LED6 = True
+
+        self.ir_front_level = 0
+        self.ir_front_level_new = False
+        self.ir_l90_level = 0
+        self.ir_l90_level_new = False
+        self.ir_l45_level = 0
+        self.ir_l45_level_new = False
+        self.ir_r90_level = 0
+        self.ir_r90_level_new = False
+        self.ir_r45_level = 0
+        self.ir_r45_level_new = False
+        # see EV_ALL_SENSOR_STATE
+        self.sensor_snapshot = None
+        self.sensor_snapshot_new = False
+        # keep every IR level, speed sample and tick report (not just the
+        # last) in ring buffers for steering tuning, if NumPy is installed
+        if capture_sensors and SensorCapture is not None:
+            self.sensor_capture = SensorCapture()
+        else:
+            self.sensor_capture = None
+
+        self.locked = True
+
+        self.got_wall_info = False
+        self.left_wall_sense = False
+        self.right_wall_sense = False
+        self.front_short_wall_sense = False
+        self.front_long_wall_sense = False
+
+        self.got_45_info = False
+        self.left_45_sense = False
+        self.right_45_sense = False
+        self.left_45_too_close_sense = False
+        self.right_45_too_close_sense = False
+
+        self.test_distance_flag = True
+
+        self.config_parameter_read_values = {
+                                        0xC5:None,
+                                        0xC7:None,
+                                        0xC8:None,
+                                        0xC9:None,
+                                        }
+
+        self.acceleration_value = None
+        # (address, value) of each acceleration table write waiting for its
+        # EV_VALUE_FOR_ACCEL. They come back in the order they were sent.
+        self.acceleration_writes_pending = deque()
+        self.acceleration_write_failures = []
+        # see load_acceleration_table_cache()
+        self.acceleration_tables_possible = None
+
+        self.flashing_cal4_led = False
+        self.cal_engine = None
+        self.cal_IR = {}
+
+        # seconds, from the last run_program()
+        self.search_time = None
+        self.speed_run_time = None
+
+    # This function manages the saving of battery data
+    def save_battery_data(self, flush_all_data, battery_voltage):
+        if log_battery_voltage:
+
+            if battery_voltage is not None:
+                self.battery_voltage_array.append( (time.time(), battery_voltage) )
+
+            if flush_all_data or len(self.battery_voltage_array) >= 200:
+                with open(battery_filename, "a") as f:
+                    for item in self.battery_voltage_array:
+                        f.write("%f, %s\n" % (item[0], item[1]))
+                self.battery_voltage_array = []
+
+    # Queue a message, and send what we can. Doesn't wait.
+    def queue_message(self, message):
+        self.outgoing_queue.append((message, read_accurate_time()))
+        self.queued_bytes += len(message)
+        self.max_queue_depth = max(self.max_queue_depth, len(self.outgoing_queue))
+        self.fill_send_window()
+
+    # Send queued messages while they fit in the window
+    def fill_send_window(self):
+        while self.outgoing_queue and self.sent_bytes_in_flight + len(self.outgoing_queue[0][0]) <= SEND_WINDOW_BYTES:
+            message, queued_time = self.outgoing_queue.popleft()
+            ml = len(message)
+            time_now = read_accurate_time()
+            self.queue_wait_time += time_now - queued_time
+            self.queued_bytes -= ml
+            self.sent_bytes_in_flight += ml
+            self.messages_in_flight_queue.append((ml, time_now))
+            self.messages_sent += 1
+            self.bytes_sent += ml
+            self.port.write(message)
+            # @todo: should we check number of bytes written?
+        self.flight_queue_full = len(self.outgoing_queue) != 0
+
+    def send_message(self, message):
+        # anything cached goes first, to keep the order
+        self.flush_pending_writes()
+        self.send_message_now(message)
+
+    def send_message_now(self, message):
+        if hasattr(self.port, "queue_message"):
+            # the asyncio runtime (mouse_async.py) does the waiting itself
+            self.port.queue_message(message)
+            return
+
+        # run as many as we can until we are empty
+        while self.events_waiting():
+            self.event_processor(False)
+
+        self.queue_message(message)
+
+        if self.queued_bytes > MAX_QUEUED_BYTES:
+            stall_start = read_accurate_time()
+            end_time = stall_start + 0.1
+            while self.queued_bytes > MAX_QUEUED_BYTES:
+                self.event_processor()
+                if read_accurate_time() > end_time:
+                    print("Waited for response - we should do something")
+                    end_time = read_accurate_time() + 1
+            self.send_stall_time += read_accurate_time() - stall_start
+
+    # Wait until everything queued has been sent
+    def flush_send_queue(self):
+        while self.outgoing_queue:
+            self.event_processor()
+
+    def acknowledge_send(self, event, cmd):
+        try:
+            count, sent_time = self.messages_in_flight_queue.popleft()
+        except IndexError:
+            print("Got acknowledge send without anything in message_in_flight_queue - Ignoring")
+            count = 0
+            #recover_from_major_error()
+        else:
+            round_trip = read_accurate_time() - sent_time
+            self.ack_count += 1
+            self.ack_time_total += round_trip
+            self.ack_time_max = max(self.ack_time_max, round_trip)
+
+        self.sent_bytes_in_flight -= count
+        self.fill_send_window()
+
+    def reset_message_queue(self):
+        self.sent_bytes_in_flight = 0
+        self.messages_in_flight_queue.clear()
+        self.outgoing_queue.clear()
+        self.queued_bytes = 0
+        self.flight_queue_full = False
+        self.invalidate_write_cache()
+
+    def print_flow_stats(self):
+        elapsed = max(read_accurate_time() - self.flow_stats_start_time, 0.001)
+        # 57600 baud with start and stop bits is 5760 bytes a second
+        print("Sent %d messages, %d bytes, %.0f bytes/s (%.1f%% of 57600 baud)" %
+              (self.messages_sent, self.bytes_sent, self.bytes_sent / elapsed, self.bytes_sent * 100.0 / elapsed / 5760))
+        print("Max queue depth %d, queue wait %.3f s, send stall %.3f s" %
+              (self.max_queue_depth, self.queue_wait_time, self.send_stall_time))
+        if self.ack_count:
+            print("Ack round trip average %.1f ms, max %.1f ms" %
+                  (self.ack_time_total * 1000 / self.ack_count, self.ack_time_max * 1000))
+
+    def send_unlock_command(self):
+        if verbose: print("Send Unlock")
+        self.send_message(b'\xFE\xFC\xF8\xFE')
+        # the dsPIC sets its own LED patterns while locked, and may have reset
+        self.invalidate_write_cache()
+
+
+    def send_poll_command(self):
+        if verbose: print("Send Poll")
+        self.send_message(b'\x80')
+
+    # forget what we think the dsPIC has, so everything is sent again
+    def invalidate_write_cache(self):
+        self.led_states_known = 0
+        self.ir_state_sent = None
+        self.speed_sent = None
+
+    def _write_cached(self, nbytes):
+        self.write_bytes_requested += nbytes
+        if not coalesce_writes:
+            self.flush_pending_writes()
+
+    def flush_pending_writes(self):
+        # sending can run event_processor(), which flushes again, so the
+        # cache is updated before each send
+        if self.led_states_dirty:
+            changed = self.led_states_dirty & ((self.led_states_wanted ^ self.led_states_sent) | ~self.led_states_known | DSPIC_DRIVEN_LEDS)
+            use_pattern = bin(changed).count("1") > 2 and (self.led_states_known | changed) == ALL_LEDS
+            self.led_states_dirty = 0
+            self.led_states_sent = (self.led_states_sent & ~changed) | (self.led_states_wanted & changed)
+            self.led_states_known |= changed
+            if use_pattern:
+                # one 2 byte pattern command is shorter
+                self.write_bytes_sent += 2
+                self._send_led_pattern(self.led_states_sent)
             else:
-                update_state = 0
-                flash = not flash
-                if read_data and flash:
-                    do_calibration_LEDs(port, 0)
-                else:
-                    do_calibration_LEDs(port, cal_state + 1)
+                for led in range(1, 10):
+                    bit = 1 << (led - 1)
+                    if changed & bit:
+                        self.write_bytes_sent += 1
+                        self._send_switch_led(led, self.led_states_sent & bit)
+
+        if self.ir_state_wanted is not None and self.ir_state_wanted != self.ir_state_sent:
+            self.ir_state_sent = self.ir_state_wanted
+            self.write_bytes_sent += 1
+            self.send_message_now(b"\xD1" if self.ir_state_sent else b"\xD0")
+
+        if self.speed_wanted is not None and self.speed_wanted != self.speed_sent:
+            self.speed_sent = self.speed_wanted
+            self.write_bytes_sent += 3
+            self.send_message_now(bytes([0xC4, self.speed_sent >> 8, self.speed_sent & 0xff]))
+
+    def print_write_cache_stats(self):
+        print("Write cache: %d bytes asked for, %d sent, %d saved" %
+              (self.write_bytes_requested, self.write_bytes_sent, self.write_bytes_requested - self.write_bytes_sent))
+
+    def _send_switch_led(self, led, on):
+        if on:
+            command = 0x10 + led
+            #if verbose: print("Switch LED", led, "on")
+        else:
+            #if verbose: print("Switch LED", led, "off")
+            command = 0x00 + led
 
-            update_state += 1
-            
-            start = read_accurate_time()
-
-        # do the testing
-        entry = cal_dispatcher[cal_state]
-        need_step = entry[0](port, read_data, entry[2])
-        if need_step is None:
-            break
-        elif need_step:
-            read_data = False
-            cal_state += 1
-            print(cal_dispatcher[cal_state][1])
-
-        if keys_in_queue:
-            key = get_key(port)
-            if key == "a":
-                read_data = True
-                
-            elif key == 'B' or key == 'b':
-                # exit early key
-                # return IR to old levels
-                set_default_IR_thresholds(port, IR_threshold_defaults)
-                break
+        self.send_message_now(bytes([command]))
 
-    print("Exit Calibration")
-    turn_off_all_LEDs(port)
-    turn_off_ir(port)
+    def _send_led_pattern(self, led_states):
+        # 0x20 = CMD_TYPE_ALL_LEDS - extra byte (leds 1-8, led 9-bit 0 of cmd byte)
+        leds_1to8 = led_states & 0xFF
+        cmd_and_led_9 = 0x20 + ((led_states >> 8) & 1)
+        self.send_message_now(bytes([cmd_and_led_9, leds_1to8]))
 
-def do_test_mode(port):
-    print("Start Test")
-    start = read_accurate_time()
-    set_speed(port, search_speed)    # normal search speed
-    turn_on_ir(port)
-    
-    wait_to_go = None
-    flash = True
-    mode = 0
-    while True:
-        if (read_accurate_time() - start) > 0.2:
-            flash = not flash
-            send_switch_led_command(port, 1, flash)
-            if mode != 3:
-                send_switch_led_command(port, 2, flash)
-            if mode == 1 or mode == 3:
-                send_switch_led_command(port, 3, flash)
-            elif mode == 2:
-                send_switch_led_command(port, 4, flash)
-
-            if wait_to_go is not None:
-                wait_to_go -= 1
-                if wait_to_go == 0:
-                    wait_to_go = None
-                    
-                    if mode == 0:
-                        move_forward(port, distance_cell)
-                        wait_for_move_to_finish(port)
-                        turn_off_motors(port)
-                    elif mode == 1:
-                        turn_off_ir(port)
-                        move_right(port, distance_turnr90)
-                        wait_for_move_to_finish(port)
-                        turn_off_motors(port)
-                        turn_on_ir(port)
-                    elif mode == 2:
-                        turn_off_ir(port)
-                        move_left(port, distance_turnr90)
-                        wait_for_move_to_finish(port)
-                        turn_off_motors(port)
-                        turn_on_ir(port)
-                    elif mode == 3:
-                        while not keys_in_queue:
-                            get_wall_info(port)
-                            get_45_info(port)
-
-                            if left_wall_sense: L = "L<"
-                            else: L = "  "
-                            send_switch_led_command(port, 5, left_wall_sense)
-                            if right_wall_sense: R = ">R"
-                            else: R = "  "  
-                            send_switch_led_command(port, 2, right_wall_sense)
-
-                            if front_short_wall_sense: FS = "_FS_"
-                            else: FS = "    "
-                            send_switch_led_command(port, 1, front_short_wall_sense)
-                            if front_long_wall_sense: FL = "^FL^"
-                            else: FL = "    "
-
-                            wait_seconds(port, 0.1)
-
-                            if left_45_sense: L45 = "\\"
-                            else: L45 = " "
-                            if right_45_sense: R45 = "/"
-                            else: R45 = " "
-
-                            if left_45_too_close_sense: LS45 = "\\"
-                            else: LS45 = " "
-                            send_switch_led_command(port, 4, left_45_too_close_sense)
-                            if right_45_too_close_sense: RS45 = "/"
-                            else: RS45 = " "
-                            send_switch_led_command(port, 3, right_45_too_close_sense)
-
-                            print(L + L45 + LS45 + FS + FL + RS45 + R45 + R)
-                           
-                            wait_seconds(port, 0.2)
-
-                        # ignore this key
-                        get_key(port)
-                        
-            start = read_accurate_time()
-
-        if keys_in_queue:
-            key = get_key(port)
-            turn_off_all_LEDs(port)
-            if key == "a":
-                wait_to_go = 5
-            elif key == 'b':
-                mode += 1
-                if mode == 4:
-                    mode = 0
-            elif key == 'B' or key == 'b':
-                # exit key
-                break
+    def send_switch_led_command(self, led, on):
+        bit = 1 << (led - 1)
+        if on:
+            self.led_states_wanted |= bit
+        else:
+            self.led_states_wanted &= ~bit
+        self.led_states_dirty |= bit
+        self._write_cached(1)
 
-    turn_off_all_LEDs(port)
-    turn_off_ir(port)
-    print("End Test")
 
-################################################################
-#
-# Control Loop
-#
+    def send_led_pattern_command(self, led_states):
+        self.led_states_wanted = led_states & ALL_LEDS
+        self.led_states_dirty = ALL_LEDS
+        self._write_cached(2)
 
-def run_program(port):
+    def turn_off_all_LEDs(self):
+        self.send_led_pattern_command(0);
 
-    while True:
-        send_unlock_command(port)
-        if wait_for_unlock_to_complete(port):
-            break
-        print("Unlock failed - Retrying")
 
-    turn_off_all_LEDs(port)
-    turn_off_motors(port)
-    turn_off_ir(port)
+    def turn_off_motors(self):
+        if verbose: print("Turn off motors")
+        self.send_message(b"\xC0")
 
-    set_default_distances(port)
-    load_IR_calibration(port)
+    def move_forward(self, distance):
+        self.move_finished = False
 
-    #write_default_acceleration_table(port)
+        if verbose: print("Forward")
+        s = bytes([0xC1, distance >> 8, distance & 0xff])
+        self.send_message(s)
 
-    global maze_selected
-    calibration_mode = False
-    test_mode = False
-    while True:
+    def move_right(self, distance):
+        self.move_finished = False
+
+        if verbose: print("right")
+        s = bytes([0xC2, distance >> 8, distance & 0xff])
+        self.send_message(s)
+
+    def move_left(self, distance):
+        self.move_finished = False
+
+        if verbose: print("left")
+        s = bytes([0xC3, distance >> 8, distance & 0xff])
+        self.send_message(s)
+
+    def turn_on_ir(self):
+        if verbose: print("IR on")
+        self.ir_state_wanted = True
+        self._write_cached(1)
+
+    def turn_off_ir(self):
+        if verbose: print("IR off")
+        self.ir_state_wanted = False
+        self._write_cached(1)
+
+
+    def set_speed(self, speed):
+        if verbose: print("set speed", speed)
+        self.speed_wanted = speed
+        self._write_cached(3)
+
+    def send_get_wall_info(self):
+        if verbose: print("Get wall IR")
+        self.send_message(b"\x98")
+
+    def send_get_45_sensor_info(self):
+        if verbose: print("Get 45 IR")
+        self.send_message(b"\x99")
+
+    def get_front_level(self):
+        self.send_message(b"\x9A")
+
+    def get_l90_level(self):
+        self.send_message(b"\x9B")
+
+    def get_l45_level(self):
+        self.send_message(b"\x9C")
+
+    def get_r90_level(self):
+        self.send_message(b"\x9D")
+
+    def get_r45_level(self):
+        self.send_message(b"\x9E")
+
+    def send_get_sensor_snapshot(self):
+        if verbose: print("Get sensor snapshot")
+        self.send_message(b"\x90")
+
+
+    def set_steering_correction(self, distance):
+        if verbose: print("set steering correction distance", distance)
+        s = bytes([0xC5, distance >> 8, distance & 0xff])
+        self.send_message(s)
+
+    def extend_movement(self):
+        if verbose: print("extent movement")
+        self.send_message(b"\xC6")
+
+    def set_cell_distance(self, distance):
+        if verbose: print("set_cell_distance", distance)
+        s = bytes([0xC7, distance >> 8, distance & 0xff])
+        self.send_message(s)
+
+    def set_wall_edge_correction(self, distance):
+        if verbose: print("set_wall_edge_correction", distance)
+        s = bytes([0xC8, distance >> 8, distance & 0xff])
+        self.send_message(s)
+
+    def set_distance_to_test(self, distance):
+        if verbose: print("set_distance_to_test", distance)
+        s = bytes([0xC9, distance >> 8, distance & 0xff])
+        self.send_message(s)
+
+
+    #
+    # IR commands
+    #
+    def set_front_long_threshold(self, threshold):
+        if verbose: print("set_front_long_threshold", threshold)
+        s = bytes([0xD8, threshold >> 8, threshold & 0xff])
+        self.send_message(s)
+
+    def set_front_short_threshold(self, threshold):
+        if verbose: print("set_front_short_threshold", threshold)
+        s = bytes([0xD9, threshold >> 8, threshold & 0xff])
+        self.send_message(s)
+
+    def set_left_side_threshold(self, threshold):
+        if verbose: print("set_left_side_threshold", threshold)
+        s = bytes([0xDA, threshold >> 8, threshold & 0xff])
+        self.send_message(s)
+
+    def set_right_side_threshold(self, threshold):
+        if verbose: print("set_right_side_threshold", threshold)
+        s = bytes([0xDB, threshold >> 8, threshold & 0xff])
+        self.send_message(s)
+
+    def set_left_45_threshold(self, threshold):
+        if verbose: print("set_left_45_threshold", threshold)
+        s = bytes([0xDC, threshold >> 8, threshold & 0xff])
+        self.send_message(s)
+
+    def set_right_45_threshold(self, threshold):
+        if verbose: print("set_right_45_threshold", threshold)
+        s = bytes([0xDD, threshold >> 8, threshold & 0xff])
+        self.send_message(s)
+
+    def set_left_45_too_close_threshold(self, threshold):
+        if verbose: print("set_left_45_too_close_threshold", threshold)
+        s = bytes([0xDE, threshold >> 8, threshold & 0xff])
+        self.send_message(s)
+
+    def set_right_45_too_close_threshold(self, threshold):
+        if verbose: print("set_right_45_too_close_threshold", threshold)
+        s = bytes([0xDF, threshold >> 8, threshold & 0xff])
+        self.send_message(s)
+
+    def get_steering_correction(self):
+        if verbose: print("get steering correction distance")
+        self.clear_CF_result(0xC5)
+        s = b"\xCF\xC5"
+        self.send_message(s)
+        return self.get_CF_result(0xC5)
+
+    def get_cell_distance(self):
+        if verbose: print("get_cell_distance")
+        self.clear_CF_result(0xC7)
+        s = b"\xCF\xC7"
+        self.send_message(s)
+        return self.get_CF_result(0xC7)
+
+    def get_wall_edge_correction(self):
+        if verbose: print("get_wall_edge_correction")
+        self.clear_CF_result(0xC8)
+        s = b"\xCF\xC8"
+        self.send_message(s)
+        return self.get_CF_result(0xC8)
+
+    def get_distance_to_test(self):
+        if verbose: print("get_distance_to_test")
+        self.clear_CF_result(0xC9)
+        s = b"\xCF\xC9"
+        self.send_message(s)
+        return self.get_CF_result(0xC9)
+
+    def check_distances_are_set_correctly(self):
+        if self.get_steering_correction() != steering_correction_value:
+            print("get_steering_correction() didn't return expected value")
+            return False
+        if self.get_cell_distance() != distance_cell:
+            print("get_cell_distance() didn't return expected value")
+            return False
+        if self.get_wall_edge_correction() != wall_edge_correction_factor:
+            print("get_wall_edge_correction() didn't return expected value")
+            return False
+        if self.get_distance_to_test() != distance_to_test_value:
+            print("get_distance_to_test() didn't return expected value")
+            return False
+
+        return True
+
+    def set_default_distances(self):
+
+        success = False
+        for _ in range(10):
+        #self.set_speed(speed)
+            self.set_steering_correction(steering_correction_value)           # might need to fixed for higher speeds
+            self.set_cell_distance(distance_cell)      # 
+            self.set_wall_edge_correction(wall_edge_correction_factor)
+            self.set_distance_to_test(distance_to_test_value)
+
+            if self.check_distances_are_set_correctly():
+                success = True
+                break
+
+        if not success:
+            print("Failed to set values 10 times :-(")
+
+    def run_timers(self):
+        time_now = read_accurate_time()
+        if time_now >= self.timer_next_end_time:
+
+            # notice: time slip possible here, no 'catchup' attempted.
+            self.timer_next_end_time = read_accurate_time() + self.timer_tick()
+            sim_clock.wake_at(self.timer_next_end_time)
+
+    # LED6 heartbeat and battery report. Returns the time to the next tick.
+    def timer_tick(self):
+        if self.battery_voltage_mode == 0:
+            # no problem
+            next_tick = 1
+        else:
+            # fast flash if problem
+            next_tick = 0.125
+
+        # only do this if we are not running full already...
+        if not self.flight_queue_full and not TEXT_SIMULATOR:
+            # we hard code a function here, for the moment
+            self.send_switch_led_command(6, self.execution_state_LED6)
+            self.execution_state_LED6 = not self.execution_state_LED6
+
+        self.battery_count -= 1
+        if self.battery_count <= 0:
+            print("Batt V", self.battery_voltage, "cell:", self.battery_voltage/4.0, "min:", self.minimum_battery_voltage)
+            self.battery_count = 10
+
+        return next_tick
+
+    ################################################################
+    # 
+    # Recieved Event Functions
+    # 
+    def EV_UNKNOWN_RESET(self, event, cmd):
+        print("Unknown Reset")
+        raise SoftReset
+    def EV_POWER_ON_RESET(self, event, cmd):
+        print("Power On Reset")
         if snoop_serial_data:
-            port.save_all()
+            self.port.print_all()
+        recover_from_major_error()
+    def EV_BROWN_OUT_RESET(self, event, cmd):
+        print("Brown Out Reset")
+        recover_from_major_error()
+    def EV_WATCHDOG_RESET(self, event, cmd):
+        print("Watchdog Reset")
+        recover_from_major_error()
+    def EV_SOFTWARE_RESET(self, event, cmd):
+        print("Software Reset")
+        recover_from_major_error()
+    def EV_EXTERNAL_RESET(self, event, cmd):
+        print("External Reset")
+        raise SoftReset
+
+    def EV_EXCEPTION_RESET(self, event, cmd):
+        print("Exception Reset")
+        recover_from_major_error()
+
+
+    def EV_BATTERY_VOLTAGE(self, event, cmd):
+        ADC_reading = event.read(1)
+        ADClen = len(ADC_reading)
+        if ADClen != 1:
+            if ADClen == 0:
+                print("Didn't get second byte of battery voltage")
+                recover_from_major_error()
+            else:
+                print("More than one byte in voltage")
+                recover_from_major_error()
+
+        ADC_reading = ord(ADC_reading) + 256 * (cmd & 0x03)
+
+        # potential divider is 33K and 12K. This does into an ADC where the reference is approx. 5v.
+        self.battery_voltage = ADC_reading * battery_voltage_conversion
+        #print("Batt V", voltage, "cell:", voltage/4)
+
+
+        # figure out the warnings and 
+
+        self.save_battery_data(False, self.battery_voltage)
+        if self.battery_voltage < self.minimum_battery_voltage:
+            self.minimum_battery_voltage = self.battery_voltage
+
+        potential_mode = 0
+        if self.battery_voltage <= BATTERY_VOLTAGE_WARNING:
+            potential_mode = 1
+            if self.battery_voltage <= BATTERY_VOLTAGE_SHUTDOWN:
+                potential_mode = 2
+
+            # we only go one way... don't allow increases to 
+            # reset the warnings or shutdown!
+            if  potential_mode > self.battery_voltage_mode:
+                self.battery_voltage_count -= 1
+                if self.battery_voltage_count <= 0:
+                    # become a higher mode
+                    # two passes are required to reach shutdown!
+                    self.battery_voltage_mode += 1
+                    self.battery_voltage_count = BATT_VOLTAGE_COUNT
+                    # shutdown the Raspberry Pi
+                    if self.battery_voltage_mode == 1:
+                        print("Battery Low.      Batt V", self.battery_voltage, "cell:", self.battery_voltage/4.0)
+                    elif self.battery_voltage_mode == 2:
+                        raise ShutdownRequest
+            else:
+                self.battery_voltage_count = BATT_VOLTAGE_COUNT
+
+    def EV_IR_FRONT_LEVEL(self, event, cmd):
+        self.ir_front_level = ord(event.read(1))*256
+        self.ir_front_level += ord(event.read(1))
+        if verbose: print("IR Front level", self.ir_front_level)
+        if self.sensor_capture is not None:
+            self.sensor_capture.record("front", (self.ir_front_level,), read_accurate_time())
+        self.ir_front_level_new = True
+
+    def EV_L90_LEVEL(self, event, cmd):
+        self.ir_l90_level = ord(event.read(1))*256
+        self.ir_l90_level += ord(event.read(1))
+        if verbose: print("IR L90 level", self.ir_l90_level)
+        if self.sensor_capture is not None:
+            self.sensor_capture.record("l90", (self.ir_l90_level,), read_accurate_time())
+        self.ir_l90_level_new = True
+
+    def EV_L45_LEVEL(self, event, cmd):
+        self.ir_l45_level = ord(event.read(1))*256
+        self.ir_l45_level += ord(event.read(1))
+        if verbose: print("IR L45 level", self.ir_l45_level)
+        if self.sensor_capture is not None:
+            self.sensor_capture.record("l45", (self.ir_l45_level,), read_accurate_time())
+        self.ir_l45_level_new = True
+
+    def EV_R90_LEVEL(self, event, cmd):
+        self.ir_r90_level = ord(event.read(1))*256
+        self.ir_r90_level += ord(event.read(1))
+        if verbose: print("IR R90 level", self.ir_r90_level)
+        if self.sensor_capture is not None:
+            self.sensor_capture.record("r90", (self.ir_r90_level,), read_accurate_time())
+        self.ir_r90_level_new = True
+
+    def EV_R45_LEVEL(self, event, cmd):
+        self.ir_r45_level = ord(event.read(1))*256
+        self.ir_r45_level += ord(event.read(1))
+        if verbose: print("IR R45 level", self.ir_r45_level)
+        if self.sensor_capture is not None:
+            self.sensor_capture.record("r45", (self.ir_r45_level,), read_accurate_time())
+        self.ir_r45_level_new = True
+
+    def EV_ALL_SENSOR_STATE(self, event, cmd):
+        front_side_state = ord(event.read(1))
+        ir_45_state = ord(event.read(1))
+        self.ir_front_level = ord(event.read(1))*256 + ord(event.read(1))
+        self.ir_l90_level = ord(event.read(1))*256 + ord(event.read(1))
+        self.ir_l45_level = ord(event.read(1))*256 + ord(event.read(1))
+        self.ir_r90_level = ord(event.read(1))*256 + ord(event.read(1))
+        self.ir_r45_level = ord(event.read(1))*256 + ord(event.read(1))
+        self.ir_front_level_new = self.ir_l90_level_new = self.ir_l45_level_new = self.ir_r90_level_new = self.ir_r45_level_new = True
+        if self.sensor_capture is not None:
+            time_now = read_accurate_time()
+            self.sensor_capture.record("front", (self.ir_front_level,), time_now)
+            self.sensor_capture.record("l90", (self.ir_l90_level,), time_now)
+            self.sensor_capture.record("l45", (self.ir_l45_level,), time_now)
+            self.sensor_capture.record("r90", (self.ir_r90_level,), time_now)
+            self.sensor_capture.record("r45", (self.ir_r45_level,), time_now)
+
+        self.sensor_snapshot = {
+            "time": read_accurate_time(),
+            "front_level": self.ir_front_level,
+            "l90_level": self.ir_l90_level,
+            "l45_level": self.ir_l45_level,
+            "r90_level": self.ir_r90_level,
+            "r45_level": self.ir_r45_level,
+            "front_long": bool(front_side_state & 1),
+            "front_short": bool(front_side_state & 2),
+            "left_side": bool(front_side_state & 4),
+            "right_side": bool(front_side_state & 8),
+            "left_45": bool(ir_45_state & 1),
+            "right_45": bool(ir_45_state & 2),
+            "left_45_too_close": bool(ir_45_state & 4),
+            "right_45_too_close": bool(ir_45_state & 8),
+        }
+        if verbose: print("Sensor snapshot", self.sensor_snapshot)
+        self.sensor_snapshot_new = True
+
+    def EV_TICKS_PER_MOTOR(self, event, cmd):
+        left_ticks = ord(event.read(1))*256 + ord(event.read(1))
+        right_ticks = ord(event.read(1))*256 + ord(event.read(1))
+        print("Left Motor Ticks =", left_ticks, " Right Motor Ticks =", right_ticks)
+        if self.sensor_capture is not None:
+            self.sensor_capture.record("ticks", (left_ticks, right_ticks), read_accurate_time())
+
+    def EV_FINISHED_MOVE(self, event, cmd):
+        self.move_finished = True
+        print("Got move finished")
+
+    def EV_UNLOCK_FROM_LOCK(self, event, cmd):
+        print("Got unlock from lock")
+        self.locked = False
+
+    def EV_UNLOCK_FROM_UNLOCK(self, event, cmd):
+        print("Got unlock from unlock")
+        self.locked = False
+
+    def EV_LOCK_BY_TIMER(self, event, cmd):
+        print("Got lock by timer - NOT HANDLED")
+        recover_from_major_error()
+        self.locked = True
+        # @todo: We should issue unlock here, immediately!
+
+    def EV_LOCK_BY_COMMAND(self, event, cmd):
+        print("Got lock by command - NOT HANDLED")
+        recover_from_major_error()
+        self.locked = True
+        # @todo: We should issue unlock here, immediately!
+
+
+    def EV_POLL_REPLY(self, event, cmd):
+        print("Got poll reply")
+
+    def EV_FAIL_INVALID_COMMAND(self, event, cmd):
+        print("Got invalid command")
+        recover_from_major_error()
+
+    #def EV_GOT_INSTRUCTION(self, event, cmd):
+    #    self.acknowledge_send(event, cmd)
+
+    def EV_BUTTON_A_RELEASE(self, event, cmd):
+        if self.key_A_start_time == None:
+            # no press, ignore release
+            return
+        #print("KEY A TIME =", read_accurate_time() - key_A_start_time)
+        # hold key or normal key?
+        if (read_accurate_time() - self.key_A_start_time) > HOLD_KEY_TIME:
+            self.keys_in_queue.append('A')
+            if verbose: print("held A")
+        else:
+            self.keys_in_queue.append('a')
+            if verbose: print("press A")
+
+        self.key_A_start_time = None
+
+    def EV_BUTTON_B_RELEASE(self, event, cmd):
+        if self.key_B_start_time == None:
+            # no press, ignore release
+            return
+        #print("KEY B TIME =", read_accurate_time() - key_B_start_time)
+        # hold key or normal key?
+        if (read_accurate_time() - self.key_B_start_time) > HOLD_KEY_TIME:
+            self.keys_in_queue.append('B')
+            if verbose: print("held B")
+        else:
+            self.keys_in_queue.append('b')
+            if verbose: print("press B")
+
+        self.key_B_start_time = None
+
+    def EV_BUTTON_A_PRESS(self, event, cmd):
+        self.key_A_start_time = read_accurate_time()
+
+    def EV_BUTTON_B_PRESS(self, event, cmd):
+        self.key_B_start_time = read_accurate_time()
+
+    #EV_IR_FRONT_SIDE_STATE  0x40        // bit 0 = front long
+    #                                    // bit 1 = front short
+    #                                    // bit 2 = left side
+    #                                    // bit 3 = right side
+    def EV_IR_FRONT_SIDE_STATE(self, event, cmd):
+        self.left_wall_sense = cmd&4
+        self.right_wall_sense = cmd&8
+        self.front_short_wall_sense = cmd&2
+        self.front_long_wall_sense = cmd&1
+        self.got_wall_info = True
+
+    # define EV_IR_45_STATE          0x50        // bit 0 = left 45
+    #                                           // bit 1 = right 45
+    #                                           // bit 2 = left 45 too close
+    #                                           // bit 3 = right 45 too close
+    def EV_IR_45_STATE(self, event, cmd):
+        self.left_45_sense = cmd & 1
+        self.right_45_sense = cmd & 2
+        self.left_45_too_close_sense = cmd & 4
+        self.right_45_too_close_sense = cmd & 8
+        self.got_45_info = True
+
+
+    """
+    def EV_IR_FRONT_SIDE_STATE_0(port, cmd):
+        # we use short sensor for wall measurement
+        # left, front, right, front_long
+        return False, False, False, False  # cmd&4, cmd&2, cmd&8, cmd&1
+
+    def EV_IR_FRONT_SIDE_STATE_1(port, cmd):
+        # we use short sensor for wall measurement
+        # left, front, right, front_long
+        return False, False, False, True  # cmd&4, cmd&2, cmd&8, cmd&1
+
+    def EV_IR_FRONT_SIDE_STATE_2(port, cmd):
+        # we use short sensor for wall measurement
+        # left, front, right, front_long
+        return False, True, False, False  # cmd&4, cmd&2, cmd&8, cmd&1
+
+    def EV_IR_FRONT_SIDE_STATE_3(port, cmd):
+        # we use short sensor for wall measurement
+        # left, front, right, front_long
+        return False, True, False, True  # cmd&4, cmd&2, cmd&8, cmd&1
+
+    def EV_IR_FRONT_SIDE_STATE_4(port, cmd):
+        # we use short sensor for wall measurement
+        # left, front, right, front_long
+        return True, False, False, False  # cmd&4, cmd&2, cmd&8, cmd&1
+
+    def EV_IR_FRONT_SIDE_STATE_5(port, cmd):
+        # we use short sensor for wall measurement
+        # left, front, right, front_long
+        return True, False, False, True  # cmd&4, cmd&2, cmd&8, cmd&1
+
+    def EV_IR_FRONT_SIDE_STATE_6(port, cmd):
+        # we use short sensor for wall measurement
+        # left, front, right, front_long
+        return True, True, False, False  # cmd&4, cmd&2, cmd&8, cmd&1
+
+    def EV_IR_FRONT_SIDE_STATE_7(port, cmd):
+        # we use short sensor for wall measurement
+        # left, front, right, front_long
+        return True, True, False, True  # cmd&4, cmd&2, cmd&8, cmd&1
+
+    def EV_IR_FRONT_SIDE_STATE_8(port, cmd):
+        # we use short sensor for wall measurement
+        # left, front, right, front_long
+        return False, False, True, False  # cmd&4, cmd&2, cmd&8, cmd&1
+
+    def EV_IR_FRONT_SIDE_STATE_9(port, cmd):
+        # we use short sensor for wall measurement
+        # left, front, right, front_long
+        return False, False, True, True  # cmd&4, cmd&2, cmd&8, cmd&1
+
+    def EV_IR_FRONT_SIDE_STATE_A(port, cmd):
+        # we use short sensor for wall measurement
+        # left, front, right, front_long
+        return False, True, True, False  # cmd&4, cmd&2, cmd&8, cmd&1
+
+    def EV_IR_FRONT_SIDE_STATE_B(port, cmd):
+        # we use short sensor for wall measurement
+        # left, front, right, front_long
+        return False, True, True, True  # cmd&4, cmd&2, cmd&8, cmd&1
+
+    def EV_IR_FRONT_SIDE_STATE_C(port, cmd):
+        # we use short sensor for wall measurement
+        # left, front, right, front_long
+        return True, False, True, False  # cmd&4, cmd&2, cmd&8, cmd&1
+
+    def EV_IR_FRONT_SIDE_STATE_D(port, cmd):
+        # we use short sensor for wall measurement
+        # left, front, right, front_long
+        return True, False, True, True  # cmd&4, cmd&2, cmd&8, cmd&1
+
+    def EV_IR_FRONT_SIDE_STATE_E(port, cmd):
+        # we use short sensor for wall measurement
+        # left, front, right, front_long
+        return True, True, True, False  # cmd&4, cmd&2, cmd&8, cmd&1
+
+    def EV_IR_FRONT_SIDE_STATE_F(port, cmd):
+        # we use short sensor for wall measurement
+        # left, front, right, front_long
+        return True, True, True, True  # cmd&4, cmd&2, cmd&8, cmd&1
+    """
+
+    def EV_TEST_DISTANCE(self, event, cmd):
+        #print("Test Distance")
+        ir_state = ord(event.read(1))
+        if ir_state >= 0x40 and ir_state <= 0x4f:
+            self.test_distance_flag = True
+            self.EV_IR_FRONT_SIDE_STATE(event, ir_state)
+        else:
+            print("Test distance without EV_IR_FRONT_SIDE_STATE")
+            raise MajorError
+
+    def EV_SPEED_SAMPLE_00(self, event, cmd):
+        left = ord(event.read(1))
+        right = ord(event.read(1))
+        print("Speed", left, right)
+        if self.sensor_capture is not None:
+            self.sensor_capture.record("speed", (left, right), read_accurate_time())
+
+    def EV_SPEED_SAMPLE_01(self, event, cmd):
+        left = ord(event.read(1))+256
+        right = ord(event.read(1))
+        print("Speed", left, right)
+        if self.sensor_capture is not None:
+            self.sensor_capture.record("speed", (left, right), read_accurate_time())
+
+    def EV_SPEED_SAMPLE_10(self, event, cmd):
+        left = ord(event.read(1))
+        right = ord(event.read(1))+256
+        print("Speed", left, right)
+        if self.sensor_capture is not None:
+            self.sensor_capture.record("speed", (left, right), read_accurate_time())
+
+    def EV_SPEED_SAMPLE_11(self, event, cmd):
+        left = ord(event.read(1))+256
+        right = ord(event.read(1))+256
+        print("Speed", left, right)
+        if self.sensor_capture is not None:
+            self.sensor_capture.record("speed", (left, right), read_accurate_time())
+
+    def EV_STEERING_TRIM_REPORT(self, event, cmd):
+        print("Trim", cmd&0x0F)
+    def EV_CONFIG_PARAMETER_VALUE(self, event, cmd):
+        subcmd = ord(event.read(1))
+        if subcmd not in self.config_parameter_read_values:
+            print("INVALID CONFIG PARAMETER VALUE")
+        else:
+            self.config_parameter_read_values[subcmd] = ord(event.read(1))*256 + ord(event.read(1))
+
+    def EV_VALUE_FOR_ACCEL(self, event, cmd):
+        self.acceleration_value = ord(event.read(1))*256 + ord(event.read(1))
+        if self.acceleration_writes_pending:
+            addr, data = self.acceleration_writes_pending.popleft()
+            if self.acceleration_value != data:
+                print("Error verifying acceleration value", addr, data, self.acceleration_value)
+                self.acceleration_write_failures.append(addr)
+
+
+    def get_CF_result(self, subcmd_type):
+        while self.config_parameter_read_values[subcmd_type] is None:
+            # @todo: Add timeout here (and other wait locations)
+            self.event_processor()
+
+        return self.config_parameter_read_values[subcmd_type]
+
+
+    def clear_CF_result(self, subcmd_type):
+        self.config_parameter_read_values[subcmd_type] = None
+
+    ################################################################
+    # 
+    # Event Processor 
+    # 
+
+    command_handlers = {
+        0x00: EV_UNKNOWN_RESET,
+        0x01: EV_POWER_ON_RESET,
+        0x02: EV_BROWN_OUT_RESET,
+        0x03: EV_WATCHDOG_RESET,
+        0x04: EV_SOFTWARE_RESET,
+        0x05: EV_EXTERNAL_RESET,
+        0x06: EV_EXCEPTION_RESET,
+
+        0x10: EV_BATTERY_VOLTAGE,   # bit 0 and bit 1 plus extra byte
+        0x11: EV_BATTERY_VOLTAGE,
+        0x12: EV_BATTERY_VOLTAGE,
+        0x13: EV_BATTERY_VOLTAGE,
+
+        0x20: EV_FINISHED_MOVE,
+
+        0x21: EV_TEST_DISTANCE,    # single command (but always followed immediately by EV_IR_FRONT_SIDE_STATE)
+
+        0x22: EV_SPEED_SAMPLE_00,
+        0x23: EV_SPEED_SAMPLE_01,
+        0x24: EV_SPEED_SAMPLE_10,
+        0x25: EV_SPEED_SAMPLE_11,
+        0x26: EV_TICKS_PER_MOTOR,
+
+        0x30: EV_BUTTON_A_RELEASE,
+        0x31: EV_BUTTON_B_RELEASE,
+        0x38: EV_BUTTON_A_PRESS,
+        0x39: EV_BUTTON_B_PRESS,
+
+
+        0x40: EV_IR_FRONT_SIDE_STATE,
+        0x41: EV_IR_FRONT_SIDE_STATE,
+        0x42: EV_IR_FRONT_SIDE_STATE,
+        0x43: EV_IR_FRONT_SIDE_STATE,
+        0x44: EV_IR_FRONT_SIDE_STATE,
+        0x45: EV_IR_FRONT_SIDE_STATE,
+        0x46: EV_IR_FRONT_SIDE_STATE,
+        0x47: EV_IR_FRONT_SIDE_STATE,
+        0x48: EV_IR_FRONT_SIDE_STATE,
+        0x49: EV_IR_FRONT_SIDE_STATE,
+        0x4A: EV_IR_FRONT_SIDE_STATE,
+        0x4B: EV_IR_FRONT_SIDE_STATE,
+        0x4C: EV_IR_FRONT_SIDE_STATE,
+        0x4D: EV_IR_FRONT_SIDE_STATE,
+        0x4E: EV_IR_FRONT_SIDE_STATE,
+        0x4F: EV_IR_FRONT_SIDE_STATE,
+
+        # not really used (except for steering, which is low level code)
+        0x50: EV_IR_45_STATE,
+        0x51: EV_IR_45_STATE,
+        0x52: EV_IR_45_STATE,
+        0x53: EV_IR_45_STATE,
+        0x54: EV_IR_45_STATE,
+        0x55: EV_IR_45_STATE,
+        0x56: EV_IR_45_STATE,
+        0x57: EV_IR_45_STATE,
+        0x58: EV_IR_45_STATE,
+        0x59: EV_IR_45_STATE,
+        0x5A: EV_IR_45_STATE,
+        0x5B: EV_IR_45_STATE,
+        0x5C: EV_IR_45_STATE,
+        0x5D: EV_IR_45_STATE,
+        0x5E: EV_IR_45_STATE,
+        0x5F: EV_IR_45_STATE,
+
+        0x61: EV_IR_FRONT_LEVEL,
+        0x62: EV_L90_LEVEL,
+        0x63: EV_L45_LEVEL,
+        0x64: EV_R90_LEVEL,
+        0x60: EV_ALL_SENSOR_STATE,
+        0x65: EV_R45_LEVEL,
+
+        0x70: EV_STEERING_TRIM_REPORT,
+        0x71: EV_STEERING_TRIM_REPORT,
+        0x72: EV_STEERING_TRIM_REPORT,
+        0x73: EV_STEERING_TRIM_REPORT,
+        0x74: EV_STEERING_TRIM_REPORT,
+        0x75: EV_STEERING_TRIM_REPORT,
+        0x76: EV_STEERING_TRIM_REPORT,
+        0x77: EV_STEERING_TRIM_REPORT,
+        0x78: EV_STEERING_TRIM_REPORT,
+        0x79: EV_STEERING_TRIM_REPORT,
+        0x7A: EV_STEERING_TRIM_REPORT,
+        0x7B: EV_STEERING_TRIM_REPORT,
+        0x7C: EV_STEERING_TRIM_REPORT,
+        0x7D: EV_STEERING_TRIM_REPORT,
+        0x7E: EV_STEERING_TRIM_REPORT,
+        0x7F: EV_STEERING_TRIM_REPORT,
+
+        # unlocking
+        0xC0: EV_UNLOCK_FROM_LOCK,
+        0xC1: EV_UNLOCK_FROM_UNLOCK,
+        0xC2: EV_LOCK_BY_TIMER,
+        0xC3: EV_LOCK_BY_COMMAND,
+
+        0xCE: EV_VALUE_FOR_ACCEL,
+        0xCF: EV_CONFIG_PARAMETER_VALUE,
+
+        0x80: EV_POLL_REPLY,
+
+        0xE2: EV_FAIL_INVALID_COMMAND,
+        0xEF: acknowledge_send,  # no intermediate function required, like EV_GOT_INSTRUCTION
+    }
+
+
+    # Number of bytes after the event byte, for handlers that read more
+    event_handler_extra_bytes = {
+        EV_BATTERY_VOLTAGE: 1,
+        EV_TEST_DISTANCE: 1,
+        EV_SPEED_SAMPLE_00: 2,
+        EV_SPEED_SAMPLE_01: 2,
+        EV_SPEED_SAMPLE_10: 2,
+        EV_SPEED_SAMPLE_11: 2,
+        EV_TICKS_PER_MOTOR: 4,
+        EV_IR_FRONT_LEVEL: 2,
+        EV_L90_LEVEL: 2,
+        EV_L45_LEVEL: 2,
+        EV_R90_LEVEL: 2,
+        EV_R45_LEVEL: 2,
+        EV_ALL_SENSOR_STATE: 12,
+        EV_VALUE_FOR_ACCEL: 2,
+        EV_CONFIG_PARAMETER_VALUE: 3,
+    }
+
+    def handle_event_frame(self, frame):
+        cmd = frame[0]
+        if cmd in self.event_handlers:
+            self.event_handlers[cmd](EventFrameReader(frame), cmd)
+        else:
+            print("Unknown event", hex(cmd), "ignoring")
+            #recover_from_major_error()
 
-        # let's process some events anyway
-        for _ in range(1,10):
-            event_processor(port)
-        
-        send_poll_command(port)
-        wait_for_poll_reply(port)
-
-        running = False
-        while not running:
-            if calibration_mode:
-                send_switch_led_command(port, 1, True)
-                send_switch_led_command(port, 2, True)
-            elif test_mode:
-                send_switch_led_command(port, 1, False)
-                send_switch_led_command(port, 2, False)
-            elif maze_selected == 5:
-                send_switch_led_command(port, 1, True)
-                send_switch_led_command(port, 2, False)
-            elif maze_selected == 16:
-                send_switch_led_command(port, 1, False)
-                send_switch_led_command(port, 2, True)
+    # If wait is True and there's no event ready, this waits a short time for
+    # one (with the reader thread) or for the port timeout (without).
+    def event_processor(self, wait=True):
+        # once per tick, send what the write cache has collected
+        self.flush_pending_writes()
+
+        if self.serial_reader is not None:
+            frame = self.serial_reader.get_event(EVENT_WAIT_TIME if wait else 0)
+            if frame is not None:
+                self.handle_event_frame(frame)
+            self.run_timers()
+            return
+
+        # read everything that's waiting, or wait for one byte if there is
+        # nothing. We only need to read if we haven't got a whole frame.
+        frame = take_frame(self.receive_buffer, event_frame_lengths)
+        if frame is None:
+            waiting = self.port.inWaiting()
+            if waiting or wait:
+                self.receive_buffer.extend(self.port.read(waiting if waiting else 1))
+                self.serial_read_calls += 1
+            frame = take_frame(self.receive_buffer, event_frame_lengths)
+
+        # one event per call, so flags can be checked between events. If we
+        # only have part of a frame, the rest hasn't arrived yet.
+        if frame is not None:
+            self.handle_event_frame(frame)
+        elif wait and sim_clock.is_virtual():
+            # the emulator doesn't block, so this is where the time goes
+            sim_clock.wait(EVENT_WAIT_TIME)
+
+        self.run_timers()
+
+    # are there events we can handle without waiting?
+    def events_waiting(self):
+        if self.serial_reader is not None:
+            return self.serial_reader.events_waiting()
+        if self.receive_buffer and len(self.receive_buffer) >= event_frame_lengths.get(self.receive_buffer[0], 1):
+            return True
+        return self.port.inWaiting() != 0
+
+    def load_acceleration_table_cache(self):
+        try:
+            with open(ACCELERATION_TABLE_CACHE_FILE, 'r') as f:
+                table = [int(line) for line in f if line.strip()]
+        except (IOError, ValueError):
+            self.acceleration_tables_possible = None
+            return
+        if len(table) != 512:
+            self.acceleration_tables_possible = None
+            return
+        self.acceleration_tables_possible = [table, list(default_acceleration_table)]
+
+    def write_acceleration_table(self, table_to_write):
+        if len(table_to_write) != 512:
+            print("Table is not 512 long!")
+            return
+        if validate_acceleration_table is not None:
+            problems = validate_acceleration_table(list(table_to_write))
+            if problems:
+                print("Bad acceleration table:", ", ".join(problems))
+                return
+
+        if self.acceleration_tables_possible is None:
+            to_write = deque(range(512))
+        else:
+            to_write = deque(addr for addr in range(512)
+                             if any(table[addr] != table_to_write[addr] for table in self.acceleration_tables_possible))
+        if verbose: print("Writing", len(to_write), "acceleration table entries")
+        if to_write:
+            # if we stop part way, we don't know what the dsPIC has
+            self.acceleration_tables_possible = None
+            try:
+                os.remove(ACCELERATION_TABLE_CACHE_FILE)
+            except OSError:
+                pass
+        self.acceleration_writes_pending.clear()
+        del self.acceleration_write_failures[:]
+
+        # keep the send window full, and check the echoes as they come back
+        errors = 0
+        while to_write or self.acceleration_writes_pending:
+            while to_write and len(self.acceleration_writes_pending) < ACCEL_WRITES_AHEAD:
+                addr = to_write.popleft()
+                data = table_to_write[addr]
+                if addr < 256:
+                    s = b"\xF9"
+                else:
+                    s = b"\xFA"
+                s += bytes([addr & 0xff, data >> 8, data & 0xff])
+                self.acceleration_writes_pending.append((addr, data))
+                self.send_message(s)
+
+            self.event_processor()
+
+            while self.acceleration_write_failures:
+                # try again
+                to_write.append(self.acceleration_write_failures.pop(0))
+                errors += 1
+                if (errors > 20):
+                    print("More than 20 Errors")
+                    exit(1)
+
+        if self.acceleration_tables_possible is None:
+            save_acceleration_table_cache(table_to_write)
+        self.acceleration_tables_possible = [list(table_to_write)]
+
+    def write_default_acceleration_table(self):
+        self.write_acceleration_table(default_acceleration_table)
+
+    def write_acceleration_profile(self, name):
+        if get_profile_table is None:
+            print("Acceleration profiles need NumPy")
+            return
+        try:
+            table = get_profile_table(name, step_mode)
+        except ValueError as e:
+            # leave the table the dsPIC has
+            print(e)
+            return
+        self.write_acceleration_table(table)
+
+
+    # background is called while waiting, until it returns False
+    def wait_for_move_to_finish(self, background=None):
+        if verbose: print("Wait for move finished")
+        while not self.move_finished:
+            # don't sleep waiting for events if we have work to do
+            self.event_processor(background is None)
+            if background and not background():
+                background = None
+        self.move_finished = False
+
+    # Returns True if we got to the test distance (the wall sense values are
+    # updated), or False if the move finished first.
+    def wait_for_move_finish_or_test_distance(self, background=None):
+        while not self.move_finished:
+            self.event_processor(background is None)
+            if self.test_distance_flag:
+                self.test_distance_flag = False
+                return True
+            if background and not background():
+                background = None
+        self.move_finished = False
+        return False
+
+    def wait_for_move_to_finish_reading_sensors(self):
+        if verbose: print("Wait for move finished (reading sensors)")
+        st = read_accurate_time()
+        move_start = st
+        state = 0
+        while not self.move_finished:
+            self.event_processor()
+
+            time_diff = read_accurate_time() - st
+            if time_diff > 0.1:
+                if state == 0:
+                    self.get_r45_level()
+                else:
+                    self.get_l45_level()
+                st = read_accurate_time()
+                state = 1 - state
+
+            if self.ir_l45_level_new:
+                self.ir_l45_level_new = False
+                print("L45 =", self.ir_l45_level)
+            if self.ir_r45_level_new:
+                self.ir_r45_level_new = False
+                print("R45 =", self.ir_r45_level)
+
+        if self.sensor_capture is not None:
+            _, l45 = self.sensor_capture.window("l45", move_start)
+            _, r45 = self.sensor_capture.window("r45", move_start)
+            if len(l45) and len(r45):
+                print("Move 45 levels: L45 %d samples %d-%d, R45 %d samples %d-%d" %
+                      (len(l45), l45.min(), l45.max(), len(r45), r45.min(), r45.max()))
+        self.move_finished = False
+
+
+
+    def wait_for_unlock_to_complete(self):
+        if verbose: print("Waiting for unlock to complete")
+        start_time = read_accurate_time()
+
+        # run one anway
+        self.event_processor()
+        while self.locked:
+            self.event_processor()
+            if read_accurate_time() > (start_time + 2):
+                return False
+
+        return True
+
+
+    def wait_for_poll_reply(self):
+        # @todo: complete this funnction
+        pass
+
+    def get_key(self):
+        while True:
+            # always poll events at least once
+            self.event_processor()
+
+            # check the key queue
+            if self.keys_in_queue:
+                return self.keys_in_queue.popleft()
+
+
+
+    def get_wall_info(self):
+        self.got_wall_info = False
+
+        self.send_get_wall_info()
+        while not self.got_wall_info:
+            self.event_processor()
+
+        return self.left_wall_sense, self.front_short_wall_sense, self.right_wall_sense
+
+
+    def get_45_info(self):
+        self.got_45_info = False
+
+        self.send_get_45_sensor_info()
+        while not self.got_45_info:
+            self.event_processor()
+
+
+    # All the IR levels and state bits in one round trip. Returns the
+    # sensor_snapshot dictionary (see EV_ALL_SENSOR_STATE).
+    def get_sensor_snapshot(self):
+        self.sensor_snapshot_new = False
+
+        self.send_get_sensor_snapshot()
+        while not self.sensor_snapshot_new:
+            self.event_processor()
+
+        self.sensor_snapshot_new = False
+        return self.sensor_snapshot
+
+
+    def scan_for_walls(self, m, robot_direction, robot_row, robot_column, planner=None):
+        left, front, right = self.get_wall_info()
+        if verbose: print("Directions LFR =", left, front, right)
+        return update_walls(m, robot_direction, robot_row, robot_column, left, front, right, planner)
+
+    # Run a list of moves from compile_speed_run(). Returns False if a key
+    # aborted it.
+    def run_speed_run(self, moves):
+        current_speed = None
+        ir_on = None
+        for move, distance, speed in moves:
+            if self.keys_in_queue:
+                print("Key aborts")
+                while self.keys_in_queue:
+                    self.get_key()
+                self.turn_off_motors()
+                return False
+
+            if speed != current_speed:
+                self.set_speed(speed)
+                current_speed = speed
+            if move == "forward":
+                if not ir_on:
+                    self.turn_on_ir()
+                    ir_on = True
+                self.move_forward(distance)
+            elif move == "diagonal":
+                # no walls alongside to steer by
+                if ir_on is not False:
+                    self.turn_off_ir()
+                    ir_on = False
+                self.move_forward(distance)
             else:
-                print("Unknown mode")
-                sys.exit(1)
+                if ir_on is not False:
+                    self.turn_off_ir()
+                    ir_on = False
+                if move == "right":
+                    self.move_right(distance)
+                else:
+                    self.move_left(distance)
+            self.wait_for_move_to_finish()
+
+        if not ir_on:
+            self.turn_on_ir()
+        return True
+
+    def wait_seconds(self, time):
+        if time < 0:
+            return
+
+        end_time = read_accurate_time() + time
+        sim_clock.wake_at(end_time)
+        while read_accurate_time() < end_time:
+            self.event_processor()
+    def do_calibration_LEDs(self, value):
+        self.send_switch_led_command(1, value & 1)
+        self.send_switch_led_command(2, value & 2)
+        self.send_switch_led_command(3, value & 4)
+        if TEXT_SIMULATOR:
+            self.send_switch_led_command(4, True)
+        else:
+            self.send_switch_led_command(4, self.flashing_cal4_led)
+            self.flashing_cal4_led = not self.flashing_cal4_led
+
+    def set_default_IR_thresholds(self, IR):
+        self.set_front_long_threshold(IR["front_long_threshold"])
+        self.set_front_short_threshold(IR["front_short_threshold"])
+        self.set_left_side_threshold(IR["left_side_threshold"])
+        self.set_right_side_threshold(IR["right_side_threshold"])
+        self.set_left_45_threshold(IR["left_45_threshold"])
+        self.set_right_45_threshold(IR["right_45_threshold"])
+        self.set_left_45_too_close_threshold(IR["left_45_too_close_threshold"])
+        self.set_right_45_too_close_threshold(IR["right_45_too_close_threshold"])
+
+
+    def grab_values(self, position):
+        if self.ir_front_level_new:
+            self.ir_front_level_new = False
+            self.cal_engine.add(position, "front", self.ir_front_level)
+        if self.ir_l90_level_new:
+            self.ir_l90_level_new = False
+            self.cal_engine.add(position, "l90", self.ir_l90_level)
+        if self.ir_r90_level_new:
+            self.ir_r90_level_new = False
+            self.cal_engine.add(position, "r90", self.ir_r90_level)
+        if self.ir_l45_level_new:
+            self.ir_l45_level_new = False
+            self.cal_engine.add(position, "l45", self.ir_l45_level)
+        if self.ir_r45_level_new:
+            self.ir_r45_level_new = False
+            self.cal_engine.add(position, "r45", self.ir_r45_level)
+
+    def discard_values(self):
+        self.ir_front_level_new = False
+        self.ir_l90_level_new = False
+        self.ir_r90_level_new = False
+        self.ir_l45_level_new = False
+        self.ir_r45_level_new = False
+
+    def calibration_for_position(self, read_data, position):
+        if read_data:
+            self.grab_values(position)
+            if self.cal_engine.is_done(position):
+                return True
+        else:
+            # the mouse is being moved into position
+            self.discard_values()
+        return False
+
+    def calculate_and_configure(self, read_data, _):
+        try:
+            with open('cal_raw_data_%s.txt' % datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S'), 'w') as f:
+                self.cal_engine.write_raw_data(f)
+        except IOError:
+            pass
+
+        #
+        # We will need to test these on a real mouse
+        #
+        self.cal_IR.update(self.cal_engine.thresholds())
+        print("Calibration", self.cal_IR)
+
+        self.set_default_IR_thresholds(self.cal_IR)
+        return True
+
+    def calibration_test(self, read_data, _):
+        # if True, then exit, otherwise just wait by returning False...
+        return read_data
+
+
+    def calibration_save_and_quit(self, read_data, _):
+        print("Save calibration")
+        write_config_file('calibration.txt', self.cal_IR)
+        return None
+
 
-            while True:
-                key = get_key(port)
+    def load_IR_calibration(self):
+        read_config_file('calibration.txt', IR_threshold_defaults)
+        self.set_default_IR_thresholds(IR_threshold_defaults)
+
+
+    def do_calibration(self):
+        print("Start Calibration")
+        if CalibrationEngine is None:
+            print("Calibration needs NumPy")
+            return
+
+        self.discard_values()
+
+        self.cal_engine = CalibrationEngine(calibration_min_samples, calibration_max_samples,
+                                       calibration_confidence_counts, calibration_confidence_fraction)
+
+        cal_dispatcher = [(self.calibration_for_position, description, position)
+                          for position, description in calibration_positions]
+        cal_dispatcher += [
+            (self.calculate_and_configure, "Calculating calibration", None),
+            (self.calibration_test, "Test sensor LEDs now", None),
+            (self.calibration_save_and_quit, "Saving sensor calibration", None),
+        ]
+
+
+        start = read_accurate_time()
+        self.turn_on_ir()
+
+        update_state = 1
+        cal_state = 0
+        print(cal_dispatcher[cal_state][1])
+        read_data = False
+        flash = True
+        while True:
+            if (read_accurate_time() - start) > 0.05:
+                if use_sensor_snapshot and update_state <= 3:
+                    # everything at once, every tick
+                    self.send_get_sensor_snapshot()
+                elif update_state == 1:
+                    self.get_front_level()
+                elif update_state == 2:
+                    self.get_l90_level()
+                    self.get_r90_level()
+                elif update_state == 3:
+                    self.get_l45_level()
+                    self.get_r45_level()
+                else:
+                    update_state = 0
+                    flash = not flash
+                    if read_data and flash:
+                        self.do_calibration_LEDs(0)
+                    else:
+                        self.do_calibration_LEDs(cal_state + 1)
+
+                update_state += 1
+
+                start = read_accurate_time()
+
+            # do the testing
+            entry = cal_dispatcher[cal_state]
+            need_step = entry[0](read_data, entry[2])
+            if need_step is None:
+                break
+            elif need_step:
+                read_data = False
+                cal_state += 1
+                print(cal_dispatcher[cal_state][1])
+
+            if self.keys_in_queue:
+                key = self.get_key()
                 if key == "a":
-                    if calibration_mode:
-                        calibration_mode = False
-                        test_mode = True
-                    elif test_mode:
-                        test_mode = False
-                        maze_selected = 5
-                    elif maze_selected == 5:
-                        maze_selected = 16
-                    else:   # maze_selected == 16
-                        calibration_mode = True
-                    break
-                elif key == "b":
-                    # B key without hold does nothing
-                    pass
-                elif key == "A":
-                    raise ShutdownRequest
-                elif key == "B":
-                    running  = True
+                    read_data = True
+
+                elif key == 'B' or key == 'b':
+                    # exit early key
+                    # return IR to old levels
+                    self.set_default_IR_thresholds(IR_threshold_defaults)
                     break
 
-            # let's capture it here and do calibration
-            if running and calibration_mode:
-                running = False
-                do_calibration(port)
-                calibration_mode = False
-            if running and test_mode:
-                running = False
-                do_test_mode(port)
-                test_mode = False
-            
-        start_time = read_accurate_time()
-        # start the run
-        turn_on_ir(port)        # do this early so IR system has time to scan before scan_for_walls()
-        send_switch_led_command(port, 3, True)
-        set_speed(port, search_speed)    # normal search speed
-        m = Maze(maze_selected)
-        m.target_normal_end_cells()
-        m.flood_fill_all()
-        robot_direction = 0     # 0=north, 1=east, 2=west 
-        robot_row = 0
-        robot_column = 0
-        
-        # this is the start cell. We scan here anyway, although it's not necessary.
-        scan_for_walls(port, m, robot_direction, robot_row, robot_column)
-        m.set_explored(robot_row, robot_column)
-        
-        # ensure we wait at least 2 seconds before we move, under all circumstances
-        time_left = 2 - (read_accurate_time() - start_time)
-        wait_seconds(port, time_left)
+        print("Exit Calibration")
+        self.turn_off_all_LEDs()
+        self.turn_off_ir()
 
-        search_phase = 1
-        sparse_run = False
-        while True:             # search/explore runs
-            
-            completed = False
-            while True:         # single run search
-
-                if keys_in_queue:
-                    # keys cancel run!
-                    print("Key aborts")
-                    while keys_in_queue:
-                        get_key(port)
-                    completed = False
+    def do_test_mode(self):
+        print("Start Test")
+        start = read_accurate_time()
+        self.set_speed(search_speed)    # normal search speed
+        self.turn_on_ir()
+
+        wait_to_go = None
+        flash = True
+        mode = 0
+        while True:
+            if (read_accurate_time() - start) > 0.2:
+                flash = not flash
+                self.send_switch_led_command(1, flash)
+                if mode != 3:
+                    self.send_switch_led_command(2, flash)
+                if mode == 1 or mode == 3:
+                    self.send_switch_led_command(3, flash)
+                elif mode == 2:
+                    self.send_switch_led_command(4, flash)
+
+                if wait_to_go is not None:
+                    wait_to_go -= 1
+                    if wait_to_go == 0:
+                        wait_to_go = None
+
+                        if mode == 0:
+                            self.move_forward(distance_cell)
+                            self.wait_for_move_to_finish()
+                            self.turn_off_motors()
+                        elif mode == 1:
+                            self.turn_off_ir()
+                            self.move_right(distance_turnr90)
+                            self.wait_for_move_to_finish()
+                            self.turn_off_motors()
+                            self.turn_on_ir()
+                        elif mode == 2:
+                            self.turn_off_ir()
+                            self.move_left(distance_turnr90)
+                            self.wait_for_move_to_finish()
+                            self.turn_off_motors()
+                            self.turn_on_ir()
+                        elif mode == 3:
+                            while not self.keys_in_queue:
+                                self.get_wall_info()
+                                self.get_45_info()
+
+                                if self.left_wall_sense: L = "L<"
+                                else: L = "  "
+                                self.send_switch_led_command(5, self.left_wall_sense)
+                                if self.right_wall_sense: R = ">R"
+                                else: R = "  "  
+                                self.send_switch_led_command(2, self.right_wall_sense)
+
+                                if self.front_short_wall_sense: FS = "_FS_"
+                                else: FS = "    "
+                                self.send_switch_led_command(1, self.front_short_wall_sense)
+                                if self.front_long_wall_sense: FL = "^FL^"
+                                else: FL = "    "
+
+                                self.wait_seconds(0.1)
+
+                                if self.left_45_sense: L45 = "\\"
+                                else: L45 = " "
+                                if self.right_45_sense: R45 = "/"
+                                else: R45 = " "
+
+                                if self.left_45_too_close_sense: LS45 = "\\"
+                                else: LS45 = " "
+                                self.send_switch_led_command(4, self.left_45_too_close_sense)
+                                if self.right_45_too_close_sense: RS45 = "/"
+                                else: RS45 = " "
+                                self.send_switch_led_command(3, self.right_45_too_close_sense)
+
+                                print(L + L45 + LS45 + FS + FL + RS45 + R45 + R)
+
+                                self.wait_seconds(0.2)
+
+                            # ignore this key
+                            self.get_key()
+
+                start = read_accurate_time()
+
+            if self.keys_in_queue:
+                key = self.get_key()
+                self.turn_off_all_LEDs()
+                if key == "a":
+                    wait_to_go = 5
+                elif key == 'b':
+                    mode += 1
+                    if mode == 4:
+                        mode = 0
+                elif key == 'B' or key == 'b':
+                    # exit key
                     break
 
-                headings = m.get_lowest_directions_against_heading(robot_direction, robot_row, robot_column)
-                print(time.time(), "Best Headings:", headings)
-                if len(headings) == 0:
-                    current_cell_value = m.get_cell_value(robot_row, robot_column)
-                    if current_cell_value == 0:
-                        #completed
-                        completed = True
+        self.turn_off_all_LEDs()
+        self.turn_off_ir()
+        print("End Test")
+
+    ################################################################
+    #
+    # Control Loop
+    #
+
+    def run_program(self):
+
+        while True:
+            self.send_unlock_command()
+            if self.wait_for_unlock_to_complete():
+                break
+            print("Unlock failed - Retrying")
+
+        self.turn_off_all_LEDs()
+        self.turn_off_motors()
+        self.turn_off_ir()
+
+        self.set_default_distances()
+        self.load_IR_calibration()
+        self.load_acceleration_table_cache()
+
+        #self.write_default_acceleration_table()
+        if acceleration_profile is not None:
+            self.write_acceleration_profile(acceleration_profile)
+
+        calibration_mode = False
+        test_mode = False
+        while True:
+            if snoop_serial_data:
+                self.port.save_all()
+
+            # let's process some events anyway
+            for _ in range(1,10):
+                self.event_processor()
+
+            self.send_poll_command()
+            self.wait_for_poll_reply()
+
+            running = False
+            while not running:
+                if calibration_mode:
+                    self.send_switch_led_command(1, True)
+                    self.send_switch_led_command(2, True)
+                elif test_mode:
+                    self.send_switch_led_command(1, False)
+                    self.send_switch_led_command(2, False)
+                elif self.maze_selected == 5:
+                    self.send_switch_led_command(1, True)
+                    self.send_switch_led_command(2, False)
+                elif self.maze_selected == 16:
+                    self.send_switch_led_command(1, False)
+                    self.send_switch_led_command(2, True)
+                else:
+                    print("Unknown mode")
+                    sys.exit(1)
+
+                while True:
+                    key = self.get_key()
+                    if key == "a":
+                        if calibration_mode:
+                            calibration_mode = False
+                            test_mode = True
+                        elif test_mode:
+                            test_mode = False
+                            self.maze_selected = 5
+                        elif self.maze_selected == 5:
+                            self.maze_selected = 16
+                        else:   # maze_selected == 16
+                            calibration_mode = True
                         break
-                    else:
-                        # can't get any better cell? Probably unsolvable?
+                    elif key == "b":
+                        # B key without hold does nothing
+                        pass
+                    elif key == "A":
+                        raise ShutdownRequest
+                    elif key == "B":
+                        running  = True
+                        break
+
+                # let's capture it here and do calibration
+                if running and calibration_mode:
+                    running = False
+                    self.do_calibration()
+                    calibration_mode = False
+                if running and test_mode:
+                    running = False
+                    self.do_test_mode()
+                    test_mode = False
+
+            start_time = read_accurate_time()
+            # start the run
+            self.turn_on_ir()        # do this early so IR system has time to scan before scan_for_walls()
+            self.send_switch_led_command(3, True)
+            self.set_speed(search_speed)    # normal search speed
+            m = Maze(self.maze_selected)
+            m.target_normal_end_cells()
+            m.flood_fill_all()
+            planner = SpeculativePlanner(m)
+            robot_direction = 0     # 0=north, 1=east, 2=west 
+            robot_row = 0
+            robot_column = 0
+
+            # this is the start cell. We scan here anyway, although it's not necessary.
+            self.scan_for_walls(m, robot_direction, robot_row, robot_column)
+            m.set_explored(robot_row, robot_column)
+
+            # ensure we wait at least 2 seconds before we move, under all circumstances
+            time_left = 2 - (read_accurate_time() - start_time)
+            self.wait_seconds(time_left)
+
+            search_phase = 1
+            sparse_run = False
+            weighted_run = False
+            proving_run = False
+            path_proven = False
+            while True:             # search/explore runs
+
+                completed = False
+                while True:         # single run search
+
+                    if self.keys_in_queue:
+                        # keys cancel run!
+                        print("Key aborts")
+                        while self.keys_in_queue:
+                            self.get_key()
                         completed = False
                         break
-                
-                if sparse_run:
-                    # we don't need to achieve the target IF we have explored all
-                    # cells to the target.
-                    explored, unex_row, unex_column = is_shortest_path_explored(m, robot_row, robot_column, robot_direction)
-                    if explored:
+
+                    if weighted_run:
+                        headings = m.get_fastest_directions_against_heading(robot_direction, robot_row, robot_column)
+                    else:
+                        headings = planner.get_headings(robot_direction, robot_row, robot_column)
+                        if headings is None:
+                            headings = m.get_lowest_directions_against_heading(robot_direction, robot_row, robot_column)
+                    print(time.time(), "Best Headings:", headings)
+                    if len(headings) == 0:
+                        current_cell_value = m.get_cell_value(robot_row, robot_column)
+                        if current_cell_value == 0:
+                            #completed
+                            completed = True
+                            break
+                        else:
+                            # can't get any better cell? Probably unsolvable?
+                            completed = False
+                            break
+
+                    if proving_run and m.is_shortest_path_proven(0, 0, m.normal_end_cells()):
+                        # we've seen enough walls to know no unexplored route
+                        # can be shorter, so no need to finish this trip
+                        print("Shortest path proven")
+                        path_proven = True
                         completed = True
                         break
-                                        
-                # @todo: we should select a specific one here, but we just choose the first one at the moment
-                heading = headings[0] & 3
-                if heading == 0:
-                    turn_on_ir(port)
-                    test_distance_flag = False
-                    move_forward(port, distance_cell)
-                    wait_for_move_to_finish(port)
-                    #wait_for_move_to_finish_reading_sensors(port)
-                    #finished = wait_for_move_finish_or_test_distance()
-                    finished = True
-                    if finished:
-    #                    def wait_for_move_finish_or_test_distance
-    #                        test_distance_flag
-                        if robot_direction == 0:
-                            robot_row += 1
-                        elif robot_direction == 1:
-                            robot_column += 1
-                        elif robot_direction == 2:
-                            robot_row -= 1
+
+                    if sparse_run:
+                        # we don't need to achieve the target IF we have explored all
+                        # cells to the target.
+                        explored, unex_row, unex_column = is_shortest_path_explored(m, robot_row, robot_column, robot_direction)
+                        if explored:
+                            completed = True
+                            break
+
+                    # @todo: we should select a specific one here, but we just choose the first one at the moment
+                    heading = headings[0] & 3
+                    if heading == 0:
+                        self.turn_on_ir()
+                        if search_multi_cell_moves and not weighted_run:
+                            cells = cells_to_move_forward(m, robot_direction, robot_row, robot_column)
                         else:
-                            robot_column -= 1
-        
-                        scan_for_walls(port, m, robot_direction, robot_row, robot_column)
-                        m.set_explored(robot_row, robot_column)
-                        
-                        if print_map_in_progress:
-                            m.clear_marks()
-                            m.set_mark(robot_row, robot_column)
-                            m.print_maze()
+                            cells = 1
+                        # cells along the move, the last one is where we stop
+                        move_cells = []
+                        next_row = robot_row
+                        next_column = robot_column
+                        for _ in range(cells):
+                            if robot_direction == 0:
+                                next_row += 1
+                            elif robot_direction == 1:
+                                next_column += 1
+                            elif robot_direction == 2:
+                                next_row -= 1
+                            else:
+                                next_column -= 1
+                            move_cells.append((next_row, next_column))
+
+                        background = None
+                        if speculative_planning and not weighted_run:
+                            planner.start(robot_direction, next_row, next_column)
+                            background = planner.step
+                        if search_extend_moves and not weighted_run:
+                            # line up the test distance with the start of this move
+                            self.set_distance_to_test(distance_to_test_value)
+                        self.move_forward(cells * distance_cell)
+
+                        if search_extend_moves and not weighted_run:
+                            test_count = 0
+                            while self.wait_for_move_finish_or_test_distance(background):
+                                # we get one test distance per cell - the wall
+                                # senses are for the cell we are going into
+                                if test_count >= len(move_cells):
+                                    continue
+                                test_row, test_column = move_cells[test_count]
+                                test_count += 1
+                                update_walls(m, robot_direction, test_row, test_column,
+                                             self.left_wall_sense, self.front_short_wall_sense, self.right_wall_sense)
+                                m.set_explored(test_row, test_column)
+                                if test_count != len(move_cells):
+                                    continue
+                                headings = m.get_lowest_directions_against_heading(robot_direction, test_row, test_column)
+                                if (len(headings) == 0 or headings[0] != 0
+                                        or m.get_front_wall(robot_direction, test_row, test_column)):
+                                    continue
+                                # route carries straight on, don't stop
+                                self.extend_movement()
+                                if robot_direction == 0:
+                                    test_row += 1
+                                elif robot_direction == 1:
+                                    test_column += 1
+                                elif robot_direction == 2:
+                                    test_row -= 1
+                                else:
+                                    test_column -= 1
+                                move_cells.append((test_row, test_column))
+                                next_row, next_column = test_row, test_column
+                                if speculative_planning:
+                                    # what was planned was for the old end cell
+                                    planner.start(robot_direction, next_row, next_column)
+                        else:
+                            self.wait_for_move_to_finish(background)
+                        #self.wait_for_move_to_finish_reading_sensors()
+                        finished = True
+                        if finished:
+                            robot_row = next_row
+                            robot_column = next_column
+
+                            walls_changed = self.scan_for_walls(m, robot_direction, robot_row, robot_column, planner)
+                            m.set_explored(robot_row, robot_column)
+                            if weighted_run and walls_changed:
+                                flood_fill_fastest(m, speed_run_speed)
+
+                            if print_map_in_progress:
+                                m.clear_marks()
+                                m.set_mark(robot_row, robot_column)
+                                m.print_maze()
+                        else:
+                            # we've had a distance test flag - so we can scan walls and see if we want to.
+                            pass
+
+                    elif heading == 1:
+                        self.turn_off_ir()
+                        self.move_right(distance_turnr90)
+                        self.wait_for_move_to_finish()
+                        self.turn_on_ir()
+                        robot_direction += 1
+                        robot_direction &= 3
+                    elif heading == 2:
+                        self.turn_off_ir()
+                        self.move_right(distance_turn180)
+                        self.wait_for_move_to_finish()
+                        self.turn_on_ir()
+                        robot_direction += 2
+                        robot_direction &= 3
                     else:
-                        # we've had a distance test flag - so we can scan walls and see if we want to.
-                        pass
-                    
-                elif heading == 1:
-                    turn_off_ir(port)
-                    move_right(port, distance_turnr90)
-                    wait_for_move_to_finish(port)
-                    turn_on_ir(port)
-                    robot_direction += 1
-                    robot_direction &= 3
-                elif heading == 2:
-                    turn_off_ir(port)
-                    move_right(port, distance_turn180)
-                    wait_for_move_to_finish(port)
-                    turn_on_ir(port)
+                        self.turn_off_ir()
+                        self.move_left(distance_turnl90)
+                        self.wait_for_move_to_finish()
+                        self.turn_on_ir()
+                        robot_direction -= 1
+                        robot_direction &= 3
+
+                # shut down
+                self.turn_off_ir()
+                self.turn_off_motors()
+
+                self.send_switch_led_command(3, False)
+                if not completed:
+                    print("Failed to complete")
+                    # flash for 6 seconds
+                    for _ in range(1, 6):
+                        self.send_switch_led_command(4, True)
+                        self.wait_seconds(0.5)
+                        self.send_switch_led_command(4, False)
+                        self.wait_seconds(0.5)
+                    self.send_switch_led_command(4, True)
+                    break
+
+                # we only specifically turn these on if we want them
+                sparse_run = False
+                proving_run = False
+
+                if search_phase == 1:
+                    print()
+                    print("Got to target")
+                    print("===========================================")
+                    print()
+
+                    # let's floodfill from start to center and see if we know enough
+                    # to look for the shortest path
+                    m.clear_targets()
+                    m.target_normal_end_cells()
+                    m.flood_fill_all()
+                    shortest, unex_row, unex_column = is_shortest_path_explored(m, 0, 0, 0)
+                    print("Is shortest path explored?", shortest)
+                    if not shortest and (path_proven or m.is_shortest_path_proven(0, 0)):
+                        # the route goes through unexplored cells, but the
+                        # walls we have seen say it can't be beaten
+                        path_proven = True
+                        shortest = True
+                        print("Shortest path proven")
+                    m.print_maze()
+
+                    # if we have explored the shortest path, then we are complete
+                    if shortest:
+                        # Go to start then wait for keys
+                        m.clear_targets()
+                        m.target_start_cell()
+                        m.flood_fill_all()
+                        print()
+                        print("target start")
+                        print("===========================================")
+                        print()                    
+                        search_phase = 2
+                    else:
+                        proving_run = True
+                        # not shortest, go to unexploded cell
+                        if not cell_one_away(m, robot_row, robot_column, unex_row, unex_column):
+                            m.clear_targets()
+                            m.set_target_cell(unex_row, unex_column)
+                            m.flood_fill_all()
+                            print("Run to unexplored at", unex_row, unex_column)
+                        else:
+                            # the unexplorded is only one cell away, use a different strategy
+                            sparse_run = True
+                            m.clear_targets()
+                            m.target_normal_end_cells()
+                            m.flood_fill_all()
+
+                elif search_phase == 2:
+                    print()
+                    print("Back at start, wait for speed run")
+                    print("===========================================")
+                    print()
+                    self.search_time = read_accurate_time() - start_time
+                    print("Search took %.1f s" % self.search_time)
+                    self.set_speed(speed_run_speed)    # normal search speed
+
+                    if path_proven:
+                        # only use the route we know is there
+                        m.close_unknown_walls()
+                    m.clear_targets()
+                    m.target_normal_end_cells()
+                    m.flood_fill_all()
+                    m.print_maze()
+                    if speed_run_weighted:
+                        flood_fill_fastest(m, speed_run_speed)
+                        weighted_run = True
+
+                    #
+                    # turn around now back at start
+                    #
+                    self.turn_off_ir()
+                    self.move_left(distance_turn180)
+                    self.wait_for_move_to_finish()
+                    self.turn_on_ir()
                     robot_direction += 2
                     robot_direction &= 3
-                else:
-                    turn_off_ir(port)
-                    move_left(port, distance_turnl90)
-                    wait_for_move_to_finish(port)
-                    turn_on_ir(port)
-                    robot_direction -= 1
-                    robot_direction &= 3
-    
-            # shut down
-            turn_off_ir(port)
-            turn_off_motors(port)
-            
-            send_switch_led_command(port, 3, False)
-            if not completed:
-                print("Failed to complete")
-                # flash for 6 seconds
-                for _ in range(1, 6):
-                    send_switch_led_command(port, 4, True)
-                    wait_seconds(port, 0.5)
-                    send_switch_led_command(port, 4, False)
-                    wait_seconds(port, 0.5)
-                send_switch_led_command(port, 4, True)
-                break
-            
-            # we only specifically turn this on if we want it
-            sparse_run = False
 
-            if search_phase == 1:
-                print()
-                print("Got to target")
-                print("===========================================")
-                print()
-                
-                # let's floodfill from start to center and see if we know enough
-                # to look for the shortest path
-                m.clear_targets()
-                m.target_normal_end_cells()
-                m.flood_fill_all()
-                shortest, unex_row, unex_column = is_shortest_path_explored(m, 0, 0, 0)
-                print("Is shortest path explored?", shortest)
-                m.print_maze()
-                
-                # if we have explored the shortest path, then we are complete
-                if shortest:
-                    # Go to start then wait for keys
+                    # wait before speed run
+                    led_toggle = True
+                    for _ in range(6):
+                        self.send_switch_led_command(1, led_toggle)
+                        self.wait_seconds(0.25)
+                        led_toggle = not led_toggle
+                        if self.keys_in_queue:
+                            # keys cancel run!
+                            print("Key aborts")
+                            while self.keys_in_queue:
+                                self.get_key()
+                            completed = False
+                            break
+
+                    #key = self.get_key()
+                    #if key == "A":
+                    #    raise ShutdownRequest
+
+                    search_phase = 3
+                    speed_run_start = read_accurate_time()
+
+                    if speed_run_compiled:
+                        distances = (distance_cell, distance_turnl90, distance_turnr90, distance_turn180)
+                        if speed_run_diagonals:
+                            compiler = compile_diagonal_speed_run
+                        else:
+                            compiler = compile_speed_run
+                        try:
+                            moves, end = compiler(m, robot_direction, robot_row, robot_column,
+                                                  speed_run_speed, distances, weighted=weighted_run)
+                        except SpeedRunRouteFailed as e:
+                            print(e)
+                            recover_from_major_error()
+                        print("Speed run", len(moves), "moves")
+                        if not self.run_speed_run(moves):
+                            completed = False
+                            break
+                        # at the target now, so the search loop will finish straight away
+                        robot_direction, robot_row, robot_column = end
+
+                elif search_phase == 3:
+                    self.speed_run_time = read_accurate_time() - speed_run_start
+                    print("Speed run took %.2f s" % self.speed_run_time)
+                    weighted_run = False
                     m.clear_targets()
                     m.target_start_cell()
                     m.flood_fill_all()
@@ -2055,83 +2585,30 @@ def run_program(port):
                     print("target start")
                     print("===========================================")
                     print()                    
-                    search_phase = 2
-                else:
-                    # not shortest, go to unexploded cell
-                    if not cell_one_away(m, robot_row, robot_column, unex_row, unex_column):
-                        m.clear_targets()
-                        m.set_target_cell(unex_row, unex_column)
-                        m.flood_fill_all()
-                        print("Run to unexplored at", unex_row, unex_column)
+                    search_phase = 4
+
+                elif search_phase == 4:
+                    print("Finished")
+                    print("Distance cache hits", m.cache_hits, "misses", m.cache_misses)
+                    print("Speculative planner hits", planner.hits, "misses", planner.misses)
+                    if self.serial_reader is not None:
+                        print("Serial read calls", self.serial_reader.read_calls)
                     else:
-                        # the unexplorded is only one cell away, use a different strategy
-                        sparse_run = True
-                        m.clear_targets()
-                        m.target_normal_end_cells()
-                        m.flood_fill_all()
-
-            elif search_phase == 2:
-                print()
-                print("Back at start, wait for speed run")
-                print("===========================================")
-                print()
-                set_speed(port, speed_run_speed)    # normal search speed
-
-                m.clear_targets()
-                m.target_normal_end_cells()
-                m.flood_fill_all()
-                m.print_maze()
-
-                #
-                # turn around now back at start
-                #
-                turn_off_ir(port)
-                move_left(port, distance_turn180)
-                wait_for_move_to_finish(port)
-                turn_on_ir(port)
-                robot_direction -= 1
-                robot_direction &= 3
-
-                # wait before speed run
-                led_toggle = True
-                for _ in range(6):
-                    send_switch_led_command(port, 1, led_toggle)
-                    wait_seconds(port, 0.25)
-                    led_toggle = not led_toggle
-                    if keys_in_queue:
-                        # keys cancel run!
-                        print("Key aborts")
-                        while keys_in_queue:
-                            get_key(port)
-                        completed = False
-                        break
-
-                #key = get_key(port)
-                #if key == "A":
-                #    raise ShutdownRequest
-
-                search_phase = 3
-
-            elif search_phase == 3:
-                m.clear_targets()
-                m.target_start_cell()
-                m.flood_fill_all()
-                print()
-                print("target start")
-                print("===========================================")
-                print()                    
-                search_phase = 4
-            
-            elif search_phase == 4:
-                print("Finished")
-                break;
-
-        print("<<Add in key restart>>")
-        if completed:
-            print("We need to wait for speed run keys here?")
-            print("Then assemble and run speed run at 500?")
-        else:
-            print("Going back to start menu")
+                        print("Serial read calls", self.serial_read_calls)
+                    self.print_flow_stats()
+                    self.print_write_cache_stats()
+                    if self.sensor_capture is not None:
+                        self.sensor_capture.print_stats()
+                    break;
+
+            print("<<Add in key restart>>")
+            if completed:
+                print("We need to wait for speed run keys here?")
+                print("Then assemble and run speed run at 500?")
+            else:
+                print("Going back to start menu")
+            if exit_after_run:
+                return completed
                 
         # @todo: move test (similar to calibration)
         # @todo: do speed run.
@@ -2140,6 +2617,26 @@ def run_program(port):
 
         # loop back to top to do keys again
 
+    # After an error we start again with a new controller on the same port,
+    # as if the program had restarted - except we remember which maze was
+    # selected, the battery state and the sensor capture. The dsPIC might
+    # have reset, so run_program() unlocks it and sets everything up again.
+    def reset(self):
+        controller = MouseController(self.port, self.serial_reader)
+        controller.receive_buffer = self.receive_buffer
+        controller.maze_selected = self.maze_selected
+        controller.battery_voltage = self.battery_voltage
+        controller.minimum_battery_voltage = self.minimum_battery_voltage
+        controller.battery_voltage_mode = self.battery_voltage_mode
+        controller.battery_voltage_count = self.battery_voltage_count
+        controller.battery_voltage_array = self.battery_voltage_array
+        controller.sensor_capture = self.sensor_capture
+        return controller
+
+# whole frame length (including the event byte) for every event
+event_frame_lengths = dict((cmd, 1 + MouseController.event_handler_extra_bytes.get(handler, 0))
+                           for cmd, handler in MouseController.command_handlers.items())
+
 class serial_snooper:
     def __init__(self, port):
         self.port = port
@@ -2208,43 +2705,47 @@ def set_up_port(gui_bridge=None):
         port.set_gui(gui_bridge)
     if snoop_serial_data:
         port = serial_snooper(port)
-    time.sleep(0.05)
+    sim_clock.sleep(0.05)
     bytes_waiting = port.inWaiting()
     if bytes_waiting != 0:
         print("Bytes Waiting = ", bytes_waiting)
         port.read(bytes_waiting)
         print("Flushed bytes")
     return port
+
+def make_controller(port):
+    if use_serial_reader_thread:
+        return MouseController(port, SerialReader(port, event_frame_lengths))
+    return MouseController(port)
     
 def main(gui_bridge=None):
     port = set_up_port(gui_bridge)
+    controller = make_controller(port)
     
     while True:
         try:
-            run_program(port)
-            
+            controller.run_program()
+            # only returns if exit_after_run is set
+            if sim_clock.is_virtual():
+                print("Simulated %.1f s in %.2f s CPU time" % (read_accurate_time(), time.process_time()))
+            return
+
         except (SoftReset, MajorError):
             print("Error recovery?")
-            # @todo: Fix this to reset variables, and restart
-            # @todo: Go though all variables in project, and set... maybe collate variables at top?
-            reset_message_queue()
-            global locked
-            locked = True
-            global keys_in_queue
-            keys_in_queue = deque()
+            controller = controller.reset()
             
         except ShutdownRequest:
-            if battery_voltage_mode == 2:
-                print("Battery Shutdown.      Batt V", battery_voltage, "cell:", battery_voltage/4.0)
+            if controller.battery_voltage_mode == 2:
+                print("Battery Shutdown.      Batt V", controller.battery_voltage, "cell:", controller.battery_voltage/4.0)
 
-            save_battery_data(True, None)
+            controller.save_battery_data(True, None)
 
             print("Running RPi shutdown command")
-            turn_off_motors(port)
-            turn_off_ir(port)
-            send_led_pattern_command(port, 0x10)    # LED 5 on = shutdown
+            controller.turn_off_motors()
+            controller.turn_off_ir()
+            controller.send_led_pattern_command(0x10)    # LED 5 on = shutdown
             # let everything settle
-            wait_seconds(port, 0.1)
+            controller.wait_seconds(0.1)
             if not SIMULATOR:
                 os.system("sudo poweroff")
             print("sudo poweroff")
@@ -2252,31 +2753,31 @@ def main(gui_bridge=None):
 
 def cmd_control():
     print("Command Processor")
-    port = set_up_port()
+    controller = make_controller(set_up_port())
     if sys.argv[1] == "motors":
         while True:
-            send_unlock_command(port)
-            if wait_for_unlock_to_complete(port):
+            controller.send_unlock_command()
+            if controller.wait_for_unlock_to_complete():
                 break
             print("Unlock failed - Retrying")
         
                 # let's process some events anyway
         for _ in range(1,10):
-            event_processor(port)
+            controller.event_processor()
         
-        send_poll_command(port)
-        wait_for_poll_reply(port)
+        controller.send_poll_command()
+        controller.wait_for_poll_reply()
         
-        set_speed(port, search_speed/10)    # normal search speed
-        move_forward(port, distance_cell/10)
-        wait_for_move_to_finish(port)
-        turn_off_motors(port)
+        controller.set_speed(search_speed/10)    # normal search speed
+        controller.move_forward(distance_cell/10)
+        controller.wait_for_move_to_finish()
+        controller.turn_off_motors()
 
     else:
         print("Unknown command")
     
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
+    if len(sys.argv) < 2 or SIMULATOR:
         main()
     else:
         cmd_control()
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+#
+# asyncio runtime for the Vision2 Micromouse Robot controller.
+#
+# mouse.py waits for things (a move to finish, wall info, a key) by calling
+# event_processor() in a loop. This gives the same things as coroutines
+# that can be awaited, so control code can be written as a straight line
+# and the heartbeat/battery timer runs as its own task rather than being
+# checked on every event.
+#
+#  * Bytes are read by the SerialReader thread, which hands whole frames
+#    to the event loop. They are handled by the event handlers of a
+#    mouse.MouseController (runtime.mouse), so its state is kept up to date.
+#  * The controller's command methods (move_forward(), turn_on_ir() etc.)
+#    are used as they are, but its port is an object that puts messages
+#    on the send queue without waiting. Acknowledges coming back send the
+#    rest.
+#  * wait_until() suspends until a condition on the controller is true,
+#    and is checked every time an event is handled.
+#
+# Copyright 2016 Rob Probin.
+# All original work.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+import sys
+import asyncio
+
+if __name__ == "__main__" and len(sys.argv) < 2:
+    # the self test runs against the emulator
+    sys.argv.append("TEXT_SIMULATOR")
+
+import mouse
+from serial_reader import SerialReader
+
+
+# What the controller has instead of the serial port. send_message() sees
+# queue_message() and passes the message to us.
+class AsyncPortProxy:
+    def __init__(self, runtime):
+        self.runtime = runtime
+
+    def queue_message(self, message):
+        self.runtime.mouse.queue_message(message)
+
+    def __getattr__(self, name):
+        return getattr(self.runtime.port, name)
+
+
+class AsyncMouseRuntime(object):
+
+    def __init__(self, port):
+        self.port = port
+        self.proxy = AsyncPortProxy(self)
+        self.mouse = mouse.MouseController(self.proxy)
+        self.waiters = []
+        self.error = None
+        self.events_handled = 0
+        self.loop = None
+        self.reader = None
+        self.tasks = []
+        self.flush_scheduled = False
+
+    # Must be called from inside the event loop, before anything else
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.reader = SerialReader(self.port, mouse.event_frame_lengths,
+                                   lambda frame: self.loop.call_soon_threadsafe(self._frame_received, frame))
+        self.tasks.append(asyncio.ensure_future(self._timers()))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        for task in self.tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self.reader.stop()
+
+    #
+    # Events
+    #
+    def _frame_received(self, frame):
+        try:
+            self.mouse.handle_event_frame(frame)
+        except Exception as e:
+            # e.g. MajorError or SoftReset - give it to whoever is waiting,
+            # or keep it for the next wait_until(), command() or flush()
+            self.error = e
+        self.events_handled += 1
+        self._check_waiters()
+
+    def _check_waiters(self):
+        still_waiting = []
+        handed_on = False
+        for condition, future in self.waiters:
+            if future.done():
+                continue
+            if self.error is not None:
+                future.set_exception(self.error)
+                handed_on = True
+            elif condition():
+                future.set_result(True)
+            else:
+                still_waiting.append((condition, future))
+        self.waiters = still_waiting
+        if handed_on:
+            self.error = None
+
+    # raise an error from an event that nothing was waiting for
+    def _raise_pending_error(self):
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+    # Wait until condition() (looking at self.mouse) is true.
+    # Returns False if it timed out.
+    async def wait_until(self, condition, timeout=None):
+        self._raise_pending_error()
+        if condition():
+            return True
+        future = self.loop.create_future()
+        self.waiters.append((condition, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    #
+    # Sending
+    #
+    # Call one of the controller's command methods, e.g.
+    #    runtime.command(runtime.mouse.move_forward, mouse.distance_cell)
+    def command(self, function, *args):
+        self._raise_pending_error()
+        result = function(*args)
+        # LED/IR/speed writes are cached by the controller - send them once all
+        # the commands from this pass of the event loop are in
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self._flush_writes)
+        return result
+
+    def _flush_writes(self):
+        self.flush_scheduled = False
+        self.mouse.flush_pending_writes()
+
+    # wait for everything we've queued to be sent
+    async def flush(self):
+        self._raise_pending_error()
+        self.mouse.flush_pending_writes()
+        await self.wait_until(lambda: not self.mouse.outgoing_queue)
+
+    #
+    # Periodic tasks
+    #
+    async def _timers(self):
+        while True:
+            next_tick = self.mouse.timer_tick()
+            self.mouse.flush_pending_writes()
+            await asyncio.sleep(next_tick)
+
+    #
+    # Coroutine versions of the controller's wait methods
+    #
+    async def wait_for_unlock(self, timeout=2):
+        self.command(self.mouse.send_unlock_command)
+        return await self.wait_until(lambda: not self.mouse.locked, timeout)
+
+    async def wait_for_move_to_finish(self):
+        await self.wait_until(lambda: self.mouse.move_finished)
+        self.mouse.move_finished = False
+
+    async def get_wall_info(self):
+        self.mouse.got_wall_info = False
+        self.command(self.mouse.send_get_wall_info)
+        await self.wait_until(lambda: self.mouse.got_wall_info)
+        return self.mouse.left_wall_sense, self.mouse.front_short_wall_sense, self.mouse.right_wall_sense
+
+    async def get_key(self):
+        await self.wait_until(lambda: self.mouse.keys_in_queue)
+        return self.mouse.keys_in_queue.popleft()
+
+    # The controller's get_cell_distance() etc. wait for the reply
+    # themselves, so use this instead, e.g. read_config_parameter(0xC7)
+    async def read_config_parameter(self, subcmd_type):
+        self.mouse.clear_CF_result(subcmd_type)
+        self.proxy.queue_message(bytes([0xCF, subcmd_type]))
+        await self.wait_until(lambda: self.mouse.config_parameter_read_values[subcmd_type] is not None)
+        return self.mouse.config_parameter_read_values[subcmd_type]
+
+    async def wait_seconds(self, time):
+        if time > 0:
+            await asyncio.sleep(time)
+
+    async def scan_for_walls(self, m, robot_direction, robot_row, robot_column):
+        left, front, right = await self.get_wall_info()
+        return mouse.update_walls(m, robot_direction, robot_row, robot_column, left, front, right)
+
+
+if __name__ == "__main__":
+    import resource
+    from maze import Maze
+
+    # Drive to the centre of the emulator's maze, a cell at a time
+    async def search_to_centre(runtime):
+        if not await runtime.wait_for_unlock():
+            print("Unlock failed")
+            sys.exit(1)
+        controller = runtime.mouse
+        runtime.command(controller.set_cell_distance, mouse.distance_cell)
+        if await runtime.read_config_parameter(0xC7) != mouse.distance_cell:
+            print("Cell distance not set")
+            sys.exit(1)
+
+        runtime.command(controller.turn_on_ir)
+        runtime.command(controller.set_speed, mouse.search_speed)
+        m = Maze(16)
+        m.target_normal_end_cells()
+        m.flood_fill_all()
+        direction, row, column = 0, 0, 0
+        await runtime.scan_for_walls(m, direction, row, column)
+        moves = 0
+        while m.get_cell_value(row, column) != 0:
+            heading = m.get_lowest_directions_against_heading(direction, row, column)[0]
+            if heading == 0:
+                runtime.command(controller.move_forward, mouse.distance_cell)
+                await runtime.wait_for_move_to_finish()
+                row, column = [(row+1, column), (row, column+1), (row-1, column), (row, column-1)][direction]
+                await runtime.scan_for_walls(m, direction, row, column)
+            elif heading == 1 or heading == 2:
+                runtime.command(controller.move_right, mouse.distance_turnr90 if heading == 1 else mouse.distance_turn180)
+                await runtime.wait_for_move_to_finish()
+                direction = (direction + heading) & 3
+            else:
+                runtime.command(controller.move_left, mouse.distance_turnl90)
+                await runtime.wait_for_move_to_finish()
+                direction = (direction - 1) & 3
+            moves += 1
+        runtime.command(controller.turn_off_ir)
+        await runtime.flush()
+        return moves
+
+    async def test():
+        port = mouse.serial.Serial(mouse.serial_port, baudrate = 57600, timeout = 0.1)
+        runtime = AsyncMouseRuntime(port)
+        await runtime.start()
+        moves = await search_to_centre(runtime)
+
+        # idle, with just the timer task and battery events
+        start_cpu = resource.getrusage(resource.RUSAGE_SELF)
+        await runtime.wait_seconds(2)
+        end_cpu = resource.getrusage(resource.RUSAGE_SELF)
+        idle_cpu = (end_cpu.ru_utime + end_cpu.ru_stime) - (start_cpu.ru_utime + start_cpu.ru_stime)
+
+        # a reset with nothing waiting must not be lost
+        runtime._frame_received(bytes([0x05]))
+        try:
+            runtime.command(runtime.mouse.turn_on_ir)
+            print("Reset while not waiting was lost")
+            sys.exit(1)
+        except mouse.SoftReset:
+            pass
+        await runtime.stop()
+        if runtime.reader.thread.is_alive():
+            print("Reader thread still running")
+            sys.exit(1)
+        print("Got to centre in", moves, "moves,", runtime.events_handled, "events")
+        print("CPU used idling for 2 s = %.3f s" % idle_cpu)
+        runtime.mouse.print_flow_stats()
+        runtime.mouse.print_write_cache_stats()
+
+    asyncio.run(test())
+    # the emulator's key thread is waiting on stdin
+    sys.exit(0)
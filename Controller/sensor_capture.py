@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+#
+# Sensor capture for the Vision2 Micromouse Robot, using NumPy.
+#
+# The event handlers in mouse.py keep just the last value of each sensor,
+# so anything that arrives between reads is lost. This keeps every sample
+# (IR levels, speed samples, motor tick reports) with the time it was
+# decoded, in fixed size ring buffers - so a long run can't use up the
+# Pi's memory, we just lose the oldest samples.
+#
+# Each channel has a name (e.g. "l45" or "speed") and a fixed number of
+# values per sample (e.g. 1 for an IR level, 2 for left and right speed).
+#
+# Copyright 2016 Rob Probin.
+# All original work.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+from __future__ import print_function
+
+import sys
+import time
+import numpy as np
+
+DEFAULT_CAPACITY = 8192     # samples per channel
+
+# (name, values per sample) of what mouse.py records
+default_channels = (
+    ("front", 1),
+    ("l90", 1),
+    ("l45", 1),
+    ("r90", 1),
+    ("r45", 1),
+    ("speed", 2),           # left, right
+    ("ticks", 2),           # left, right, at the end of a move
+)
+
+
+class RingBuffer(object):
+
+    def __init__(self, capacity, width, dtype=np.int32):
+        self.capacity = capacity
+        self.width = width
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.data = np.zeros((capacity, width), dtype=dtype)
+        self.written = 0        # total ever appended
+
+    def __len__(self):
+        return min(self.written, self.capacity)
+
+    # samples that have been overwritten
+    def dropped(self):
+        return max(0, self.written - self.capacity)
+
+    def append(self, t, values):
+        index = self.written % self.capacity
+        self.times[index] = t
+        self.data[index] = values
+        self.written += 1
+
+    def clear(self):
+        self.written = 0
+
+    # The last n samples (all of them if n is None), oldest first, as
+    # (times, data) arrays. These are copies.
+    def latest(self, n=None):
+        count = len(self)
+        if n is None or n > count:
+            n = count
+        end = self.written % self.capacity
+        indexes = (np.arange(end - n, end)) % self.capacity
+        return self.times[indexes], self.data[indexes]
+
+    # Samples with start_time <= time < end_time, oldest first
+    def window(self, start_time=None, end_time=None):
+        times, data = self.latest()
+        # times go up, so we can search rather than scan
+        first = 0 if start_time is None else np.searchsorted(times, start_time, side="left")
+        last = len(times) if end_time is None else np.searchsorted(times, end_time, side="left")
+        return times[first:last], data[first:last]
+
+
+# Average each block of factor samples, to make long captures smaller.
+# Anything left over at the end (less than a block) is dropped.
+def decimate(times, data, factor):
+    if factor <= 1:
+        return times, data
+    blocks = len(times) // factor
+    times = times[:blocks*factor].reshape(blocks, factor).mean(axis=1)
+    data = data[:blocks*factor].reshape(blocks, factor, -1).mean(axis=1)
+    return times, data
+
+
+class SensorCapture(object):
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, channels=default_channels):
+        self.capacity = capacity
+        self.channels = {}
+        for name, width in channels:
+            self.channels[name] = RingBuffer(capacity, width)
+
+    def record(self, channel, values, t=None):
+        if t is None:
+            t = time.time()
+        self.channels[channel].append(t, values)
+
+    def clear(self):
+        for ring in self.channels.values():
+            ring.clear()
+
+    def count(self, channel):
+        return len(self.channels[channel])
+
+    def latest(self, channel, n=None):
+        return self.channels[channel].latest(n)
+
+    def window(self, channel, start_time=None, end_time=None):
+        return self.channels[channel].window(start_time, end_time)
+
+    def decimated(self, channel, factor, start_time=None, end_time=None):
+        times, data = self.window(channel, start_time, end_time)
+        return decimate(times, data, factor)
+
+    # Save everything to a .npz file, as <channel>_time and <channel>
+    # arrays for each channel, oldest first.
+    def export(self, filename, start_time=None, end_time=None):
+        arrays = {}
+        for name in self.channels:
+            times, data = self.window(name, start_time, end_time)
+            arrays[name + "_time"] = times
+            arrays[name] = data
+        np.savez_compressed(filename, **arrays)
+
+    # Save one channel as a CSV file of time, value, value...
+    def export_csv(self, filename, channel, start_time=None, end_time=None):
+        times, data = self.window(channel, start_time, end_time)
+        np.savetxt(filename, np.column_stack((times, data)), delimiter=", ", fmt="%.6f")
+
+    def print_stats(self):
+        for name in sorted(self.channels):
+            ring = self.channels[name]
+            if ring.written:
+                print("Captured %s: %d samples (%d dropped)" % (name, len(ring), ring.dropped()))
+
+
+if __name__ == "__main__":
+    def test():
+        import os
+        import tempfile
+        import timeit
+
+        # wrap round a small buffer and check we get the newest, in order
+        capture = SensorCapture(capacity = 100)
+        for n in range(250):
+            capture.record("l45", (n,), t = n * 0.01)
+            capture.record("speed", (n, 2*n), t = n * 0.01)
+        times, data = capture.latest("l45")
+        if list(data[:, 0]) != list(range(150, 250)) or capture.channels["l45"].dropped() != 150:
+            print("Ring buffer didn't keep the newest samples")
+            sys.exit(1)
+        times, data = capture.latest("speed", 3)
+        if data.tolist() != [[247, 494], [248, 496], [249, 498]]:
+            print("latest() wrong")
+            sys.exit(1)
+
+        times, data = capture.window("l45", 2.0, 2.1)
+        if list(data[:, 0]) != list(range(200, 210)):
+            print("window() wrong")
+            sys.exit(1)
+
+        times, data = capture.decimated("l45", 10)
+        if len(data) != 10 or data[0, 0] != 154.5:
+            print("decimated() wrong")
+            sys.exit(1)
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "capture.npz")
+            capture.export(filename)
+            with np.load(filename) as saved:
+                if saved["speed"].tolist() != capture.latest("speed")[1].tolist():
+                    print("export() wrong")
+                    sys.exit(1)
+            capture.export_csv(os.path.join(directory, "l45.csv"), "l45")
+            if len(np.loadtxt(os.path.join(directory, "l45.csv"), delimiter=",")) != 100:
+                print("export_csv() wrong")
+                sys.exit(1)
+
+        # how long a record takes, as the event handlers will do it
+        capture = SensorCapture()
+        count = 100000
+        start = timeit.default_timer()
+        for n in range(count):
+            capture.record("front", (n & 1023,), t = n)
+        duration = timeit.default_timer() - start
+        print("record() takes %.2f us, %d samples of each channel is %d KB" %
+              (duration * 1e6 / count, capture.capacity,
+               sum(r.times.nbytes + r.data.nbytes for r in capture.channels.values()) // 1024))
+        capture.print_stats()
+
+    test()
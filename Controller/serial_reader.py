@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+# Serial reader thread for the Vision2 Micromouse Robot.
+#
+# The thread owns reading from the serial port. It splits what it reads
+# into whole event frames (using the frame lengths from mouse.py) and puts
+# them on a queue. The control code waits on the queue with a timeout, so
+# it sleeps rather than spinning while waiting for a move to finish or a
+# key press. Handlers are still run by the control code, not this thread.
+#
+# Instead of the queue, on_frame can be given to be called (from this
+# thread) with each frame, e.g. to pass them to an asyncio event loop.
+#
+# Copyright 2016 Rob Probin.
+# All original work.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+from __future__ import print_function
+
+import time
+from threading import Thread
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+# Take one whole frame off the front of buffer (a bytearray), or return
+# None if there isn't a whole one there yet. Events not in frame_lengths
+# are one byte long.
+def take_frame(buffer, frame_lengths):
+    if not buffer:
+        return None
+    length = frame_lengths.get(buffer[0], 1)
+    if len(buffer) < length:
+        return None
+    frame = bytes(buffer[:length])
+    del buffer[:length]
+    return frame
+
+
+class SerialReader(object):
+
+    def __init__(self, port, frame_lengths, on_frame=None):
+        self.port = port
+        self.frame_lengths = frame_lengths
+        self.on_frame = on_frame
+        self.events = queue.Queue()
+        self.buffer = bytearray()
+        self.read_calls = 0
+        self.running = True
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True      # thread dies with the program
+        self.thread.start()
+
+    def _run(self):
+        while self.running:
+            # everything that's waiting, or wait (up to the port timeout)
+            # for one byte if there is nothing
+            waiting = self.port.inWaiting()
+            data = self.port.read(waiting if waiting else 1)
+            self.read_calls += 1
+            if not data:
+                # the emulator doesn't block, so don't spin on it
+                time.sleep(0.001)
+                continue
+
+            self.buffer.extend(data)
+            while True:
+                frame = take_frame(self.buffer, self.frame_lengths)
+                if frame is None:
+                    break
+                if self.on_frame:
+                    self.on_frame(frame)
+                else:
+                    self.events.put(frame)
+
+    # Next frame, waiting up to timeout seconds for one (no wait if
+    # timeout is 0). Returns None if there isn't one.
+    def get_event(self, timeout):
+        try:
+            if timeout:
+                return self.events.get(timeout=timeout)
+            return self.events.get_nowait()
+        except queue.Empty:
+            return None
+
+    def events_waiting(self):
+        return not self.events.empty()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
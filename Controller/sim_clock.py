@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#
+# Time source for mouse.py and the low level emulator.
+#
+# Normally this is just the wall clock. For headless simulation it can be
+# switched to a virtual clock, where time only moves when something waits:
+# sleep() adds to the clock and returns straight away. Because mouse.py
+# and the emulator both read the time from here, the emulator's timers
+# (battery reports, key holds) and mouse.py's waits (the start delay, key
+# hold times, wait_seconds()) still happen in the right order, but a whole
+# maze solve takes only as long as the code takes to run.
+#
+# wait() is for waiting for the serial port: like a blocking read, it
+# returns early if something arrives. The emulator (its timers and move
+# ends) and mouse.py (its timer tick and wait_seconds()) say when they
+# next have something to do with wake_at(), so on the virtual clock a
+# wait goes straight to the next of those, however far off it is, rather
+# than creeping up on it a wait time at a time.
+#
+# Call use_virtual_clock() before importing mouse.py, or use the
+# HEADLESS_SIMULATOR command line argument, which does it.
+#
+# Copyright 2016 Rob Probin.
+# All original work.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+from __future__ import print_function
+
+import time as _time
+import heapq
+
+
+class RealClock(object):
+    virtual = False
+
+    def time(self):
+        return _time.time()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            _time.sleep(seconds)
+
+    # the real serial port wakes us up
+    def wait(self, seconds):
+        self.sleep(seconds)
+
+    def wake_at(self, t):
+        pass
+
+
+class VirtualClock(object):
+    virtual = True
+
+    def __init__(self, start=0.0):
+        self.now = start
+        self.slept = 0.0        # total time skipped
+        self.wake_times = []    # heap
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.now += seconds
+            self.slept += seconds
+
+    # to the next wake_at() time, or for seconds if there isn't one
+    def wait(self, seconds):
+        while self.wake_times and self.wake_times[0] <= self.now:
+            heapq.heappop(self.wake_times)
+        if self.wake_times:
+            self.sleep(heapq.heappop(self.wake_times) - self.now)
+        else:
+            self.sleep(seconds)
+
+    def wake_at(self, t):
+        heapq.heappush(self.wake_times, t)
+
+
+clock = RealClock()
+
+def use_virtual_clock(start=0.0):
+    global clock
+    clock = VirtualClock(start)
+    return clock
+
+def use_real_clock():
+    global clock
+    clock = RealClock()
+    return clock
+
+def is_virtual():
+    return clock.virtual
+
+def time():
+    return clock.time()
+
+def sleep(seconds):
+    clock.sleep(seconds)
+
+def wait(seconds):
+    clock.wait(seconds)
+
+def wake_at(t):
+    clock.wake_at(t)
+
+
+if __name__ == "__main__":
+    def test():
+        import sys
+        start = _time.time()
+        c = use_virtual_clock(100.0)
+        sleep(3600)
+        if time() != 3700.0 or not is_virtual() or c.slept != 3600:
+            print("Virtual clock wrong")
+            sys.exit(1)
+        sleep(-1)
+        if time() != 3700.0:
+            print("Negative sleep moved the clock")
+            sys.exit(1)
+        wake_at(3700.25)
+        wake_at(3699.0)     # already gone
+        wait(1)
+        if time() != 3700.25:
+            print("Wait didn't wake up")
+            sys.exit(1)
+        wait(1)
+        if time() != 3701.25:
+            print("Wait without a wake up was short")
+            sys.exit(1)
+        wake_at(3711.25)
+        wake_at(3711.25)    # asked for twice
+        wait(0.02)
+        if time() != 3711.25:
+            print("Wait didn't go to the next wake up")
+            sys.exit(1)
+        wait(0.02)
+        if time() != 3711.27:
+            print("Wake up used twice")
+            sys.exit(1)
+        if _time.time() - start > 0.5:
+            print("Virtual sleep really slept")
+            sys.exit(1)
+        use_real_clock()
+        if is_virtual() or abs(time() - _time.time()) > 0.5:
+            print("Real clock wrong")
+            sys.exit(1)
+        print("OK")
+
+    test()
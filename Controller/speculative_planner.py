@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+#
+# Speculative planner - works out the next move while the current one runs.
+#
+# When the mouse moves forward into a cell, the only thing we don't know
+# is which of the left, front and right walls are there. So while the move
+# is running (and the Pi would otherwise just be waiting) we flood fill for
+# each possible outcome, at most 8. When the wall scan comes back we just
+# pick the matching answer, rather than flood filling before the next move.
+#
+# Copyright 2016 Rob Probin.
+# All original work.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+from __future__ import print_function
+
+import sys
+from maze import Maze
+
+
+class SpeculativePlanner(object):
+
+    def __init__(self, m):
+        self.m = m
+        self.pending = []
+        self.results = {}
+        self.started = False
+        self.base_revision = None
+        self.used_revision = None
+        self.used_headings = None
+        self.hits = 0
+        self.misses = 0
+
+    # Call before waiting for a move, with where the robot will be when the
+    # move finishes. Nothing is worked out here, that's done by step().
+    def start(self, heading, row, column):
+        m = self.m
+        self.heading = heading & 3
+        self.row = row
+        self.column = column
+        self.targets = tuple(m.targets)
+        self.base_revision = m.wall_revision
+        self.results = {}
+        self.used_headings = None
+        self.started = True
+
+        # walls we already have can't be new, so only the rest can vary
+        unknown = []
+        for wall_heading in ((heading-1) & 3, heading & 3, (heading+1) & 3):
+            if not m.get_front_wall(wall_heading, row, column):
+                unknown.append(wall_heading)
+
+        # every combination of the unknown walls, no new walls first
+        self.pending = []
+        for combination in range(1 << len(unknown)):
+            self.pending.append(frozenset(wall_heading for bit, wall_heading in enumerate(unknown)
+                                          if combination & (1 << bit)))
+
+    # Work out one outcome. Returns True if there is more to do, so it can
+    # be called from a wait loop until it returns False.
+    def step(self):
+        if not self.pending:
+            return False
+        m = self.m
+        if m.wall_revision != self.base_revision or tuple(m.targets) != self.targets:
+            # maze changed under us, what we have is no use
+            self.pending = []
+            self.results = {}
+            return False
+
+        new_headings = self.pending.pop(0)
+        state = m.save_state()
+        walls = []
+        for wall_heading in new_headings:
+            m.set_front_wall(wall_heading, self.row, self.column)
+            walls.append((wall_heading, self.row, self.column))
+        if walls:
+            m.flood_fill_incremental(walls)
+        headings = m.get_lowest_directions_against_heading(self.heading, self.row, self.column)
+        cell_data = m.cell_data[:] if walls else None
+        m.restore_state(state)
+
+        self.results[new_headings] = (cell_data, headings)
+        return len(self.pending) != 0
+
+    # Called after the new walls for the cell at (row, column), arrived at
+    # on heading, have been set. revision is the wall revision before they
+    # were set. If we worked this outcome out already (for the same cell)
+    # the cell data is put into the maze and True is returned, otherwise
+    # the caller needs to flood fill.
+    def use_result(self, heading, row, column, revision, walls):
+        m = self.m
+        if not self.started:
+            return False
+        self.started = False
+        key = frozenset(wall_heading & 3 for wall_heading, _, _ in walls)
+        if ((heading & 3, row, column) != (self.heading, self.row, self.column)
+                or revision != self.base_revision or tuple(m.targets) != self.targets
+                or key not in self.results):
+            self.misses += 1
+            return False
+
+        self.hits += 1
+        cell_data, headings = self.results[key]
+        if cell_data is not None:
+            m.use_cell_data(cell_data)
+        self.used_revision = m.wall_revision
+        self.used_headings = headings
+        return True
+
+    # The headings worked out for the cell we moved into, or None if they
+    # aren't valid any more (walls or targets changed since, or we aren't
+    # in that cell). They are relative to the heading we arrived on, so
+    # they can only be used once, before the robot turns.
+    def get_headings(self, heading, row, column):
+        m = self.m
+        headings = self.used_headings
+        self.used_headings = None
+        if headings is None:
+            return None
+        if ((heading & 3, row, column) != (self.heading, self.row, self.column)
+                or m.wall_revision != self.used_revision or tuple(m.targets) != self.targets):
+            return None
+        return headings
+
+
+if __name__ == "__main__":
+    def test():
+        import random
+        import timeit
+
+        # drive random routes round the example mazes, checking the planner
+        # gives the same answer as scanning then flood filling
+        random.seed(1)
+        plan_time = 0
+        lookup_time = 0
+        flood_time = 0
+        cells = 0
+        for select in range(3):
+            truth = Maze(16, standard_target = True)
+            truth.load_example_maze(select)
+            m = Maze(16, standard_target = True)
+            check = Maze(16, standard_target = True)
+            m.flood_fill_all()
+            check.flood_fill_all()
+            planner = SpeculativePlanner(m)
+            heading, row, column = 0, 0, 0
+            while m.get_cell_value(row, column) != 0 and cells < 2000:
+                headings = planner.get_headings(heading, row, column)
+                if headings is None:
+                    headings = m.get_lowest_directions_against_heading(heading, row, column)
+                if headings != check.get_lowest_directions_against_heading(heading, row, column):
+                    print("Headings differ from flood fill")
+                    sys.exit(1)
+                heading = (heading + headings[0]) & 3
+                if m.get_front_wall(heading, row, column):
+                    print("Driving into a wall")
+                    sys.exit(1)
+                row, column = [(row+1, column), (row, column+1), (row-1, column), (row, column-1)][heading]
+
+                # the move - plan while it runs
+                start_time = timeit.default_timer()
+                planner.start(heading, row, column)
+                while planner.step():
+                    pass
+                plan_time += timeit.default_timer() - start_time
+
+                # the scan
+                walls = []
+                for wall_heading in (heading-1, heading, heading+1):
+                    if truth.get_front_wall(wall_heading, row, column) and not m.get_front_wall(wall_heading, row, column):
+                        walls.append((wall_heading, row, column))
+                start_time = timeit.default_timer()
+                revision = m.wall_revision
+                for wall in walls:
+                    m.set_front_wall(*wall)
+                if walls and not planner.use_result(heading, row, column, revision, walls):
+                    print("Outcome not planned")
+                    sys.exit(1)
+                lookup_time += timeit.default_timer() - start_time
+
+                start_time = timeit.default_timer()
+                for wall in walls:
+                    check.set_front_wall(*wall)
+                if walls:
+                    check.flood_fill_incremental(walls)
+                flood_time += timeit.default_timer() - start_time
+                if list(m.cell_data) != list(check.cell_data):
+                    print("Cell data differs from flood fill")
+                    sys.exit(1)
+                cells += 1
+        # A move extended past the cell that was planned for (the mouse
+        # doesn't stop at (1, 0), which has no new walls, and carries on to
+        # (2, 0) which has a front wall). Column 0 is a dead end corridor,
+        # so the two cells give different distances. The outcome {front}
+        # was planned, but for the wrong cell, so it mustn't be used.
+        m = Maze(16, standard_target = True)
+        check = Maze(16, standard_target = True)
+        for row in range(15):
+            m.set_front_wall(1, row, 0)
+            check.set_front_wall(1, row, 0)
+        m.flood_fill_all()
+        check.flood_fill_all()
+        planner = SpeculativePlanner(m)
+        planner.start(0, 1, 0)
+        while planner.step():
+            pass
+        revision = m.wall_revision
+        m.set_front_wall(0, 2, 0)
+        if planner.use_result(0, 2, 0, revision, [(0, 2, 0)]):
+            print("Planned outcome used for a different cell")
+            sys.exit(1)
+        m.flood_fill_incremental([(0, 2, 0)])
+        check.set_front_wall(0, 2, 0)
+        check.flood_fill_all()
+        if list(m.cell_data) != list(check.cell_data) or planner.get_headings(0, 2, 0) is not None:
+            print("Extended move used the wrong plan")
+            sys.exit(1)
+
+        print("%d cells: planning %.1f ms (during moves), after scan %.1f ms, flood after scan %.1f ms" %
+              (cells, plan_time*1000, lookup_time*1000, flood_time*1000))
+
+    test()
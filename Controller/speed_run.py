@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+#
+# Speed run compiler for the Vision2 Micromouse Robot.
+#
+# Once the maze is solved the whole route is known before we start, so
+# rather than deciding a cell at a time we walk the distance map once and
+# turn it into a list of moves, with straights merged into one long
+# forward move. Each move is (move, distance, speed) where move is one of
+# "forward", "left" or "right" (a 180 is a long "right").
+#
+# compile_diagonal_speed_run() also cuts across staircase parts of the
+# route. A zig-zag of cells (e.g. N, E, N, E) is run as a 45 degree turn,
+# one "diagonal" move through the middles of the cell edges, and another
+# 45 degree turn, rather than a stop and a 90 degree turn in every cell.
+#
+# Copyright 2016 Rob Probin.
+# All original work.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+from __future__ import print_function
+
+import sys
+import math
+from maze import Maze
+from acceleration import default_acceleration_table, estimate_move_time
+
+# (cell, turn left 90, turn right 90, turn 180) in steps, for step mode 2.
+# mouse.py passes its own values in.
+default_distances = (694, 224, 224, 448)
+
+
+# The route loops or stops short of the target (e.g. the maze wasn't
+# flood filled for it)
+class SpeedRunRouteFailed(Exception):
+    pass
+
+
+# Walk the route from (heading, row, column) to a target and return
+# (moves, (heading, row, column)) where the second part is where the
+# robot ends up. The maze must be flood filled for the targets first; if
+# weighted is True, flood_fill_weighted() must have been done and the
+# fastest route is followed instead of the shortest.
+def compile_speed_run(m, heading, row, column, speed, distances=default_distances, turn_speed=None, weighted=False):
+    if turn_speed is None:
+        turn_speed = speed
+    cell_distance, turnl90_distance, turnr90_distance, turn180_distance = distances
+
+    moves = []
+    straight_cells = 0
+    # a route can't be longer than visiting every cell in every heading
+    for _ in range(m.size * m.size * 4):
+        if weighted:
+            headings = m.get_fastest_directions_against_heading(heading, row, column)
+        else:
+            headings = m.get_lowest_directions_against_heading(heading, row, column)
+        if len(headings) == 0:
+            break
+        relative = headings[0] & 3
+
+        if relative == 0:
+            straight_cells += 1
+            if heading == 0:
+                row += 1
+            elif heading == 1:
+                column += 1
+            elif heading == 2:
+                row -= 1
+            else:
+                column -= 1
+            continue
+
+        if straight_cells:
+            moves.append(("forward", straight_cells * cell_distance, speed))
+            straight_cells = 0
+        if relative == 1:
+            moves.append(("right", turnr90_distance, turn_speed))
+        elif relative == 3:
+            moves.append(("left", turnl90_distance, turn_speed))
+        else:
+            moves.append(("right", turn180_distance, turn_speed))
+        heading = (heading + relative) & 3
+    else:
+        raise SpeedRunRouteFailed("Speed run route doesn't get to the target")
+
+    if straight_cells:
+        moves.append(("forward", straight_cells * cell_distance, speed))
+    return moves, (heading, row, column)
+
+
+# The absolute heading of each cell step along the route, and where the
+# robot ends up as (heading, row, column).
+def route_headings(m, heading, row, column, weighted=False):
+    steps = []
+    for _ in range(m.size * m.size * 4):
+        if weighted:
+            headings = m.get_fastest_directions_against_heading(heading, row, column)
+        else:
+            headings = m.get_lowest_directions_against_heading(heading, row, column)
+        if len(headings) == 0:
+            return steps, (heading, row, column)
+        heading = (heading + headings[0]) & 3
+        if headings[0] & 3 == 0:
+            steps.append(heading)
+            if heading == 0:
+                row += 1
+            elif heading == 1:
+                column += 1
+            elif heading == 2:
+                row -= 1
+            else:
+                column -= 1
+
+    raise SpeedRunRouteFailed("Speed run route doesn't get to the target")
+
+
+# Same as compile_speed_run(), but zig-zags of three or more cells are cut
+# across diagonally. Headings are tracked in 45 degree units (0 = north,
+# 1 = north east, 2 = east...) and a 45 degree turn is half a 90.
+def compile_diagonal_speed_run(m, heading, row, column, speed, distances=default_distances, turn_speed=None, weighted=False):
+    if turn_speed is None:
+        turn_speed = speed
+    cell_distance, turnl90_distance, turnr90_distance, turn180_distance = distances
+    steps, end = route_headings(m, heading, row, column, weighted)
+
+    moves = []
+    state = {"facing": heading * 2, "cells": 0.0}
+
+    def flush():
+        if state["cells"]:
+            move = "diagonal" if state["facing"] & 1 else "forward"
+            moves.append((move, int(round(state["cells"] * cell_distance)), speed))
+            state["cells"] = 0.0
+
+    def turn_to(facing):
+        turn = (facing - state["facing"]) & 7
+        if turn == 0:
+            return
+        flush()
+        if turn == 4:
+            moves.append(("right", turn180_distance, turn_speed))
+        elif turn < 4:
+            moves.append(("right", turnr90_distance * turn // 2, turn_speed))
+        else:
+            moves.append(("left", turnl90_distance * (8 - turn) // 2, turn_speed))
+        state["facing"] = facing
+
+    n = len(steps)
+    i = 0
+    while i < n:
+        # find how long the zig-zag starting here is
+        j = i + 1
+        while (j < n and (steps[j] - steps[j-1]) & 1
+               and (j - i < 2 or steps[j] == steps[j-2])):
+            j += 1
+
+        if j - i >= 3:
+            # half a cell to the middle of the first edge, across the
+            # middles of the edges, then half a cell into the last cell
+            if steps[i+1] == (steps[i] + 1) & 3:
+                diagonal = (steps[i] * 2 + 1) & 7
+            else:
+                diagonal = (steps[i] * 2 - 1) & 7
+            turn_to(steps[i] * 2)
+            state["cells"] += 0.5
+            turn_to(diagonal)
+            state["cells"] += (j - i - 1) * math.sqrt(0.5)
+            turn_to(steps[j-1] * 2)
+            state["cells"] += 0.5
+            i = j
+        else:
+            turn_to(steps[i] * 2)
+            state["cells"] += 1
+            i += 1
+
+    flush()
+    # finish facing the same way as the cardinal route does
+    turn_to(end[0] * 2)
+    return moves, end
+
+
+# Estimated time for a list of moves, stopping between each one
+def estimate_run_time(moves, acceleration_table=default_acceleration_table):
+    return sum(estimate_move_time(distance, speed, acceleration_table) for _, distance, speed in moves)
+
+
+if __name__ == "__main__":
+    def test():
+        speed = 500
+        cell_distance, turnl90_distance, turnr90_distance, turn180_distance = default_distances
+        for select in range(3):
+            m = Maze(16, standard_target = True)
+            m.load_example_maze(select)
+            m.flood_fill_all()
+
+            # what the search loop does - one move per cell or turn
+            cell_moves = []
+            for move, distance, move_speed in compile_speed_run(m, 0, 0, 0, speed)[0]:
+                if move == "forward":
+                    cell_moves += [(move, cell_distance, move_speed)] * (distance // cell_distance)
+                else:
+                    cell_moves.append((move, distance, move_speed))
+
+            moves, end = compile_speed_run(m, 0, 0, 0, speed)
+            heading, row, column = end
+            if m.get_cell_value(row, column) != 0:
+                print("Speed run doesn't end on the target")
+                sys.exit(1)
+
+            straight_costs = [estimate_move_time(cells * cell_distance, speed) for cells in range(m.size + 1)]
+            m.flood_fill_weighted(straight_costs, estimate_move_time(turnl90_distance, speed),
+                                  estimate_move_time(turn180_distance, speed))
+            fastest_moves, end = compile_speed_run(m, 0, 0, 0, speed, weighted=True)
+            if m.get_cell_value(end[1], end[2]) != 0:
+                print("Fastest speed run doesn't end on the target")
+                sys.exit(1)
+
+            print("Example maze %d: per cell %3d moves %6.2f s, compiled %3d moves %6.2f s, fastest %3d moves %6.2f s" %
+                  (select, len(cell_moves), estimate_run_time(cell_moves),
+                   len(moves), estimate_run_time(moves),
+                   len(fastest_moves), estimate_run_time(fastest_moves)))
+
+            # diagonals, against the cardinal only routes
+            for weighted in (False, True):
+                cardinal_moves, end = compile_speed_run(m, 0, 0, 0, speed, weighted=weighted)
+                diagonal_moves, diagonal_end = compile_diagonal_speed_run(m, 0, 0, 0, speed, weighted=weighted)
+                if diagonal_end != end or trace_moves(m, diagonal_moves) != end:
+                    print("Diagonal speed run doesn't end in the same place")
+                    sys.exit(1)
+                print("    %s diagonal %3d moves %6.2f s against %6.2f s, saves %5.2f s" %
+                      ("fastest " if weighted else "shortest", len(diagonal_moves), estimate_run_time(diagonal_moves),
+                       estimate_run_time(cardinal_moves),
+                       estimate_run_time(cardinal_moves) - estimate_run_time(diagonal_moves)))
+
+        # a route that goes round in circles (turning right for ever) is
+        # an exception, not an exit, so run_program() can recover
+        m = Maze(16, standard_target = True)
+        m.get_fastest_directions_against_heading = lambda heading, row, column: [1]
+        for compiler in (compile_speed_run, compile_diagonal_speed_run):
+            try:
+                compiler(m, 0, 0, 0, speed, weighted=True)
+                print("Looping route not found")
+                sys.exit(1)
+            except SpeedRunRouteFailed:
+                pass
+
+    # Follow the moves from the start cell, in half cells, checking no wall
+    # is crossed, and return where we end up as (heading, row, column).
+    def trace_moves(m, moves):
+        cell_distance, turnl90_distance, turnr90_distance, turn180_distance = default_distances
+        # position is in half cells, so cell centres are even numbers
+        facing = 0
+        y, x = 0, 0
+        directions = [(1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1)]
+        for move, distance, _ in moves:
+            if move == "right" and distance == turn180_distance:
+                facing = (facing + 4) & 7
+            elif move == "right":
+                facing = (facing + distance * 2 // turnr90_distance) & 7
+            elif move == "left":
+                facing = (facing - distance * 2 // turnl90_distance) & 7
+            else:
+                if move == "diagonal":
+                    half_cells = int(round(distance / (cell_distance * math.sqrt(0.5))))
+                else:
+                    half_cells = int(round(distance * 2.0 / cell_distance))
+                dy, dx = directions[facing]
+                for _ in range(half_cells):
+                    if move == "forward":
+                        # leaving a cell centre crosses its front wall
+                        if y % 2 == 0 and x % 2 == 0 and m.get_front_wall(facing // 2, y // 2, x // 2):
+                            print("Speed run goes through a wall")
+                            sys.exit(1)
+                    else:
+                        # diagonals go from the middle of one edge to the
+                        # middle of the next, and that edge must be open
+                        if (y + x) % 2 == 0:
+                            print("Diagonal doesn't start on the middle of an edge")
+                            sys.exit(1)
+                        if (y + dy) % 2:
+                            wall = m.get_front_wall(0, (y + dy) // 2, (x + dx) // 2)
+                        else:
+                            wall = m.get_front_wall(1, (y + dy) // 2, (x + dx) // 2)
+                        if wall:
+                            print("Diagonal goes through a wall")
+                            sys.exit(1)
+                    y += dy
+                    x += dx
+        return facing // 2, y // 2, x // 2
+
+    test()
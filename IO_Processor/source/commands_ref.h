@@ -61,7 +61,7 @@ typedef unsigned char cmd_t;
 // 0x70 unused (ASCII range)
 
 #define CMD_TYPE_POLL           0x8        // bottom 4 bytes ignored / reflected(?) (To be confirmed)
-#define CMD_TYPE_REQUEST_STATE  0x9        // nnnn=0 all state <not implemented>(in the following order)
+#define CMD_TYPE_REQUEST_STATE  0x9        // nnnn=0 all sensor state, returns EV_ALL_SENSOR_STATE
                                             //nnnn=1 LED state <not implemented>
                                             //nnnn=2 movement state<not implemented>
                                             //nnnn=3 <spare>
@@ -176,6 +176,10 @@ typedef unsigned char cmd_t;
                                             // bit 1 = right 45
                                             // bit 2 = left 45 too close
                                             // bit 3 = right 45 too close
+#define EV_ALL_SENSOR_STATE     0x60        // followed by 12 bytes:
+                                            //   IR front/side state bitmap (as EV_IR_FRONT_SIDE_STATE)
+                                            //   IR 45 state bitmap (as EV_IR_45_STATE)
+                                            //   int16 front, L90, L45, R90, R45 levels
 #define EV_IR_FRONT_LEVEL       0x61
 #define EV_L90_LEVEL            0x62
 #define EV_L45_LEVEL            0x63
@@ -618,6 +618,16 @@ int main(int argc, char** argv)
                         case CMD_TYPE_REQUEST_STATE:
                             switch(low_nibble)
                             {
+                                case 0: // all sensor state, in one frame
+                                    send_event(EV_ALL_SENSOR_STATE);
+                                    send_event(get_ir_front_side_bitmap());
+                                    send_event(get_ir_45_bitmap());
+                                    serial_write_int16(front_sensor);
+                                    serial_write_int16(left_side_sensor);
+                                    serial_write_int16(l45_sensor);
+                                    serial_write_int16(right_side_sensor);
+                                    serial_write_int16(r45_sensor);
+                                    break;
                                 case 4: // battery voltage
                                 {
                                     int battery_v = battery_voltage & 0x3FF;